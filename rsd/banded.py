@@ -0,0 +1,297 @@
+'''
+Banded pairwise alignment, seeded by the coordinates of the blast HSP (high
+scoring pair) of a hit, as an alternative to aligning every sequence pair with
+kalign (see rsd.setAlignMode()).
+
+Blast has already found where a sequence and its hit align, so the dynamic
+programming only needs the cells near the diagonals (hit position minus
+sequence position) the HSP runs along.  alignBanded() fills the cells within
+BAND_MARGIN diagonals of the HSP, so the work grows with the length of the
+sequences times the width of the band instead of the product of their lengths,
+which matters for long proteins.  Alignments use BLOSUM62 and affine gap costs
+(11 to open, 1 to extend), like the k-mer search backend (see rsd.search).
+Gaps at the ends of an alignment are free, as an overhang of one sequence past
+the other is trimmed by RSD anyway (see rsd.dashlen_check()).  With numpy, a
+row of the band is computed at a time.
+
+compareAligners() measures how often banded alignments agree with kalign, and
+how much faster they are, on the hits of a pair of genomes.
+'''
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import fasta
+import search
+
+
+# the band spans the diagonals of the HSP, widened by this many diagonals on each side.
+BAND_MARGIN = 64
+# divergence thresholds at which compareAligners() checks whether the two alignments of a pair agree.
+COMPARE_DIVERGENCES = (0.2, 0.5, 0.8)
+# a score below any alignment score, for cells outside the band or the matrix.
+_NEG = -2**28
+# traceback pointers: where the best score of a cell comes from.
+_DIAGONAL, _VERTICAL, _HORIZONTAL, _START = 0, 1, 2, 3
+
+
+def bandForHsp(hsp, seqLength, hitSeqLength, margin=BAND_MARGIN):
+    '''
+    hsp: the (qstart, qend, sstart, send) coordinates of the HSP of a hit, 1-based and inclusive as reported by blast,
+      where the query is the sequence and the subject is the hit sequence.
+    returns: a pair of the lowest and highest diagonal (hit position minus sequence position) of the band.
+    '''
+    qstart, qend, sstart, send = hsp
+    diagonals = (sstart - qstart, send - qend)
+    return max(-seqLength, min(diagonals) - margin), min(hitSeqLength, max(diagonals) + margin)
+
+
+def alignBanded(seq, hitSeq, lowDiagonal, highDiagonal):
+    '''
+    seq, hitSeq: protein sequences.
+    lowDiagonal, highDiagonal: the band of diagonals (hit position minus sequence position) in which to align, e.g.
+      from bandForHsp().
+    returns: a pair of the aligned seq and hitSeq, padded with '-', of the best scoring alignment within the band, with
+      free end gaps.  Uses numpy if it is installed.
+    '''
+    lowDiagonal = max(-len(seq), lowDiagonal)
+    highDiagonal = min(len(hitSeq), highDiagonal)
+    if lowDiagonal > highDiagonal:
+        raise ValueError('Empty band.', lowDiagonal, highDiagonal, len(seq), len(hitSeq))
+    codes, hitCodes = search.encode(seq), search.encode(hitSeq)
+    if numpy is not None:
+        matrices = _bandedMatricesNumpy(codes, hitCodes, lowDiagonal, highDiagonal)
+    else:
+        matrices = _bandedMatricesPython(codes, hitCodes, lowDiagonal, highDiagonal)
+    return _traceback(seq, hitSeq, lowDiagonal, *matrices)
+
+
+def _bandedMatricesPython(codes, hitCodes, low, high):
+    '''
+    codes, hitCodes: encoded sequences.
+    Fills the band of the dynamic programming matrices a cell at a time.  Row i of each matrix holds the cells of
+    diagonals low to high, so cell (i, j) is at offset j - i - low.  See _bandedMatricesNumpy() for the recurrences.
+    returns: the traceback pointers of every cell, whether each vertical gap opens at a cell, the offset from which each
+      horizontal gap opens, and the (i, j) of the best end cell.
+    '''
+    n, m = len(codes), len(hitCodes)
+    width = high - low + 1
+    openCost = search.GAP_OPEN + search.GAP_EXTEND
+    extend = search.GAP_EXTEND
+    ptrs, fOpens, eFroms, lastColumn = [], [], [], []
+    prevH = prevF = None
+    for i in xrange(n + 1):
+        h, f = [_NEG] * width, [_NEG] * width
+        ptr, fOpen, eFrom = [_START] * width, [False] * width, [0] * width
+        scores = search.BLOSUM62[codes[i - 1]] if i else None
+        e, eStart, prevHp = _NEG, 0, _NEG
+        for t in xrange(width):
+            j = i + low + t
+            if j < 0 or j > m:
+                e, prevHp = _NEG, _NEG
+                continue
+            if i == 0 or j == 0:
+                hp, p = 0, _START
+            else:
+                diagonal = prevH[t] + scores[hitCodes[j - 1]]
+                if t + 1 < width:
+                    opened, extended = prevH[t + 1] - openCost, prevF[t + 1] - extend
+                    fOpen[t] = opened >= extended
+                    f[t] = opened if fOpen[t] else extended
+                hp, p = (diagonal, _DIAGONAL) if diagonal >= f[t] else (f[t], _VERTICAL)
+            if t:
+                opened, extended = prevHp - openCost, e - extend
+                if opened >= extended:
+                    e, eStart = opened, t - 1
+                else:
+                    e = extended
+            eFrom[t] = eStart
+            if hp >= e:
+                h[t], ptr[t] = hp, p
+            else:
+                h[t], ptr[t] = e, _HORIZONTAL
+            prevHp = hp
+        ptrs.append(ptr)
+        fOpens.append(fOpen)
+        eFroms.append(eFrom)
+        if 0 <= m - i - low < width:
+            lastColumn.append((h[m - i - low], i))
+        prevH, prevF = h, f
+    lastRow = [(h[t], n + low + t) for t in xrange(width) if 0 <= n + low + t <= m]
+    return ptrs, fOpens, eFroms, _bestEnd(n, m, lastRow, lastColumn)
+
+
+def _bandedMatricesNumpy(codes, hitCodes, low, high):
+    '''
+    codes, hitCodes: encoded sequences.
+    Fills the band of the dynamic programming matrices with numpy, a row at a time.  With H the best score of a cell, F
+    of a cell ending in a vertical gap (a residue of the sequence aligned to a gap) and E in a horizontal gap:
+      F[i, j] = max(H[i-1, j] - open - extend, F[i-1, j] - extend)
+      E[i, j] = max over k < j of H[i, k] - open - extend * (j - k)
+      H[i, j] = max(H[i-1, j-1] + BLOSUM62[i, j], F[i, j], E[i, j]), or 0 in the first row and column.
+    E is computed from a running maximum along the row, as in rsd.search, and ties prefer the diagonal, then vertical
+    gaps, then horizontal gaps, then the shortest gap, exactly as _bandedMatricesPython() does.
+    returns: see _bandedMatricesPython().
+    '''
+    n, m = len(codes), len(hitCodes)
+    width = high - low + 1
+    openCost = search.GAP_OPEN + search.GAP_EXTEND
+    extend = search.GAP_EXTEND
+    blosum = numpy.array(search.BLOSUM62, dtype=numpy.int32)
+    hitArray = numpy.array(hitCodes or [0], dtype=numpy.int32)
+    offsets = numpy.arange(width, dtype=numpy.int32)
+    ramp = offsets * extend
+    ptrs, fOpens, eFroms, lastColumn = [], [], [], []
+    prevH = prevF = None
+    negRow = numpy.full(1, _NEG, dtype=numpy.int32)
+    for i in xrange(n + 1):
+        columns = i + low + offsets
+        valid = (columns >= 0) & (columns <= m)
+        if i == 0:
+            hp = numpy.zeros(width, dtype=numpy.int32)
+            ptr = numpy.full(width, _START, dtype=numpy.int8)
+            f = numpy.full(width, _NEG, dtype=numpy.int32)
+            fOpen = numpy.zeros(width, dtype=bool)
+        else:
+            diagonal = prevH + blosum[codes[i - 1]][hitArray[numpy.clip(columns - 1, 0, max(0, m - 1))]]
+            opened = numpy.concatenate((prevH[1:], negRow)) - openCost
+            extended = numpy.concatenate((prevF[1:], negRow)) - extend
+            fOpen = opened >= extended
+            f = numpy.where(fOpen, opened, extended)
+            isDiagonal = diagonal >= f
+            hp = numpy.where(isDiagonal, diagonal, f)
+            ptr = numpy.where(isDiagonal, _DIAGONAL, _VERTICAL).astype(numpy.int8)
+            start = columns == 0
+            hp[start] = 0
+            ptr[start] = _START
+        hp[~valid] = _NEG
+        f[~valid] = _NEG
+        # E at offset t opens from the best H at an offset before t, preferring the latest on ties.
+        v = hp + ramp
+        runningMax = numpy.maximum.accumulate(v)
+        latest = numpy.maximum.accumulate(numpy.where(v == runningMax, offsets, -1))
+        e = numpy.full(width, _NEG, dtype=numpy.int32)
+        e[1:] = runningMax[:-1] - ramp[:-1] - openCost
+        eFrom = numpy.zeros(width, dtype=numpy.int32)
+        eFrom[1:] = latest[:-1]
+        isHp = hp >= e
+        h = numpy.where(isHp, hp, e)
+        ptr = numpy.where(isHp, ptr, _HORIZONTAL).astype(numpy.int8)
+        h[~valid] = _NEG
+        ptrs.append(ptr)
+        fOpens.append(fOpen)
+        eFroms.append(eFrom)
+        if 0 <= m - i - low < width:
+            lastColumn.append((int(h[m - i - low]), i))
+        prevH, prevF = h, f
+    lastRow = [(int(prevH[t]), n + low + t) for t in xrange(width) if 0 <= n + low + t <= m]
+    return ptrs, fOpens, eFroms, _bestEnd(n, m, lastRow, lastColumn)
+
+
+def _bestEnd(n, m, lastRow, lastColumn):
+    '''
+    lastRow: (score, j) of the cells of the last row, by increasing j.
+    lastColumn: (score, i) of the cells of the last column, by increasing i.
+    returns: the (i, j) of the first best scoring cell, where an alignment with free end gaps ends.
+    '''
+    ends = [(score, (n, j)) for score, j in lastRow] + [(score, (i, m)) for score, i in lastColumn]
+    best = max(score for score, cell in ends)
+    return [cell for score, cell in ends if score == best][0]
+
+
+def _traceback(seq, hitSeq, low, ptrs, fOpens, eFroms, end):
+    '''
+    returns: the aligned seq and hitSeq of the alignment ending at end, with the overhanging ends aligned to gaps.
+    '''
+    n, m = len(seq), len(hitSeq)
+    i, j = end
+    # built backwards.
+    aligned = [(aa, '-') for aa in reversed(seq[i:])] + [('-', aa) for aa in reversed(hitSeq[j:])]
+    vertical = False
+    while i > 0 and j > 0:
+        t = j - i - low
+        if vertical:
+            aligned.append((seq[i - 1], '-'))
+            vertical = not fOpens[i][t]
+            i -= 1
+            continue
+        ptr = ptrs[i][t]
+        if ptr == _DIAGONAL:
+            aligned.append((seq[i - 1], hitSeq[j - 1]))
+            i, j = i - 1, j - 1
+        elif ptr == _VERTICAL:
+            vertical = True
+        else:
+            k = i + low + int(eFroms[i][t])
+            aligned.extend(('-', aa) for aa in reversed(hitSeq[k:j]))
+            j = k
+    aligned.extend([(aa, '-') for aa in reversed(seq[:i])] + [('-', aa) for aa in reversed(hitSeq[:j])])
+    aligned.reverse()
+    return ''.join(aa for aa, hitAa in aligned), ''.join(hitAa for aa, hitAa in aligned)
+
+
+def alignedResiduePairs(alignedSeq, alignedHitSeq):
+    '''
+    returns: the set of (sequence position, hit position) of the residues aligned to each other.
+    '''
+    pairs = set()
+    i = j = 0
+    for aa, hitAa in zip(alignedSeq, alignedHitSeq):
+        if aa != '-' and hitAa != '-':
+            pairs.add((i, j))
+        i += aa != '-'
+        j += hitAa != '-'
+    return pairs
+
+
+def compareAligners(queryFastaPath, subjectIndexPath, evalue, maxPairs=None, divergences=COMPARE_DIVERGENCES, workingDir='.'):
+    '''
+    subjectIndexPath: the subject genome, formatted for searching, e.g. by rsd.formatFastaArg().
+    Searches every query sequence against the subject genome, and aligns every query and good evalue hit with an HSP
+    twice, with kalign (or clustalw) and with alignBanded().  Hits have HSPs when they are found by the blast backend.
+    maxPairs: the number of pairs to align.  Default: every pair.
+    returns: a dict of the number of 'pairs' aligned, of 'skipped' hits without an HSP, and, over the pairs, the fraction
+      whose banded alignment is 'identical' to kalign's, the mean 'residueAgreement' (the fraction of the residue pairs
+      aligned by kalign that the banded alignment also aligns), the 'divergenceAgreement' (the fraction of pairs whose
+      alignments are too diverged for the same divergences), and the 'fullSeconds' and 'bandedSeconds' spent aligning.
+    '''
+    import nested
+    import rsd
+    hitsMap = rsd.getBlastHits(queryFastaPath, subjectIndexPath, evalue, workingDir=workingDir)
+    querySeqs = dict((fasta.idFromName(nameline), seq) for nameline, seq in fasta.readFasta(queryFastaPath))
+    subjectSeqs = dict((fasta.idFromName(nameline), seq) for nameline, seq in fasta.readFasta(subjectIndexPath))
+    results = dict.fromkeys(['pairs', 'skipped', 'identical', 'residueAgreement', 'divergenceAgreement', 'fullSeconds', 'bandedSeconds'], 0)
+    with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
+        for seqId in sorted(hitsMap):
+            for hit in rsd.filterGoodHits(hitsMap[seqId], float(evalue)):
+                if maxPairs is not None and results['pairs'] >= maxPairs:
+                    break
+                hsp = rsd.getHitHsp(hit)
+                if hsp is None:
+                    results['skipped'] += 1
+                    continue
+                seq, hitSeq = querySeqs[seqId], subjectSeqs[rsd.getHitId(hit)]
+                start = time.time()
+                full = rsd.alignSeqPair('seq', seq, 'hit', hitSeq, tmpDir)
+                results['fullSeconds'] += time.time() - start
+                start = time.time()
+                banded = zip(('seq', 'hit'), alignBanded(seq, hitSeq, *bandForHsp(hsp, len(seq), len(hitSeq))))
+                results['bandedSeconds'] += time.time() - start
+                fullPairs = alignedResiduePairs(full[0][1], full[1][1])
+                results['pairs'] += 1
+                results['identical'] += (full[0][1], full[1][1]) == (banded[0][1], banded[1][1])
+                results['residueAgreement'] += len(fullPairs & alignedResiduePairs(banded[0][1], banded[1][1])) / float(len(fullPairs) or 1)
+                fullDivergences = rsd.alignedSeqPairDivergences(*full)[2:]
+                bandedDivergences = rsd.alignedSeqPairDivergences(*banded)[2:]
+                results['divergenceAgreement'] += all(rsd.isTooDiverged(*(fullDivergences + (div,))) == rsd.isTooDiverged(*(bandedDivergences + (div,)))
+                                                      for div in divergences)
+    for key in ('identical', 'residueAgreement', 'divergenceAgreement'):
+        results[key] = results[key] / float(results['pairs']) if results['pairs'] else None
+    return results
+
+
+# last line
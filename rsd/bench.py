@@ -0,0 +1,383 @@
+'''
+Synthetic proteome generation and end-to-end scaling benchmarks for RSD.
+
+Synthetic proteomes are built from families of related proteins.  Each family
+has an ancestral sequence, which is duplicated into one or more ancestral
+paralogs, which are then mutated independently in the query and subject
+genomes.  The query and subject copies of the same ancestral paralog are the
+true orthologs.  Some families are orphans, present in only one genome.  The
+sizes of the genomes, the number of paralogs per family, and the amount of
+divergence between orthologs and between paralogs are all controlled by
+parameters, and the generation is deterministic for a given random seed.
+
+A benchmark run generates a pair of synthetic proteomes, formats them for
+BLAST, computes forward and reverse hits, and computes orthologs, optionally
+splitting the query sequences across several worker processes.  For each run,
+the wall time of each stage, the time spent in each instrumented step of the
+pipeline (see rsd.STAGE_TIMER), and the peak resident set size are recorded.
+Every run happens in its own process so peak RSS measurements are independent.
+Results are saved as JSON so runs can be compared across releases.
+'''
+
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import Queue
+import random
+import time
+
+import fasta
+import nested
+import rsd
+import shard
+import util
+
+
+# how often benchmarkRunInProcess() checks that its run is still alive.
+RUN_POLL_SECONDS = 1.0
+
+AMINO_ACIDS = 'ARNDCQEGHILKMFPSTWYV'
+# background amino acid frequencies from Robinson and Robinson (1991), in the same order as AMINO_ACIDS.
+AMINO_ACID_FREQS = [0.07805, 0.05129, 0.04487, 0.05364, 0.01925, 0.04264, 0.06295, 0.07377, 0.02199, 0.05142,
+                    0.09019, 0.05744, 0.02243, 0.03856, 0.05203, 0.07120, 0.05841, 0.01330, 0.03216, 0.06441]
+MIN_SEQ_LENGTH = 30
+
+DEFAULT_SIZES = (500, 2000)
+DEFAULT_WORKERS = (1,)
+DEFAULT_DIV_EVALUES = ((0.8, 1e-5),)
+
+
+#########################
+# SYNTHETIC PROTEOMES
+#########################
+
+class ProteomeGenerator(object):
+    '''
+    Generates random protein sequences and mutates them.  Deterministic for a given seed.
+    '''
+    def __init__(self, seed=0, meanLength=350, lengthSigma=0.5):
+        '''
+        meanLength: the mean length of generated ancestral sequences.  Lengths are log-normally distributed.
+        lengthSigma: the standard deviation of the log of the lengths.
+        '''
+        self.rand = random.Random(seed)
+        self.meanLength = meanLength
+        self.lengthSigma = lengthSigma
+        # cumulative distribution used to draw amino acids from the background frequencies.
+        total = float(sum(AMINO_ACID_FREQS))
+        self.cumFreqs = []
+        cum = 0.0
+        for freq in AMINO_ACID_FREQS:
+            cum += freq / total
+            self.cumFreqs.append(cum)
+
+    def randomResidue(self):
+        r = self.rand.random()
+        for aa, cum in zip(AMINO_ACIDS, self.cumFreqs):
+            if r < cum:
+                return aa
+        return AMINO_ACIDS[-1]
+
+    def randomLength(self):
+        mu = math.log(self.meanLength) - (self.lengthSigma ** 2) / 2.0
+        return max(MIN_SEQ_LENGTH, int(self.rand.lognormvariate(mu, self.lengthSigma)))
+
+    def randomSeq(self, length=None):
+        if length is None:
+            length = self.randomLength()
+        return ''.join(self.randomResidue() for i in xrange(length))
+
+    def mutate(self, seq, divergence, indelRate=0.0):
+        '''
+        seq: a protein sequence.
+        divergence: the probability that any given residue is substituted with a random residue.
+        indelRate: the probability that any given residue is deleted or followed by a short insertion.
+        returns: a mutated copy of seq.  Never returns an empty sequence.
+        '''
+        residues = []
+        for aa in seq:
+            r = self.rand.random()
+            if r < indelRate / 2.0:
+                continue # deletion
+            if self.rand.random() < divergence:
+                aa = self.randomResidue()
+            residues.append(aa)
+            if r > 1.0 - indelRate / 2.0: # insertion of 1 to 3 residues
+                residues.extend(self.randomResidue() for i in xrange(self.rand.randint(1, 3)))
+        if not residues:
+            residues.append(self.randomResidue())
+        return ''.join(residues)
+
+
+def makeSyntheticProteomes(queryPath, subjectPath, numQuerySeqs, numSubjectSeqs, divergence=0.3, paralogRate=0.2,
+                           paralogDivergence=0.4, orphanFraction=0.2, indelRate=0.02, meanLength=350, seed=0,
+                           queryPrefix='Q', subjectPrefix='S'):
+    '''
+    queryPath: where to write the FASTA-formatted query proteome.
+    subjectPath: where to write the FASTA-formatted subject proteome.
+    numQuerySeqs: the number of sequences in the query proteome.
+    numSubjectSeqs: the number of sequences in the subject proteome.
+    divergence: the substitution probability per residue applied to each genome's copy of an ancestral paralog,
+      so orthologs differ by roughly twice this much.
+    paralogRate: the probability that a family gains each additional paralog.  The number of paralogs in a family is geometric.
+    paralogDivergence: the substitution probability per residue between ancestral paralogs and the family ancestor.
+    orphanFraction: the fraction of families present in only one genome.
+    indelRate: the probability per residue of an insertion or deletion, applied wherever divergence is applied.
+    meanLength: the mean length of ancestral sequences.
+    seed: random seed.  The same seed and parameters generate the same proteomes.
+    queryPrefix, subjectPrefix: prefixes of the sequence ids in each genome.  Ids look like Q000001.
+    Namelines look like '>lcl|Q000001 family=F000001 paralog=1'.
+    returns: a list of the true orthologs, as (query id, subject id) pairs.
+    '''
+    gen = ProteomeGenerator(seed=seed, meanLength=meanLength)
+    queryRecords = []
+    subjectRecords = []
+    orthologs = []
+    familyNum = 0
+    while len(queryRecords) < numQuerySeqs or len(subjectRecords) < numSubjectSeqs:
+        familyNum += 1
+        family = 'F{:06d}'.format(familyNum)
+        ancestor = gen.randomSeq()
+        numParalogs = 1
+        while gen.rand.random() < paralogRate:
+            numParalogs += 1
+        paralogs = [ancestor] + [gen.mutate(ancestor, paralogDivergence, indelRate) for i in xrange(numParalogs - 1)]
+        queryRoom = numQuerySeqs - len(queryRecords)
+        subjectRoom = numSubjectSeqs - len(subjectRecords)
+        inQuery = inSubject = True
+        if not queryRoom:
+            inQuery = False
+        elif not subjectRoom:
+            inSubject = False
+        elif gen.rand.random() < orphanFraction:
+            # orphan family.  put it in one genome, choosing in proportion to the room left.
+            if gen.rand.random() < queryRoom / float(queryRoom + subjectRoom):
+                inSubject = False
+            else:
+                inQuery = False
+        for paralogNum, paralog in enumerate(paralogs, 1):
+            qid = sid = None
+            desc = 'family={} paralog={}'.format(family, paralogNum)
+            if inQuery and len(queryRecords) < numQuerySeqs:
+                qid = '{}{:06d}'.format(queryPrefix, len(queryRecords) + 1)
+                queryRecords.append((qid, desc, gen.mutate(paralog, divergence, indelRate)))
+            if inSubject and len(subjectRecords) < numSubjectSeqs:
+                sid = '{}{:06d}'.format(subjectPrefix, len(subjectRecords) + 1)
+                subjectRecords.append((sid, desc, gen.mutate(paralog, divergence, indelRate)))
+            if qid and sid:
+                orthologs.append((qid, sid))
+
+    for path, records in ((queryPath, queryRecords), (subjectPath, subjectRecords)):
+        with open(path, 'w') as fh:
+            for seqId, desc, seq in records:
+                fh.write('>lcl|{} {}\n'.format(seqId, desc))
+                fh.write(fasta.prettySeq(seq))
+    return orthologs
+
+
+###########
+# BENCHMARK
+###########
+
+def numResidues(fastaPath):
+    return sum(len(seq) for nameline, seq in fasta.readFasta(fastaPath))
+
+
+def _computeOrthologsChunk(args):
+    '''
+    Computes orthologs for a chunk of query sequence ids, in its own working dir.  Used by worker processes.  Each chunk
+    runs one alignment and one distance at a time, so the benchmark measures how runs scale with processes.
+    returns: a tuple of the mapping from (div, evalue) to orthologs, a snapshot of the stage timings of the worker, and
+      the latency summary of its queries (see rsd.latencySummary()).
+    '''
+    queryFastaPath, subjectFastaPath, divEvalues, forwardHitsPath, reverseHitsPath, querySeqIds, workingDir = args
+    rsd.STAGE_TIMER.reset()
+    rsd.resetRunSummaries()
+    savedWorkers = dict(rsd.STAGE_WORKERS)
+    rsd.setStageWorkers(align=1, distance=1)
+    try:
+        # codeml writes files with fixed names to its working dir, so every chunk needs its own dir.
+        with nested.NestedTempDir(dir=workingDir, nesting=0) as chunkDir:
+            divEvalueToOrthologs = rsd.computeOrthologsUsingSavedHits(queryFastaPath, subjectFastaPath, divEvalues, forwardHitsPath,
+                                                                      reverseHitsPath, querySeqIds, chunkDir)
+    finally:
+        rsd.STAGE_WORKERS.update(savedWorkers)
+    return divEvalueToOrthologs, rsd.STAGE_TIMER.snapshot(), dict(rsd.LATENCY_SUMMARY)
+
+
+def computeOrthologsInChunks(queryFastaPath, subjectFastaPath, divEvalues, forwardHitsPath, reverseHitsPath, workers=1, workingDir='.'):
+    '''
+    Splits the query sequence ids into one chunk per worker and computes the orthologs of each chunk in a separate process.
+    Sequences are assigned to chunks costliest first, each to the chunk with the least total cost so far, so the chunks
+    finish at about the same time (see rsd.estimateQueryCosts()).  If workers is 1, orthologs are computed in this process.
+    returns: a pair of a mapping from (div, evalue) to lists of orthologs, and a list of the latency summary of each chunk.
+    '''
+    querySeqIds = list(fasta.readIds(queryFastaPath))
+    if workers == 1:
+        chunkIds = [querySeqIds]
+    else:
+        costs = rsd.estimateQueryCosts(querySeqIds, fasta.readSeqLengths(queryFastaPath), fasta.readSeqLengths(subjectFastaPath),
+                                       rsd.loadBlastHits(forwardHitsPath))
+        assignment = shard.assignShards(costs.items(), workers)
+        chunkIds = [[seqId for seqId in querySeqIds if assignment[seqId] == chunk] for chunk in range(1, workers + 1)]
+    chunks = [(queryFastaPath, subjectFastaPath, divEvalues, forwardHitsPath, reverseHitsPath, ids, workingDir)
+              for ids in chunkIds if ids]
+    if workers == 1:
+        results = [_computeOrthologsChunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_computeOrthologsChunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    rsd.STAGE_TIMER.reset()
+    divEvalueToOrthologs = dict((divEvalue, []) for divEvalue in divEvalues)
+    for chunkDivEvalueToOrthologs, snapshot, latency in results:
+        rsd.STAGE_TIMER.merge(snapshot)
+        for divEvalue, orthologs in chunkDivEvalueToOrthologs.items():
+            divEvalueToOrthologs[divEvalue].extend(orthologs)
+    return divEvalueToOrthologs, [latency for chunkDivEvalueToOrthologs, snapshot, latency in results]
+
+
+def benchmarkRun(size, workers=1, divEvalues=DEFAULT_DIV_EVALUES, workingDir='.', subjectRatio=1.0, genomeParams=None, seed=0):
+    '''
+    size: the number of sequences in the query genome.
+    workers: the number of processes used to compute orthologs.
+    subjectRatio: the number of sequences in the subject genome is size * subjectRatio.
+    genomeParams: a dict of keyword arguments for makeSyntheticProteomes(), e.g. divergence or paralogRate.
+    Generates a pair of synthetic proteomes and runs the full pipeline on them in this process.
+    returns: a dict describing the run: sizes, wall time per stage, timings of each instrumented step, and peak RSS.
+    '''
+    genomeParams = genomeParams or {}
+    maxEvalue = max(float(evalue) for div, evalue in divEvalues)
+    numSubjectSeqs = max(1, int(round(size * subjectRatio)))
+    with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
+        queryFastaPath = os.path.join(tmpDir, 'query.faa')
+        subjectFastaPath = os.path.join(tmpDir, 'subject.faa')
+        trueOrthologs = makeSyntheticProteomes(queryFastaPath, subjectFastaPath, size, numSubjectSeqs, seed=seed, **genomeParams)
+        rsd.STAGE_TIMER.reset()
+        stageWallSeconds = {}
+
+        start = time.time()
+        rsd.formatFastaArg(queryFastaPath)
+        rsd.formatFastaArg(subjectFastaPath)
+        stageWallSeconds['format'] = time.time() - start
+
+        start = time.time()
+        forwardHitsPath = os.path.join(tmpDir, 'query_subject.hits.pickle')
+        reverseHitsPath = os.path.join(tmpDir, 'subject_query.hits.pickle')
+        rsd.computeBlastHits(queryFastaPath, subjectFastaPath, forwardHitsPath, maxEvalue, workingDir=tmpDir)
+        rsd.computeBlastHits(subjectFastaPath, queryFastaPath, reverseHitsPath, maxEvalue, workingDir=tmpDir)
+        stageWallSeconds['hits'] = time.time() - start
+        hitsSnapshot = rsd.STAGE_TIMER.snapshot()
+
+        start = time.time()
+        divEvalueToOrthologs, latencies = computeOrthologsInChunks(queryFastaPath, subjectFastaPath, divEvalues, forwardHitsPath,
+                                                        reverseHitsPath, workers, tmpDir)
+        stageWallSeconds['orthologs'] = time.time() - start
+        rsd.STAGE_TIMER.merge(hitsSnapshot)
+
+        return {
+            'size': size,
+            'workers': workers,
+            'seed': seed,
+            'numQuerySeqs': size,
+            'numSubjectSeqs': numSubjectSeqs,
+            'queryResidues': numResidues(queryFastaPath),
+            'subjectResidues': numResidues(subjectFastaPath),
+            'numTrueOrthologs': len(trueOrthologs),
+            'numOrthologs': dict(('{} {}'.format(div, evalue), len(orthologs)) for (div, evalue), orthologs in divEvalueToOrthologs.items()),
+            'wallSeconds': sum(stageWallSeconds.values()),
+            'stageWallSeconds': stageWallSeconds,
+            'stages': rsd.STAGE_TIMER.snapshot(),
+            'latency': latencies,
+            'peakRssBytes': util.maxRssBytes(),
+        }
+
+
+def _benchmarkRunInProcess(queue, args, keywords):
+    try:
+        queue.put(('ok', benchmarkRun(*args, **keywords)))
+    except Exception as e:
+        queue.put(('error', repr(e)))
+        raise
+
+
+def benchmarkRunInProcess(*args, **keywords):
+    '''
+    Runs benchmarkRun() in a new process, so the peak RSS of the run is not affected by earlier runs.
+    Takes the same arguments as benchmarkRun().
+    returns: the return value of benchmarkRun().
+    '''
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_benchmarkRunInProcess, args=(queue, args, keywords))
+    proc.start()
+    while True:
+        try:
+            status, value = queue.get(timeout=RUN_POLL_SECONDS)
+            break
+        except Queue.Empty:
+            if not proc.is_alive():
+                # the run may have put its result just before exiting.
+                try:
+                    status, value = queue.get(timeout=RUN_POLL_SECONDS)
+                    break
+                except Queue.Empty:
+                    raise Exception('benchmark run died without a result', proc.exitcode)
+    proc.join()
+    if status != 'ok':
+        raise Exception('benchmark run failed', value)
+    return value
+
+
+def runBenchmark(sizes=DEFAULT_SIZES, workers=DEFAULT_WORKERS, divEvalues=DEFAULT_DIV_EVALUES, workingDir='.', subjectRatio=1.0,
+                 genomeParams=None, seed=0, verbose=False):
+    '''
+    sizes: a list of query genome sizes (numbers of sequences) to benchmark.
+    workers: a list of worker counts to benchmark.  Every size is run with every worker count.
+    returns: a dict containing information about the benchmark environment and parameters and a list of runs.
+      See benchmarkRun() for the contents of each run.
+    '''
+    results = {
+        'rsdVersion': rsd.__version__,
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'params': {
+            'sizes': list(sizes),
+            'workers': list(workers),
+            'divEvalues': [list(divEvalue) for divEvalue in divEvalues],
+            'subjectRatio': subjectRatio,
+            'genomeParams': genomeParams or {},
+            'seed': seed,
+        },
+        'runs': [],
+    }
+    for size in sizes:
+        for numWorkers in workers:
+            if verbose:
+                print 'benchmarking size {} with {} workers'.format(size, numWorkers)
+            run = benchmarkRunInProcess(size, numWorkers, divEvalues, workingDir, subjectRatio, genomeParams, seed)
+            if verbose:
+                print 'wall seconds: {wallSeconds:.1f}, peak rss: {rss}'.format(rss=util.humanBytes(run['peakRssBytes']), **run)
+            results['runs'].append(run)
+    return results
+
+
+def saveResults(results, path):
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+
+
+def loadResults(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+# last line
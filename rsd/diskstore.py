@@ -0,0 +1,364 @@
+'''
+Indexed on-disk stores of sequences and blast hits, used in place of in-memory
+dicts when a run would not fit in its memory budget (see rsd.setDiskBacked()
+and rsd_search --max-memory).
+
+Both stores are SQLite databases keyed by integers.  A sequence store holds
+the sequences of a genome by their number in its id table (see idtable).  A
+hits store numbers every id it holds in its own ids table, so each id is stored
+once however many hits it is in, holds the hits of every query, in order, with
+the coordinates and stats of their HSPs if they have them (see rsd.getHitHsp()
+and rsd.getHitStats()), and can be read like the dict returned by
+rsd.loadBlastHits().  Hits files are either pickled dicts or hits stores;
+isSqliteFile() tells them apart, so a hits store written by rsd_blast can be
+given to rsd_search like any hits file.  A hits cache is a hits store that
+grows as sequences are searched, used by rsd.makeGetCachedHits().
+
+Memory footprints are estimated from file sizes before anything is loaded,
+with factors measured for CPython 2.7 on 64-bit linux.
+'''
+
+import os
+import tempfile
+import threading
+
+import fasta
+import util
+
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+# bytes of memory per byte of fasta file, for a dict from seq id to sequence.
+SEQS_BYTES_PER_FILE_BYTE = 1.5
+# bytes of memory per byte of pickled hits file, for the unpickled dict of hits.
+HITS_BYTES_PER_PICKLE_BYTE = 10.0
+# bytes of memory per byte of the query fasta file, for a dict of the hits computed for the query genome.
+HITS_BYTES_PER_QUERY_FILE_BYTE = 2.5
+# the memory used by python, rsd and the ortholog pipeline, without sequences or hits.
+BASE_BYTES = 64 * 2**20
+INSERT_BATCH_SIZE = 10000
+INSERT_HIT = 'INSERT INTO hits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+NO_HSP = (None, None, None, None)
+NO_STATS = (None, None, None, None, None)
+
+HITS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS ids (num INTEGER PRIMARY KEY, seq_id TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS hits (seq_num INTEGER NOT NULL, rank INTEGER NOT NULL, hit_num INTEGER NOT NULL, evalue REAL NOT NULL,
+                                 qstart INTEGER, qend INTEGER, sstart INTEGER, send INTEGER,
+                                 bitscore REAL, length INTEGER, identity REAL, qcov REAL, scov REAL);
+'''
+HITS_INDEX = 'CREATE UNIQUE INDEX IF NOT EXISTS hits_seq_num_rank ON hits (seq_num, rank);'
+SEQS_SCHEMA = '''
+CREATE TABLE seqs (num INTEGER PRIMARY KEY, seq TEXT NOT NULL);
+'''
+# a hits store that also records the evalue every sequence was searched with.  See HitsCache.
+HITS_CACHE_SCHEMA = HITS_SCHEMA + HITS_INDEX + '''
+CREATE TABLE IF NOT EXISTS searched (seq_num INTEGER PRIMARY KEY, evalue REAL NOT NULL);
+'''
+SELECT_HITS = '''
+SELECT ids.seq_id, hits.evalue, hits.qstart, hits.qend, hits.sstart, hits.send,
+hits.bitscore, hits.length, hits.identity, hits.qcov, hits.scov FROM hits JOIN ids ON ids.num = hits.hit_num
+WHERE hits.seq_num = (SELECT num FROM ids WHERE seq_id = ?) {} ORDER BY hits.rank
+'''
+# seconds to wait for another process writing to a hits cache.
+HITS_CACHE_TIMEOUT = 60.0
+
+
+def isSqliteFile(path):
+    '''
+    returns: True if path is a SQLite database, e.g. a hits store.
+    '''
+    with open(path, 'rb') as fh:
+        return fh.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def _connect(path, timeout=5.0):
+    import sqlite3
+    # one connection is shared by the threads of the ortholog pipeline, guarded by a lock.
+    conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    # return str, not unicode, so ids and sequences from a store equal those from a file.
+    conn.text_factory = str
+    return conn
+
+
+def _writeRows(path, schema, index, insert, rowsGen, finish=None):
+    '''
+    creates a database at path, replacing any file there, and inserts rowsGen in batches, creating the index, if any,
+    last.
+    finish: an optional function called with the connection after every row is inserted, e.g. to insert other tables.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    conn = _connect(path)
+    try:
+        conn.executescript(schema)
+        for rows in util.groupsOfN(rowsGen, INSERT_BATCH_SIZE):
+            conn.executemany(insert, rows)
+        if finish:
+            finish(conn)
+        if index:
+            conn.execute(index)
+        conn.commit()
+    finally:
+        conn.close()
+    return path
+
+
+def _hitRow(seqNum, rank, hitNum, hit):
+    '''
+    returns: the row of the hits table for hit, a tuple of (hit id, evalue), optionally followed by an hsp and stats.
+    '''
+    hsp = tuple(hit[2]) if len(hit) > 2 and hit[2] else NO_HSP
+    stats = tuple(hit[3]) if len(hit) > 3 and hit[3] else NO_STATS
+    return (seqNum, rank, hitNum, hit[1]) + hsp + stats
+
+
+def _hitFromRow(hitId, evalue, qstart, qend, sstart, send, *stats):
+    '''
+    returns: a hit, the inverse of _hitRow().
+    '''
+    if qstart is None:
+        return (hitId, evalue)
+    if stats[0] is None:
+        return (hitId, evalue, (qstart, qend, sstart, send))
+    return (hitId, evalue, (qstart, qend, sstart, send), stats)
+
+
+def writeHitsStore(hitsItems, path):
+    '''
+    hitsItems: an iterable of (seq id, hits) pairs, e.g. the items of a dict from rsd.loadBlastHits(), or
+      rsd.hitsListsFromHitsGen().  Each seq id occurs once.
+    returns: path, a hits store of hitsItems.
+    '''
+    nums = {}
+    def num(seqId):
+        try:
+            return nums[seqId]
+        except KeyError:
+            num = nums[seqId] = len(nums)
+            return num
+    def rowsGen():
+        for seqId, hits in hitsItems:
+            seqNum = num(seqId)
+            for rank, hit in enumerate(hits):
+                yield _hitRow(seqNum, rank, num(hit[0]), hit)
+    def insertIds(conn):
+        for rows in util.groupsOfN(((num, seqId) for seqId, num in nums.iteritems()), INSERT_BATCH_SIZE):
+            conn.executemany('INSERT INTO ids VALUES (?, ?)', rows)
+    return _writeRows(path, HITS_SCHEMA, HITS_INDEX, INSERT_HIT, rowsGen(), insertIds)
+
+
+def writeSeqStore(fastaPath, path):
+    '''
+    returns: path, a sequence store of every sequence in fastaPath, keyed by its number in the id table of fastaPath.
+    '''
+    rowsGen = enumerate(seq for nameline, seq in fasta.readFasta(fastaPath))
+    return _writeRows(path, SEQS_SCHEMA, None, 'INSERT INTO seqs VALUES (?, ?)', rowsGen)
+
+
+class HitsStore(object):
+    '''
+    Read-only access to a hits store, like a dict from seq id to a list of hits, (hit id, evalue) pairs followed by the
+    hsp and stats of hits that have them.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = _connect(path)
+        self.lock = threading.Lock()
+
+    def get(self, seqId, default=None):
+        with self.lock:
+            rows = self.conn.execute(SELECT_HITS.format(''), (seqId,)).fetchall()
+        return [_hitFromRow(*row) for row in rows] if rows else default
+
+    def __getitem__(self, seqId):
+        hits = self.get(seqId)
+        if hits is None:
+            raise KeyError(seqId)
+        return hits
+
+    def __contains__(self, seqId):
+        return self.get(seqId) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(DISTINCT seq_num) FROM hits').fetchone()[0]
+
+    def iteritems(self):
+        '''
+        yields: every (seq id, hits) pair, ordered by seq id.  Reads the hits with its own connection, so other threads
+          can use the store meanwhile.
+        '''
+        conn = _connect(self.path)
+        query = '''
+        SELECT seq_ids.seq_id, hit_ids.seq_id, hits.evalue, hits.qstart, hits.qend, hits.sstart, hits.send,
+        hits.bitscore, hits.length, hits.identity, hits.qcov, hits.scov FROM hits
+        JOIN ids AS seq_ids ON seq_ids.num = hits.seq_num JOIN ids AS hit_ids ON hit_ids.num = hits.hit_num
+        ORDER BY seq_ids.seq_id, hits.rank
+        '''
+        try:
+            seqId, hits = None, None
+            for row in conn.execute(query):
+                if row[0] != seqId:
+                    if hits is not None:
+                        yield seqId, hits
+                    seqId, hits = row[0], []
+                hits.append(_hitFromRow(*row[1:]))
+            if hits is not None:
+                yield seqId, hits
+        finally:
+            conn.close()
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        return (seqId for seqId, hits in self.iteritems())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [hits for seqId, hits in self.iteritems()]
+
+    def close(self):
+        self.conn.close()
+
+
+class SeqStore(object):
+    '''
+    Read-only access to a sequence store, like a list of the sequences of a genome.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = _connect(path)
+        self.lock = threading.Lock()
+
+    def __getitem__(self, num):
+        with self.lock:
+            row = self.conn.execute('SELECT seq FROM seqs WHERE num = ?', (num,)).fetchone()
+        if row is None:
+            raise IndexError(num)
+        return row[0]
+
+    def close(self):
+        self.conn.close()
+
+
+class HitsCache(object):
+    '''
+    A persistent hits store that grows as sequences are searched, for read-through hit lookups (see
+    rsd.makeGetCachedHits()).  It records the evalue each sequence was searched with, so a sequence without hits is not
+    searched again, and a sequence searched with a stricter evalue than a lookup needs is.  A hits cache is also a hits
+    store, of the sequences searched so far.  Several processes can share a cache.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = _connect(path, HITS_CACHE_TIMEOUT)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(HITS_CACHE_SCHEMA)
+            self.conn.commit()
+
+    def lookup(self, seqId, evalue):
+        '''
+        evalue: a float.
+        returns: the hits of seqId below evalue, ordered by rank, an empty list if it has none, or None if seqId has not
+          been searched with an evalue of at least evalue.
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT searched.evalue FROM searched JOIN ids ON ids.num = searched.seq_num WHERE ids.seq_id = ?', (seqId,)).fetchone()
+            if row is None or row[0] < evalue:
+                return None
+            rows = self.conn.execute(SELECT_HITS.format('AND hits.evalue < ?'), (seqId, evalue)).fetchall()
+        return [_hitFromRow(*row) for row in rows]
+
+    def add(self, seqIdToHits, evalue):
+        '''
+        seqIdToHits: a dict from every seq id searched to its hits, or None if it has no hits.  Replaces the hits of seq ids already in the cache.
+        evalue: the evalue threshold the seq ids were searched with, a float.
+        '''
+        with self.lock:
+            for seqId, hits in seqIdToHits.iteritems():
+                seqNum = self._num(seqId)
+                self.conn.execute('DELETE FROM hits WHERE seq_num = ?', (seqNum,))
+                self.conn.executemany(INSERT_HIT, [_hitRow(seqNum, rank, self._num(hit[0]), hit) for rank, hit in enumerate(hits or [])])
+                self.conn.execute('INSERT OR REPLACE INTO searched VALUES (?, ?)', (seqNum, evalue))
+            self.conn.commit()
+
+    def _num(self, seqId):
+        '''
+        returns: the number of seqId in the ids table, adding it if needed.
+        '''
+        self.conn.execute('INSERT OR IGNORE INTO ids (seq_id) VALUES (?)', (seqId,))
+        return self.conn.execute('SELECT num FROM ids WHERE seq_id = ?', (seqId,)).fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM searched').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def _storePath(dir, suffix):
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=dir)
+    os.close(fd)
+    return path
+
+
+def seqStoreFromFasta(fastaPath, dir=None):
+    '''
+    dir: where to write the store.  The caller is responsible for removing it, e.g. by using a temporary dir.
+    returns: a SeqStore of the sequences of fastaPath.
+    '''
+    return SeqStore(writeSeqStore(fastaPath, _storePath(dir, '.seqs.sqlite')))
+
+
+def hitsStoreFromFile(path, dir=None):
+    '''
+    path: a hits file, either pickled hits or a hits store.
+    dir: where to write the store when path is pickled.  The pickled hits are loaded into memory only while the store is
+      written, e.g. before any sequences are loaded.
+    returns: a HitsStore of the hits in path.
+    '''
+    if isSqliteFile(path):
+        return HitsStore(path)
+    storePath = writeHitsStore(util.loadObject(path).iteritems(), _storePath(dir, '.hits.sqlite'))
+    return HitsStore(storePath)
+
+
+def estimateSeqsBytes(fastaPath):
+    '''
+    fastaPath: a genome, which can be gzip or bzip2 compressed.  Its size is measured decompressed.
+    '''
+    return util.uncompressedSize(fastaPath) * SEQS_BYTES_PER_FILE_BYTE
+
+
+def estimateHitsBytes(hitsPath=None, queryFastaPath=None):
+    '''
+    hitsPath: a hits file.  Hits stores are not loaded into memory, so they take no memory.
+    queryFastaPath: if hitsPath is not given, the hits are estimated for computing hits for the sequences in this file.
+    Compressed files are measured decompressed.
+    returns: the estimated bytes of memory used by the hits as a dict.
+    '''
+    if hitsPath:
+        return 0 if isSqliteFile(hitsPath) else util.uncompressedSize(hitsPath) * HITS_BYTES_PER_PICKLE_BYTE
+    return util.uncompressedSize(queryFastaPath) * HITS_BYTES_PER_QUERY_FILE_BYTE
+
+
+def chooseDiskBacked(maxBytes, seqsBytes, hitsBytes):
+    '''
+    maxBytes: the memory budget.
+    seqsBytes, hitsBytes: the estimated memory of the sequences and the hits of the run.
+    Hits are moved to disk first, since they are looked up once per sequence, while sequences are looked up for every
+    hit.
+    returns: a pair of booleans, whether sequences and whether hits should be kept on disk to stay under the budget.
+    '''
+    if BASE_BYTES + seqsBytes + hitsBytes <= maxBytes:
+        return False, False
+    if BASE_BYTES + seqsBytes <= maxBytes:
+        return False, True
+    return True, True
+
+
+# last line
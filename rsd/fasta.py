@@ -8,6 +8,8 @@ This module follows the NCBI conventions: http://blast.ncbi.nlm.nih.gov/blastcgi
 import cStringIO
 import math
 
+import util
+
 
 def idFromName(line):
     '''
@@ -77,7 +79,7 @@ def prettySeq(seq, n=60):
 
 def numSeqsInFastaDb(path):
     num = 0
-    with open(path) as fh:
+    with util.openFile(path) as fh:
         for line in fh:
             if line.startswith('>'):
                 num += 1
@@ -93,6 +95,14 @@ def readIds(fastaFile):
         yield idFromName(nameline)
 
 
+def readSeqLengths(fastaFile):
+    '''
+    fastaFile: a file-like object or a path to a fasta file
+    returns: a dict from each id in the fasta file to the length of its sequence.
+    '''
+    return dict((idFromName(nameline), len(seq)) for nameline, seq in readFasta(fastaFile))
+
+
 def readNamelines(fastaFile):
     '''
     fastaFile: a file-like object or a path to a fasta file
@@ -120,12 +130,12 @@ def readFasta(fastaFile):
 
 def readFastaLines(fastaFile):
     '''
-    fastaFile: a file-like object or a path to a fasta file
+    fastaFile: a file-like object or a path to a fasta file.  The file can be gzip or bzip2 compressed.
     yields: a seq of fasta sequence lines for each sequence in the fasta file.
     the first line is the nameline.  the other lines are the sequence data lines.  lines include newlines.
     '''
     if isinstance(fastaFile, basestring):
-        with open(fastaFile) as fh:
+        with util.openFile(fastaFile) as fh:
             for lines in relaxedFastaSeqIter(fh):
                 yield lines
     else:
@@ -321,7 +331,7 @@ def numSeqsInPath(path):
     path: path to fasta formatted db
     returns: number of sequences in fasta db
     '''
-    fh = open(path)
+    fh = util.openFile(path)
     size = numSeqsInFile(fh)
     fh.close()
     return size
@@ -0,0 +1,172 @@
+'''
+Per-genome tables of sequence ids, which number the sequences of a genome 0 to
+n-1 in the order of its fasta file.  The ortholog engine (rsd.computeOrthologs())
+works on these numbers instead of string ids, and looks sequences up in lists
+indexed by number, so a large genome does not cost a dict of strings per
+lookup table.  String ids are restored when orthologs are returned, and are
+used to name sequences for external tools.
+
+A table is written next to a genome when it is formatted (see
+rsd.formatFastaArg()), as GENOME.idtable with one id per line, and read back by
+loadIdTable(), which builds the table from the genome instead if the file is
+missing or older than the genome.  indexGenome() writes the table in the same
+pass over the genome that validates its ids and writes GENOME.offsets, an index
+of the byte offset of every sequence, one id and offset per line.
+'''
+
+import os
+import threading
+import uuid
+
+import fasta
+
+
+ID_TABLE_SUFFIX = '.idtable'
+OFFSETS_SUFFIX = '.offsets'
+# the most invalid namelines and duplicated ids listed when indexGenome() rejects a genome.
+MAX_LISTED_ERRORS = 10
+
+# tables loaded by loadIdTable(), keyed by genome path and modification time.
+_tables = {}
+_tablesLock = threading.Lock()
+
+
+class IdTable(object):
+    '''
+    The sequence ids of a genome, numbered in fasta order.  A duplicated id is numbered by its first occurrence.
+    '''
+    def __init__(self, seqIds):
+        self.ids = list(seqIds)
+        self.nums = {}
+        for num, seqId in enumerate(self.ids):
+            self.nums.setdefault(seqId, num)
+        # memo of the numbers of unparsed names, e.g. 'lcl|P12345' in blast results.
+        self.nameNums = {}
+
+    def num(self, seqId):
+        '''
+        raises: KeyError if seqId is not in the genome.
+        '''
+        return self.nums[seqId]
+
+    def seqId(self, num):
+        return self.ids[num]
+
+    def numForName(self, name):
+        '''
+        name: a nameline or name of a sequence, e.g. an id with a namespace prefix from blast results.  Each distinct name
+          is parsed only once.
+        returns: the number of the id of name.
+        '''
+        try:
+            return self.nameNums[name]
+        except KeyError:
+            num = self.nameNums[name] = self.nums[fasta.idFromName(name)]
+            return num
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, seqId):
+        return seqId in self.nums
+
+
+def idTablePath(fastaPath):
+    return fastaPath + ID_TABLE_SUFFIX
+
+
+def writeIdTable(fastaPath):
+    '''
+    writes the id table of fastaPath next to it.
+    returns: the path of the id table.
+    '''
+    path = idTablePath(fastaPath)
+    with open(path, 'w') as fh:
+        for seqId in fasta.readIds(fastaPath):
+            fh.write(seqId + '\n')
+    return path
+
+
+def offsetsPath(fastaPath):
+    return fastaPath + OFFSETS_SUFFIX
+
+
+def indexGenome(fastaPath):
+    '''
+    Reads fastaPath once, checking that every nameline has an id that fasta.idFromName() can parse and that no id
+    occurs twice, and writes the id table and the offset index of fastaPath next to it.  Both files are written to
+    temp files and renamed into place, so they are written whole or not at all.
+    fastaPath: an uncompressed fasta file.
+    raises: Exception listing the invalid namelines and duplicated ids, if any, in which case nothing is written.
+    returns: the number of sequences in fastaPath.
+    '''
+    seqIds = set()
+    badNamelines = []
+    duplicateIds = []
+    tmpSuffix = '.tmp.' + uuid.uuid4().hex
+    tablePath, indexPath = idTablePath(fastaPath), offsetsPath(fastaPath)
+    try:
+        with open(fastaPath, 'rb') as fh, open(tablePath + tmpSuffix, 'w') as tableFh, open(indexPath + tmpSuffix, 'w') as indexFh:
+            offset = 0
+            for line in fh:
+                if line.startswith('>'):
+                    try:
+                        seqId = fasta.idFromName(line.strip())
+                    except IndexError:
+                        badNamelines.append(line.strip())
+                    else:
+                        if seqId in seqIds:
+                            duplicateIds.append(seqId)
+                        seqIds.add(seqId)
+                        tableFh.write(seqId + '\n')
+                        indexFh.write('{}\t{}\n'.format(seqId, offset))
+                offset += len(line)
+        if badNamelines or duplicateIds:
+            raise Exception('Invalid ids in {}: {} namelines without an id, {} duplicated ids.'.format(
+                fastaPath, len(badNamelines), len(duplicateIds)), badNamelines[:MAX_LISTED_ERRORS], duplicateIds[:MAX_LISTED_ERRORS])
+        os.rename(tablePath + tmpSuffix, tablePath)
+        os.rename(indexPath + tmpSuffix, indexPath)
+    finally:
+        for path in (tablePath + tmpSuffix, indexPath + tmpSuffix):
+            if os.path.exists(path):
+                os.remove(path)
+    return len(seqIds)
+
+
+def isIndexed(fastaPath):
+    '''
+    returns: True if the id table and offset index of fastaPath exist and are not older than fastaPath.
+    '''
+    fastaTime = os.path.getmtime(fastaPath)
+    return all(os.path.exists(path) and os.path.getmtime(path) >= fastaTime for path in (idTablePath(fastaPath), offsetsPath(fastaPath)))
+
+
+def readOffsets(fastaPath):
+    '''
+    returns: a dict from every seq id of fastaPath to the byte offset of its nameline, read from the offset index
+      written by indexGenome().  A sequence can be read by seeking to its offset.
+    '''
+    with open(offsetsPath(fastaPath)) as fh:
+        return dict((seqId, int(offset)) for seqId, offset in (line.split('\t') for line in fh))
+
+
+def loadIdTable(fastaPath):
+    '''
+    returns: the IdTable of fastaPath, read from the file written by writeIdTable(), or built from fastaPath if that file
+      is missing or older than fastaPath.  Tables are cached, so every caller gets the same table until fastaPath changes.
+    '''
+    key = (fastaPath, os.path.getmtime(fastaPath))
+    with _tablesLock:
+        if key not in _tables:
+            for oldKey in [oldKey for oldKey in _tables if oldKey[0] == fastaPath]:
+                del _tables[oldKey]
+            path = idTablePath(fastaPath)
+            if os.path.exists(path) and os.path.getmtime(path) >= key[1]:
+                with open(path) as fh:
+                    _tables[key] = IdTable(line.rstrip('\n') for line in fh)
+            else:
+                _tables[key] = IdTable(fasta.readIds(fastaPath))
+        return _tables[key]
+
+
+# last line
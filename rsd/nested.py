@@ -1,12 +1,17 @@
 '''
 Code for creating nested directory structures to avoid having a single directory with millions of files.
 Code for creating nested temp files and dirs.
+Code for recycling a pool of scratch dirs, preferably in RAM, instead of creating and deleting temp dirs.
 '''
 
 import os
+import errno
 import hashlib # sha
 import uuid
 import shutil
+import socket
+import Queue
+import threading
 
 # SET THE DEFAULT TMP DIR ROOT.
 if os.environ.has_key('NESTED_TMP_DIR'):
@@ -22,6 +27,11 @@ else:
 DEFAULT_NESTED_LEVELS = int(os.environ.get('NESTED_LEVELS', 0)) # should be >= 0
 DEFAULT_TMP_PREFIX = 'tmp'
 DEFAULT_DIRS_MODE = 0777
+# RAM-backed (tmpfs) dirs to try for scratch space, in order.  NESTED_SCRATCH_DIR is tried first if set.
+SCRATCH_RAM_DIRS = ([os.environ['NESTED_SCRATCH_DIR']] if os.environ.has_key('NESTED_SCRATCH_DIR') else []) + ['/dev/shm']
+DEFAULT_SCRATCH_POOL_SIZE = int(os.environ.get('NESTED_SCRATCH_POOL_SIZE', 16))
+# a RAM dir is only used if it and the available memory both have at least this many bytes free.
+DEFAULT_SCRATCH_MIN_FREE = 512 * 2**20
 
 
 ########################################################
@@ -161,5 +171,191 @@ def _getNestedComponents(seed, nesting=DEFAULT_NESTED_LEVELS):
     return components
 
 
+##########################
+# POOLED SCRATCH DIRECTORIES
+##########################
+
+def memAvailableBytes():
+    '''
+    returns: the memory available for starting new applications without swapping, from /proc/meminfo, or None if it is unknown.
+    '''
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def freeBytes(dir):
+    '''
+    returns: the bytes available to unprivileged users in the filesystem containing dir.
+    '''
+    stat = os.statvfs(dir)
+    return stat.f_bavail * stat.f_frsize
+
+
+def chooseScratchRoot(minFree=DEFAULT_SCRATCH_MIN_FREE, fallback=None):
+    '''
+    minFree: the bytes that must be free in a RAM dir and in available memory for the RAM dir to be used.
+    fallback: the dir to use when no RAM dir is usable.  Defaults to DEFAULT_TMP_DIR (e.g. NESTED_TMP_DIR).
+    Files written to tmpfs use memory, so a RAM dir is not used when memory is tight.
+    returns: the first dir in SCRATCH_RAM_DIRS that is writable and has room, or fallback.
+    '''
+    memAvailable = memAvailableBytes()
+    for dir in SCRATCH_RAM_DIRS:
+        try:
+            if os.path.isdir(dir) and os.access(dir, os.W_OK | os.X_OK) and freeBytes(dir) >= minFree and (memAvailable is None or memAvailable >= minFree):
+                return dir
+        except OSError:
+            pass
+    return fallback if fallback is not None else DEFAULT_TMP_DIR
+
+
+def emptyDir(path):
+    '''
+    removes everything in the dir path, but not path itself.
+    '''
+    for name in os.listdir(path):
+        childPath = os.path.join(path, name)
+        if os.path.isdir(childPath) and not os.path.islink(childPath):
+            shutil.rmtree(childPath)
+        else:
+            os.remove(childPath)
+
+
+def reapScratchPools(dir, prefix):
+    '''
+    Deletes the pools under dir left behind by processes on this host that exited without closing them, e.g. worker
+    processes killed by multiprocessing.  Pool dirs are named prefix-hostname-pid-...
+    '''
+    hostPrefix = '{}-{}-'.format(prefix, socket.gethostname())
+    for name in os.listdir(dir):
+        if not name.startswith(hostPrefix):
+            continue
+        try:
+            pid = int(name[len(hostPrefix):].split('-')[0])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                shutil.rmtree(os.path.join(dir, name), ignore_errors=True)
+
+
+class ScratchPool(object):
+    '''
+    A bounded pool of scratch dirs that are recycled instead of created and deleted for every use, which avoids
+    metadata churn on slow (e.g. network) filesystems.  The pool lives in RAM (e.g. /dev/shm) when there is room,
+    and under DEFAULT_TMP_DIR otherwise.  Dirs are created lazily, on first use.  Thread-safe.
+    Example:
+        pool = ScratchPool()
+        with pool.scratch() as dir:
+            ... work in dir ...
+    '''
+    def __init__(self, size=DEFAULT_SCRATCH_POOL_SIZE, dir=None, minFree=DEFAULT_SCRATCH_MIN_FREE, prefix='nested_scratch'):
+        '''
+        size: the number of dirs in the pool.
+        dir: where to put the pool.  Defaults to chooseScratchRoot(minFree).
+        '''
+        self.size = size
+        self.root = dir if dir is not None else chooseScratchRoot(minFree)
+        self.prefix = prefix
+        self.path = None
+        self.free = Queue.Queue()
+        self.numCreated = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, block=True):
+        '''
+        block: if True and every dir is in use, wait for one to be released.
+        returns: the path of an empty scratch dir, or None if block is False and every dir is in use.
+        '''
+        with self.lock:
+            if self.free.empty() and self.numCreated < self.size:
+                if self.path is None:
+                    reapScratchPools(self.root, self.prefix)
+                    self.path = makeTempDir(dir=self.root, nesting=0, prefix='{}-{}-{}-'.format(self.prefix, socket.gethostname(), os.getpid()))
+                slotPath = os.path.join(self.path, str(self.numCreated))
+                os.mkdir(slotPath)
+                self.numCreated += 1
+                return slotPath
+        try:
+            return self.free.get(block)
+        except Queue.Empty:
+            return None
+
+    def grow(self, size):
+        '''
+        size: the number of dirs the pool should have, e.g. enough for every thread that can hold a dir at once.
+        Raises the number of dirs in the pool to size, if it has fewer.
+        '''
+        with self.lock:
+            self.size = max(self.size, size)
+
+    def release(self, path, clean=True):
+        '''
+        path: a dir returned by acquire().
+        clean: if True, empty the dir before returning it to the pool.  Only pass False if the dir is already empty or
+          the next user expects its contents.
+        '''
+        if clean:
+            emptyDir(path)
+        self.free.put(path)
+
+    def scratch(self):
+        '''
+        returns: a context manager that acquires a dir, 'returns' its path, and cleans and releases it on exit.
+        '''
+        return _PooledScratchDir(self)
+
+    def close(self):
+        '''
+        deletes every dir of the pool.  The pool must not be used after it is closed.
+        '''
+        if self.path and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _PooledScratchDir(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.path = None
+
+    def __enter__(self):
+        self.path = self.pool.acquire()
+        return self.path
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.release(self.path)
+
+
+_DEFAULT_SCRATCH_POOLS = {}
+
+
+def getDefaultScratchPool():
+    '''
+    returns: a ScratchPool shared by the current process, deleted when the process exits.  A forked child process gets
+    its own pool, so processes never share scratch dirs.
+    '''
+    import atexit
+    pid = os.getpid()
+    if pid not in _DEFAULT_SCRATCH_POOLS:
+        pool = ScratchPool()
+        _DEFAULT_SCRATCH_POOLS[pid] = pool
+        atexit.register(pool.close)
+    return _DEFAULT_SCRATCH_POOLS[pid]
 
 
+# last line
@@ -32,9 +32,37 @@ OR      C5BKE0  D9RR03  2.1041
 //
 PA      502025  521010  0.2     1e-20
 //
+
+Files of orthologs can be gzip or bzip2 compressed.  Compressed files are
+detected when reading and written when the file name ends in .gz or .bz2.
+
+Large files containing many sets of orthologs can be indexed with
+buildOrthDatasIndex(), which writes a sidecar file mapping the params of each
+set of orthologs to its byte offset.  orthDatasFromIndexedFileGen() uses the
+index to seek directly to the sets of orthologs for some params instead of
+scanning the whole file.
+
+Files of orthDatas from many runs can be merged in bounded memory with
+mergeOrthDatasFiles(), which sorts the orthDatas by params and resolves
+duplicate params deterministically.
+
+buildSeqOrthologsIndex() builds an inverted index from every sequence id in a
+corpus of files to its orthologs, and SeqOrthologsIndex looks them up.
+
+For serving queries across many genomes, orthDatasToDb() bulk loads orthDatas
+into a SQLite database indexed by params and by sequence id.
+orthDatasFromDbGen() and orthologsForSeqFromDbGen() query it.
 '''
 
 import io
+import itertools
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import util
 
 
 def orthologsFromStreamGen(handle, version=-1):
@@ -88,7 +116,7 @@ def orthDatasFromFileGen(path):
     path: contains zero or more orthDatas.  must exist.
     yields: every orthData, a pair of params and orthologs, in path.
     '''
-    with open(path) as fh:
+    with util.openFile(path) as fh:
         for orthData in orthDatasFromStreamGen(fh):
             yield orthData
 
@@ -96,10 +124,11 @@ def orthDatasFromFileGen(path):
 def orthDatasFromFilesGen(paths):
     '''
     paths: a list of file paths containing orthDatas.
+    Streams each file, so only one orthData is in memory at a time.
     yields: every orthData in every file in paths
     '''
     for path in paths:
-        for orthData in orthDatasFromFile(path):
+        for orthData in orthDatasFromFileGen(path):
             yield orthData
 
 
@@ -108,6 +137,7 @@ def orthDatasToFile(orthDatas, path, mode='w'):
     orthDatas: a list of rsd orthDatas. orthData is a pair of params and orthologs
     path: where to save the orthDatas
     mode: change to 'a' to append to an existing file
+    If path ends in .gz or .bz2, the file is compressed.
     serializes orthDatas and persists them to path
     Inspired by the Uniprot dat files, a set of orthologs starts with a params row, then has 0 or more ortholog rows, then has an end row.
     Easy to parse.  Can represent a set of parameters with no orthologs.
@@ -119,7 +149,7 @@ def orthDatasToFile(orthDatas, path, mode='w'):
     PA      MYCGE   MYCHP   0.2     1e-15
     //
     '''
-    with open(path, mode) as fh:
+    with util.openFile(path, mode) as fh:
         orthDatasToStream(orthDatas, fh)
 
 
@@ -162,6 +192,703 @@ def orthDatasFromStreamGen(handle):
             orthologs.append((qid, sid, dist))
         elif line.startswith('//'):
             yield ((qdb, sdb, div, evalue), orthologs)
-    
-    
-                    
+
+
+###########################
+# MERGING AND SORTING FILES
+###########################
+
+# Files of orthDatas are merged by streaming them in params order, like the
+# merge step of a merge sort, so memory use depends on the number of files, not
+# their size.  Unsorted files are first sorted externally: sorted runs of
+# bounded size are written to temporary files and merged.  Params are ordered
+# by orthDatasParamsKey(), so '0.8' and '.8' are the same divergence.
+MERGE_KEEP_FIRST = 'first'
+MERGE_KEEP_LAST = 'last'
+MERGE_FAN_IN = 64
+SORT_RUN_SIZE = 1000000
+
+
+def orthDatasParamsKey(params):
+    '''
+    params: a tuple of qdb, sdb, div, and evalue.
+    returns: the key by which params are sorted and compared when merging: qdb, sdb, and div and evalue as floats.
+    '''
+    qdb, sdb, div, evalue = params
+    return (qdb, sdb, float(div), float(evalue))
+
+
+def isOrthDatasFileSorted(path):
+    '''
+    path: a file of orthDatas.
+    Reads the file once, without holding more than one orthData in memory.
+    returns: True iff the orthDatas in path are in orthDatasParamsKey() order.  Equal params are allowed.
+    '''
+    prevKey = None
+    for params, orthologs in orthDatasFromFileGen(path):
+        key = orthDatasParamsKey(params)
+        if prevKey is not None and key < prevKey:
+            return False
+        prevKey = key
+    return True
+
+
+def mergeOrthDatasGen(orthDatasIters, keep=None):
+    '''
+    orthDatasIters: a list of iterables of orthDatas, each sorted by orthDatasParamsKey().
+    keep: how to resolve orthDatas with equal params.  MERGE_KEEP_FIRST keeps the first one, in the order of orthDatasIters
+      and then the order within each iterable.  MERGE_KEEP_LAST keeps the last one.  None keeps all of them, in that order.
+    Holds one orthData per iterable in memory.
+    yields: the orthDatas of all the iterables, in orthDatasParamsKey() order.
+    '''
+    import heapq
+
+    def decorated(i, orthDatas):
+        for j, orthData in enumerate(orthDatas):
+            yield orthDatasParamsKey(orthData[0]), i, j, orthData
+
+    merged = heapq.merge(*[decorated(i, orthDatas) for i, orthDatas in enumerate(orthDatasIters)])
+    if keep is None:
+        for key, i, j, orthData in merged:
+            yield orthData
+    elif keep in (MERGE_KEEP_FIRST, MERGE_KEEP_LAST):
+        prevKey = None
+        kept = None
+        for key, i, j, orthData in merged:
+            if key != prevKey:
+                if kept is not None:
+                    yield kept
+                kept = orthData
+                prevKey = key
+            elif keep == MERGE_KEEP_LAST:
+                kept = orthData
+        if kept is not None:
+            yield kept
+    else:
+        raise ValueError('Unrecognized keep value.  Use MERGE_KEEP_FIRST, MERGE_KEEP_LAST, or None.', keep)
+
+
+def _mergeSortedFiles(paths, outPath, keep, tmpDir, fanIn):
+    '''
+    Merges sorted files into outPath, opening at most fanIn files at once.  If there are more than fanIn paths, consecutive
+    groups of paths are merged into temporary files first, which preserves the order used to resolve equal params.
+    '''
+    while len(paths) > fanIn:
+        groupPaths = []
+        for start in range(0, len(paths), fanIn):
+            fd, groupPath = tempfile.mkstemp(suffix='.merge', dir=tmpDir)
+            os.close(fd)
+            group = paths[start:start+fanIn]
+            orthDatasToFile(mergeOrthDatasGen([orthDatasFromFileGen(path) for path in group], keep), groupPath)
+            groupPaths.append(groupPath)
+        paths = groupPaths
+    orthDatasToFile(mergeOrthDatasGen([orthDatasFromFileGen(path) for path in paths], keep), outPath)
+
+
+def sortOrthDatasFile(path, outPath, tmpDir=None, runSize=SORT_RUN_SIZE, fanIn=MERGE_FAN_IN):
+    '''
+    path: a file of orthDatas.
+    outPath: where to write the sorted orthDatas.  Can be path.
+    tmpDir: where to write sorted runs.  Defaults to the directory of outPath.
+    runSize: the approximate number of orthologs held in memory at once.
+    Sorts by orthDatasParamsKey() using an external merge sort.  The sort is stable and keeps orthDatas with equal params.
+    returns: outPath
+    '''
+    runDir = tempfile.mkdtemp(dir=tmpDir or os.path.dirname(os.path.abspath(outPath)))
+    try:
+        runPaths = []
+        run = []
+        runRows = 0
+        for orthData in itertools.chain(orthDatasFromFileGen(path), [None]):
+            if orthData is not None:
+                run.append(orthData)
+                runRows += len(orthData[1]) + 1
+            if run and (orthData is None or runRows >= runSize):
+                run.sort(key=lambda orthData: orthDatasParamsKey(orthData[0]))
+                runPath = os.path.join(runDir, 'run{}'.format(len(runPaths)))
+                orthDatasToFile(run, runPath)
+                runPaths.append(runPath)
+                run = []
+                runRows = 0
+        tmpPath = os.path.join(runDir, 'sorted')
+        _mergeSortedFiles(runPaths, tmpPath, None, runDir, fanIn)
+        shutil.move(tmpPath, outPath)
+        return outPath
+    finally:
+        shutil.rmtree(runDir)
+
+
+def mergeOrthDatasFiles(paths, outPath, keep=MERGE_KEEP_FIRST, tmpDir=None, runSize=SORT_RUN_SIZE, fanIn=MERGE_FAN_IN):
+    '''
+    paths: files of orthDatas, sorted or not.
+    outPath: where to write the merged orthDatas.  Can be one of paths.  Compressed if it ends in .gz or .bz2.
+    keep: how to resolve orthDatas with equal params.  See mergeOrthDatasGen().  The order of paths decides which orthData
+      is first.
+    tmpDir: where to write temporary files.  Defaults to the directory of outPath.
+    runSize, fanIn: see sortOrthDatasFile().
+    Merges paths in orthDatasParamsKey() order, in bounded memory.  Sorted files are streamed directly; unsorted files are
+    sorted into temporary files first.  outPath is written to a temporary file and renamed.
+    returns: outPath
+    '''
+    workDir = tempfile.mkdtemp(dir=tmpDir or os.path.dirname(os.path.abspath(outPath)))
+    try:
+        sortedPaths = []
+        for i, path in enumerate(paths):
+            if isOrthDatasFileSorted(path):
+                sortedPaths.append(path)
+            else:
+                sortedPaths.append(sortOrthDatasFile(path, os.path.join(workDir, 'sorted{}'.format(i)), workDir, runSize, fanIn))
+        tmpPath = os.path.join(workDir, 'merged' + (os.path.splitext(outPath)[1] if util.compressionOfName(outPath) else ''))
+        _mergeSortedFiles(sortedPaths, tmpPath, keep, workDir, fanIn)
+        shutil.move(tmpPath, outPath)
+        return outPath
+    finally:
+        shutil.rmtree(workDir)
+
+
+#######################
+# ORTHDATAS OFFSET INDEX
+#######################
+
+# The index of a file of orthDatas is a text file.  The first line is a header
+# containing a version and the size of the indexed file when it was indexed.
+# Every other line contains the params of an orthData and the byte offset and
+# length of its serialization, tab-separated, sorted by params.  The params are
+# compared as they are written in the file (as strings).  Lines are sorted, so
+# lookups binary search the index file without reading all of it.
+ORTH_INDEX_SUFFIX = '.idx'
+ORTH_INDEX_HEADER = '#rsd orthdatas index'
+ORTH_INDEX_VERSION = '1'
+
+
+def orthDatasIndexPath(path):
+    '''
+    returns: the default location of the index of the orthDatas file at path.
+    '''
+    return path + ORTH_INDEX_SUFFIX
+
+
+def orthDatasOffsetsFromStreamGen(handle):
+    '''
+    handle: an open io stream of serialized orthDatas, positioned at the start of the stream.
+    Reads the stream once, without parsing orthologs.
+    yields: a tuple of (params, offset, length) for every orthData in handle, where params is a tuple of the strings
+    qdb, sdb, div, and evalue, and offset and length are the position and size in bytes of the serialized orthData.
+    '''
+    offset = 0
+    start = None
+    # iterate with readline(), not the file iterator, whose read-ahead buffering makes byte offsets impossible to track.
+    for line in iter(handle.readline, ''):
+        if line.startswith('PA'):
+            lineType, qdb, sdb, div, evalue = line.strip().split('\t')
+            start = offset
+        elif line.startswith('//'):
+            yield (qdb, sdb, div, evalue), start, offset + len(line) - start
+        offset += len(line)
+
+
+def buildOrthDatasIndex(path, indexPath=None):
+    '''
+    path: a file of orthDatas.
+    indexPath: where to write the index.  Defaults to orthDatasIndexPath(path).
+    Builds the index of path in a single streaming pass over path.  The index is written to a temporary file
+    and renamed, so readers never see a partially written index.
+    returns: indexPath
+    '''
+    indexPath = indexPath or orthDatasIndexPath(path)
+    with util.openFile(path, 'rb') as fh:
+        entries = sorted(orthDatasOffsetsFromStreamGen(fh))
+    tmpPath = indexPath + '.tmp.{}'.format(os.getpid())
+    with open(tmpPath, 'wb') as fh:
+        fh.write('{}\t{}\t{}\n'.format(ORTH_INDEX_HEADER, ORTH_INDEX_VERSION, os.path.getsize(path)))
+        for params, offset, length in entries:
+            fh.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(*(params + (offset, length))))
+    os.rename(tmpPath, indexPath)
+    return indexPath
+
+
+def _indexLineKey(line):
+    return tuple(line.split('\t', 4)[:4])
+
+
+def _bisectIndex(fh, start, end, target):
+    '''
+    fh: an open index file.
+    start: the offset of the first index line.  end: the size of the index file.
+    target: a tuple of params (or a prefix of params).
+    returns: the offset of the first index line whose params (or prefix of params) are >= target.
+    '''
+    lo, hi = start, end
+    n = len(target)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # move to the start of the first line at or after mid.
+        fh.seek(mid - 1)
+        fh.readline()
+        lineStart = fh.tell()
+        if lineStart >= hi:
+            hi = mid
+            continue
+        line = fh.readline()
+        if _indexLineKey(line)[:n] < target:
+            lo = lineStart + len(line)
+        else:
+            hi = mid
+    return lo
+
+
+def orthDatasIndexEntriesGen(path, qdb=None, sdb=None, div=None, evalue=None, indexPath=None):
+    '''
+    path: an indexed file of orthDatas.
+    qdb, sdb, div, evalue: the params to look up.  Params are matched against the strings in the file, e.g. '1e-05', not '1e-5'.
+      Non-string params are formatted like orthDatasToStream() formats them.  A param can only be given if all the params
+      before it are given.  e.g. qdb and sdb can be given without div and evalue, to find every orthData for a pair of genomes.
+    indexPath: the location of the index.  Defaults to orthDatasIndexPath(path).
+    Raises an exception if the index is missing or out of date.
+    yields: (params, offset, length) for each orthData matching the given params, in params order.
+    '''
+    target = []
+    for param in (qdb, sdb, div, evalue):
+        if param is None:
+            break
+        target.append('{}'.format(param))
+    target = tuple(target)
+    indexPath = indexPath or orthDatasIndexPath(path)
+    with open(indexPath, 'rb') as fh:
+        header = fh.readline().rstrip('\n').split('\t')
+        if header[:2] != [ORTH_INDEX_HEADER, ORTH_INDEX_VERSION]:
+            raise Exception('Unrecognized orthDatas index.', indexPath)
+        if int(header[2]) != os.path.getsize(path):
+            raise Exception('orthDatas index is out of date.  Rebuild it with buildOrthDatasIndex().', indexPath, path)
+        fh.seek(_bisectIndex(fh, fh.tell(), os.fstat(fh.fileno()).st_size, target))
+        for line in iter(fh.readline, ''):
+            splits = line.rstrip('\n').split('\t')
+            params = tuple(splits[:4])
+            if params[:len(target)] != target:
+                break
+            yield params, int(splits[4]), int(splits[5])
+
+
+def orthDatasFromIndexedFileGen(path, qdb=None, sdb=None, div=None, evalue=None, indexPath=None):
+    '''
+    path: an indexed file of orthDatas.  See buildOrthDatasIndex().
+    qdb, sdb, div, evalue, indexPath: see orthDatasIndexEntriesGen().
+    Seeks directly to the orthDatas matching the given params instead of scanning the file.
+    Compressed files can be indexed, but seeking in them requires decompressing everything before the offset,
+    so large indexed corpora should be stored uncompressed.
+    yields: every orthData matching the params, in params order.
+    '''
+    with util.openFile(path, 'rb') as fh:
+        for params, offset, length in orthDatasIndexEntriesGen(path, qdb, sdb, div, evalue, indexPath):
+            fh.seek(offset)
+            for orthData in orthDatasFromStreamGen(io.BytesIO(fh.read(length))):
+                yield orthData
+
+
+
+
+##########################
+# SEQUENCE ORTHOLOGS INDEX
+##########################
+
+# An inverted index from sequence ids to the orthologs of each sequence across a
+# corpus of files of orthDatas, for answering "the orthologs of this protein in
+# every genome" without scanning files or running a database server.
+#
+# The index is a single binary file, read through mmap, so opening it is cheap
+# and lookups only touch the pages they need.  All integers are little-endian.
+# It contains, in order:
+#   A header: SEQ_INDEX_HEADER_FORMAT.
+#   The indexed files: for each file, its size when indexed and the length of its
+#     path (SEQ_INDEX_FILE_FORMAT), followed by its path.
+#   The sequence ids, sorted: one fixed-size record per id (SEQ_INDEX_ID_FORMAT),
+#     holding the offset and length of the id in the id strings and the position of
+#     its first posting.  A final record holds the total number of postings, so
+#     the postings of id i are between record i and record i + 1.
+#   The id strings, concatenated.
+#   The postings, grouped by sequence id and ordered by file and offset within each
+#     group: fixed-size records (SEQ_INDEX_POSTING_FORMAT) of the file id, the offset of
+#     the orthData containing the ortholog, the rank of the partner sequence id, the
+#     distance as a 32-bit float, and whether the sequence is the query (1) or subject (0).
+# Lookups binary search the fixed-size id records, comparing ids as byte strings.
+SEQ_INDEX_MAGIC = 'RSDSEQIX'
+SEQ_INDEX_VERSION = 1
+SEQ_INDEX_HEADER_FORMAT = '<8sIIIQQQQ' # magic, version, numFiles, numIds, numPostings, idsOffset, stringsOffset, postingsOffset
+SEQ_INDEX_FILE_FORMAT = '<QI' # file size, path length
+SEQ_INDEX_ID_FORMAT = '<QIQ' # string offset, string length, first posting
+SEQ_INDEX_POSTING_FORMAT = '<IQIfB' # file id, orthData offset, partner id rank, distance, is query
+
+
+def _orthDatasWithOffsetsFromStreamGen(handle):
+    '''
+    handle: an open io stream of serialized orthDatas, positioned at the start of the stream.
+    yields: the byte offset of every orthData in handle and the orthData.
+    '''
+    offset = 0
+    for line in iter(handle.readline, ''):
+        if line.startswith('PA'):
+            lineType, qdb, sdb, div, evalue = line.strip().split('\t')
+            start = offset
+            orthologs = []
+        elif line.startswith('OR'):
+            lineType, qid, sid, dist = line.strip().split('\t')
+            orthologs.append((qid, sid, dist))
+        elif line.startswith('//'):
+            yield start, ((qdb, sdb, div, evalue), orthologs)
+        offset += len(line)
+
+
+def _orthologsWithOffsetsFromFilesGen(paths):
+    '''
+    yields: file id (the position of the file in paths), orthData offset, and ortholog for every ortholog in paths.
+    '''
+    for fileId, path in enumerate(paths):
+        with util.openFile(path, 'rb') as fh:
+            for offset, (params, orthologs) in _orthDatasWithOffsetsFromStreamGen(fh):
+                for ortholog in orthologs:
+                    yield fileId, offset, ortholog
+
+
+def buildSeqOrthologsIndex(paths, indexPath):
+    '''
+    paths: files of orthDatas.  Paths are stored in the index as absolute paths, so the files must not be moved.
+    indexPath: where to write the index.
+    Builds the index in two streaming passes over paths.  The first pass counts the postings of each sequence id.
+    The second pass writes each posting directly into its slot in the memory-mapped index, so the only thing held in
+    memory is the table of sequence ids.  The index is written to a temporary file and renamed.
+    returns: indexPath
+    '''
+    paths = [os.path.abspath(path) for path in paths]
+
+    counts = {}
+    for fileId, offset, (qid, sid, dist) in _orthologsWithOffsetsFromFilesGen(paths):
+        counts[qid] = counts.get(qid, 0) + 1
+        counts[sid] = counts.get(sid, 0) + 1
+    ids = sorted(counts)
+    ranks = dict((seqId, rank) for rank, seqId in enumerate(ids))
+    # next free posting slot of each id, starting at its first posting.
+    slots = []
+    numPostings = 0
+    for seqId in ids:
+        slots.append(numPostings)
+        numPostings += counts[seqId]
+    del counts
+
+    headerSize = struct.calcsize(SEQ_INDEX_HEADER_FORMAT)
+    filesSize = sum(struct.calcsize(SEQ_INDEX_FILE_FORMAT) + len(path) for path in paths)
+    idsOffset = headerSize + filesSize
+    stringsOffset = idsOffset + (len(ids) + 1) * struct.calcsize(SEQ_INDEX_ID_FORMAT)
+    postingsOffset = stringsOffset + sum(len(seqId) for seqId in ids)
+    postingSize = struct.calcsize(SEQ_INDEX_POSTING_FORMAT)
+
+    tmpPath = indexPath + '.tmp.{}'.format(os.getpid())
+    with open(tmpPath, 'w+b') as fh:
+        fh.write(struct.pack(SEQ_INDEX_HEADER_FORMAT, SEQ_INDEX_MAGIC, SEQ_INDEX_VERSION, len(paths), len(ids), numPostings,
+                             idsOffset, stringsOffset, postingsOffset))
+        for path in paths:
+            fh.write(struct.pack(SEQ_INDEX_FILE_FORMAT, os.path.getsize(path), len(path)))
+            fh.write(path)
+        stringOffset = 0
+        for seqId, firstPosting in zip(ids, slots):
+            fh.write(struct.pack(SEQ_INDEX_ID_FORMAT, stringOffset, len(seqId), firstPosting))
+            stringOffset += len(seqId)
+        fh.write(struct.pack(SEQ_INDEX_ID_FORMAT, stringOffset, 0, numPostings))
+        for seqId in ids:
+            fh.write(seqId)
+        del ids
+        size = postingsOffset + numPostings * postingSize
+        fh.truncate(size)
+        if numPostings:
+            mm = mmap.mmap(fh.fileno(), size)
+            try:
+                for fileId, offset, (qid, sid, dist) in _orthologsWithOffsetsFromFilesGen(paths):
+                    qrank, srank = ranks[qid], ranks[sid]
+                    struct.pack_into(SEQ_INDEX_POSTING_FORMAT, mm, postingsOffset + slots[qrank] * postingSize, fileId, offset, srank, float(dist), 1)
+                    slots[qrank] += 1
+                    struct.pack_into(SEQ_INDEX_POSTING_FORMAT, mm, postingsOffset + slots[srank] * postingSize, fileId, offset, qrank, float(dist), 0)
+                    slots[srank] += 1
+                mm.flush()
+            finally:
+                mm.close()
+    os.rename(tmpPath, indexPath)
+    return indexPath
+
+
+class SeqOrthologsIndex(object):
+    '''
+    Looks up the orthologs of sequences in an index built by buildSeqOrthologsIndex().  A lookup binary searches the
+    memory-mapped index for the sequence id and reads its postings, without reading the indexed files, so open the
+    index once and reuse it for many lookups.  Can be used as a context manager.
+    '''
+    def __init__(self, indexPath, checkFiles=True):
+        '''
+        indexPath: an index built by buildSeqOrthologsIndex().
+        checkFiles: if True, raise an exception if any indexed file has changed size since it was indexed.
+        '''
+        self.indexPath = indexPath
+        with open(indexPath, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, numFiles, self.numIds, self.numPostings, self.idsOffset, self.stringsOffset,
+         self.postingsOffset) = struct.unpack_from(SEQ_INDEX_HEADER_FORMAT, self.mm, 0)
+        if magic != SEQ_INDEX_MAGIC or version != SEQ_INDEX_VERSION:
+            self.close()
+            raise Exception('Unrecognized sequence orthologs index.', indexPath)
+        self.paths = []
+        offset = struct.calcsize(SEQ_INDEX_HEADER_FORMAT)
+        for i in range(numFiles):
+            size, pathLength = struct.unpack_from(SEQ_INDEX_FILE_FORMAT, self.mm, offset)
+            offset += struct.calcsize(SEQ_INDEX_FILE_FORMAT)
+            path = self.mm[offset:offset+pathLength]
+            offset += pathLength
+            if checkFiles and (not os.path.exists(path) or os.path.getsize(path) != size):
+                self.close()
+                raise Exception('Sequence orthologs index is out of date.  Rebuild it with buildSeqOrthologsIndex().', indexPath, path)
+            self.paths.append(path)
+        self.idSize = struct.calcsize(SEQ_INDEX_ID_FORMAT)
+        self.postingSize = struct.calcsize(SEQ_INDEX_POSTING_FORMAT)
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _idRecord(self, rank):
+        return struct.unpack_from(SEQ_INDEX_ID_FORMAT, self.mm, self.idsOffset + rank * self.idSize)
+
+    def _id(self, rank):
+        stringOffset, length, firstPosting = self._idRecord(rank)
+        start = self.stringsOffset + stringOffset
+        return self.mm[start:start+length]
+
+    def _rank(self, seqId):
+        '''
+        returns: the rank of seqId among the sorted ids, or None if seqId is not in the index.
+        '''
+        lo, hi = 0, self.numIds
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id(mid) < seqId:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.numIds and self._id(lo) == seqId:
+            return lo
+        return None
+
+    def postings(self, seqId):
+        '''
+        returns: a list of (path, offset, partnerId, distance, isQuery) for every ortholog of seqId, ordered by file
+        and offset, where offset is the position in path of the orthData containing the ortholog, partnerId is the
+        other sequence in the ortholog, and isQuery is True if seqId is the query sequence of the ortholog.
+        Distances are stored as 32-bit floats.  Returns an empty list if seqId has no orthologs.
+        '''
+        rank = self._rank(seqId)
+        if rank is None:
+            return []
+        first = self._idRecord(rank)[2]
+        last = self._idRecord(rank + 1)[2]
+        postings = []
+        for i in xrange(first, last):
+            fileId, offset, partnerRank, distance, isQuery = struct.unpack_from(
+                SEQ_INDEX_POSTING_FORMAT, self.mm, self.postingsOffset + i * self.postingSize)
+            postings.append((self.paths[fileId], offset, self._id(partnerRank), distance, bool(isQuery)))
+        return postings
+
+    def orthologs(self, seqId):
+        '''
+        Like postings(), but reads the params line of each orthData from the indexed files, to report which genomes,
+        divergence and evalue each ortholog was found with.
+        returns: a list of (params, (qid, sid, distance)) for every ortholog of seqId, ordered by file and offset.
+        '''
+        results = []
+        handles = {}
+        try:
+            for path, offset, partnerId, distance, isQuery in self.postings(seqId):
+                if path not in handles:
+                    handles[path] = util.openFile(path, 'rb')
+                fh = handles[path]
+                fh.seek(offset)
+                lineType, qdb, sdb, div, evalue = fh.readline().strip().split('\t')
+                ortholog = (seqId, partnerId, distance) if isQuery else (partnerId, seqId, distance)
+                results.append(((qdb, sdb, div, evalue), ortholog))
+        finally:
+            for fh in handles.values():
+                fh.close()
+        return results
+
+
+#######################
+# ORTHDATAS SQLITE STORE
+#######################
+
+# A SQLite database of orthDatas, for querying many sets of orthologs by
+# params or by sequence id without scanning files.  Genome and sequence ids are
+# interned in the genome and seq tables and referred to by integer ids.  Divs,
+# evalues and distances are stored as the strings orthDatasToStream() would
+# write, so orthDatas round-trip exactly between files and databases.
+ORTH_DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS genome (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS seq (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS params (id INTEGER PRIMARY KEY, qdb INTEGER NOT NULL, sdb INTEGER NOT NULL, div TEXT NOT NULL, evalue TEXT NOT NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS params_qdb_sdb_div_evalue ON params (qdb, sdb, div, evalue);
+CREATE TABLE IF NOT EXISTS ortholog (params_id INTEGER NOT NULL, qid INTEGER NOT NULL, sid INTEGER NOT NULL, dist TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS ortholog_params_id ON ortholog (params_id);
+CREATE INDEX IF NOT EXISTS ortholog_qid ON ortholog (qid);
+CREATE INDEX IF NOT EXISTS ortholog_sid ON ortholog (sid);
+'''
+ORTH_DB_BATCH_SIZE = 10000
+
+_ORTH_DB_SELECT = '''
+SELECT qg.name, sg.name, p.div, p.evalue, qs.name, ss.name, o.dist
+FROM params p
+JOIN genome qg ON qg.id = p.qdb
+JOIN genome sg ON sg.id = p.sdb
+LEFT JOIN ortholog o ON o.params_id = p.id
+LEFT JOIN seq qs ON qs.id = o.qid
+LEFT JOIN seq ss ON ss.id = o.sid
+'''
+_ORTH_DB_ORDER = ' ORDER BY qg.name, sg.name, p.div, p.evalue, o.rowid'
+
+
+def connectOrthDatasDb(path):
+    '''
+    path: a SQLite database file.  Created if it does not exist.
+    returns: an open sqlite3 connection to path, with the orthDatas tables and indexes created.
+    '''
+    import sqlite3
+    conn = sqlite3.connect(path)
+    # return str, not unicode, so orthDatas from a database equal orthDatas from a file.
+    conn.text_factory = str
+    conn.executescript(ORTH_DB_SCHEMA)
+    return conn
+
+
+def _internId(cursor, table, name, cache):
+    '''
+    returns: the integer id of name in table (genome or seq), inserting name if it is not already there.
+    '''
+    if name not in cache:
+        row = cursor.execute('SELECT id FROM {} WHERE name = ?'.format(table), (name,)).fetchone()
+        if row is None:
+            cursor.execute('INSERT INTO {} (name) VALUES (?)'.format(table), (name,))
+            cache[name] = cursor.lastrowid
+        else:
+            cache[name] = row[0]
+    return cache[name]
+
+
+def orthDatasToDb(orthDatas, path, batchSize=ORTH_DB_BATCH_SIZE):
+    '''
+    orthDatas: an iterable of rsd orthDatas.  orthData is a pair of params and orthologs.  Can be a generator, e.g. from
+      orthDatasFromFileGen(), so loading large files does not require holding them in memory.
+    path: a SQLite database file.  Created if it does not exist.
+    batchSize: the number of orthologs loaded per transaction.
+    Bulk loads orthDatas into the database.  If the database already has orthologs for the params of an orthData, they are
+    replaced, so loading the results of an incremental run merges them with the results of earlier runs.
+    returns: the number of orthDatas loaded.
+    '''
+    conn = connectOrthDatasDb(path)
+    try:
+        cursor = conn.cursor()
+        genomeCache = {}
+        seqCache = {}
+        numOrthDatas = 0
+        numRows = 0
+        for (qdb, sdb, div, evalue), orthologs in orthDatas:
+            qdbId = _internId(cursor, 'genome', '{}'.format(qdb), genomeCache)
+            sdbId = _internId(cursor, 'genome', '{}'.format(sdb), genomeCache)
+            params = (qdbId, sdbId, '{}'.format(div), '{}'.format(evalue))
+            row = cursor.execute('SELECT id FROM params WHERE qdb = ? AND sdb = ? AND div = ? AND evalue = ?', params).fetchone()
+            if row is None:
+                cursor.execute('INSERT INTO params (qdb, sdb, div, evalue) VALUES (?, ?, ?, ?)', params)
+                paramsId = cursor.lastrowid
+            else:
+                paramsId = row[0]
+                cursor.execute('DELETE FROM ortholog WHERE params_id = ?', (paramsId,))
+            rows = [(paramsId, _internId(cursor, 'seq', '{}'.format(qid), seqCache),
+                     _internId(cursor, 'seq', '{}'.format(sid), seqCache), '{}'.format(dist))
+                    for qid, sid, dist in orthologs]
+            cursor.executemany('INSERT INTO ortholog (params_id, qid, sid, dist) VALUES (?, ?, ?, ?)', rows)
+            numOrthDatas += 1
+            numRows += len(rows) + 1
+            if numRows >= batchSize:
+                conn.commit()
+                numRows = 0
+        conn.commit()
+        return numOrthDatas
+    finally:
+        conn.close()
+
+
+def _orthDatasFromRowsGen(rows):
+    '''
+    rows: (qdb, sdb, div, evalue, qid, sid, dist) rows, ordered by params.  qid, sid, and dist are None for params without orthologs.
+    yields: an orthData for each params in rows.
+    '''
+    params = None
+    orthologs = []
+    for row in rows:
+        if row[:4] != params:
+            if params is not None:
+                yield params, orthologs
+            params = row[:4]
+            orthologs = []
+        if row[4] is not None:
+            orthologs.append(row[4:])
+    if params is not None:
+        yield params, orthologs
+
+
+def orthDatasFromDbGen(path, qdb=None, sdb=None, div=None, evalue=None):
+    '''
+    path: a SQLite database of orthDatas.  See orthDatasToDb().
+    qdb, sdb, div, evalue: the params to look up, matched like orthDatasIndexEntriesGen() matches them.  A param can only be
+      given if all the params before it are given.  If no params are given, every orthData in the database is yielded.
+    Uses the (qdb, sdb, div, evalue) index, so only the matching orthDatas are read.
+    yields: every orthData matching the params, in params order.
+    '''
+    clauses = []
+    values = []
+    for column, param in zip(('qg.name', 'sg.name', 'p.div', 'p.evalue'), (qdb, sdb, div, evalue)):
+        if param is None:
+            break
+        clauses.append('{} = ?'.format(column))
+        values.append('{}'.format(param))
+    sql = _ORTH_DB_SELECT + (' WHERE ' + ' AND '.join(clauses) if clauses else '') + _ORTH_DB_ORDER
+    conn = connectOrthDatasDb(path)
+    try:
+        for orthData in _orthDatasFromRowsGen(conn.execute(sql, values)):
+            yield orthData
+    finally:
+        conn.close()
+
+
+def orthologsForSeqFromDbGen(path, seqId):
+    '''
+    path: a SQLite database of orthDatas.  See orthDatasToDb().
+    seqId: a query or subject sequence id.
+    Uses the sequence id indexes, so only the orthologs of seqId are read, e.g. to find the orthologs of a protein
+    across every genome in the database.
+    yields: a pair of params and ortholog for every ortholog with seqId as its query or subject id, in params order.
+    '''
+    sql = '''
+    SELECT qg.name, sg.name, p.div, p.evalue, qs.name, ss.name, o.dist
+    FROM ortholog o
+    JOIN params p ON p.id = o.params_id
+    JOIN genome qg ON qg.id = p.qdb
+    JOIN genome sg ON sg.id = p.sdb
+    JOIN seq qs ON qs.id = o.qid
+    JOIN seq ss ON ss.id = o.sid
+    WHERE o.rowid IN (SELECT rowid FROM ortholog WHERE qid = (SELECT id FROM seq WHERE name = ?)
+                      UNION SELECT rowid FROM ortholog WHERE sid = (SELECT id FROM seq WHERE name = ?))
+    ''' + _ORTH_DB_ORDER
+    conn = connectOrthDatasDb(path)
+    try:
+        for row in conn.execute(sql, (seqId, seqId)):
+            yield row[:4], row[4:]
+    finally:
+        conn.close()
@@ -0,0 +1,179 @@
+'''
+A streaming pipeline of stages connected by bounded queues, each stage run by
+its own threads.
+
+Every item passes through the stages in order.  Stages overlap: while one item
+is being aligned, the next can be blasted and the one before can be run through
+codeml.  The queues between stages are bounded, and at most maxInFlight items
+are in the pipeline at once, so a slow stage holds back the stages before it
+instead of letting items pile up in memory.  Results come out in the order the
+items went in, or, if run() is not ordered, as soon as they are done.
+
+The workers of a stage all take items from one queue, so a worker takes the
+next item as soon as it is free, and a long item holds up only its own worker.
+Feeding the longest items first (longest processing time first) and taking
+results as they are done keeps every worker busy until the end, instead of
+leaving one worker on a long item while the others idle.
+
+Stages that run the same tool (e.g. the forward and reverse alignment stages of
+RSD) can share a semaphore, so the tool runs at most that many times at once
+across the stages.
+'''
+
+import sys
+import threading
+import Queue
+
+
+DEFAULT_QUEUE_SIZE = 16
+# how often, in seconds, blocked threads check whether the pipeline has been stopped.
+STOP_CHECK_INTERVAL = 0.1
+
+
+class Stage(object):
+    '''
+    func: a function called with each item.  Its return value is passed to the next stage.
+    workers: the number of threads calling func.
+    semaphore: an optional threading.Semaphore, acquired around each call of func, shared by stages that run the same tool.
+    '''
+    def __init__(self, name, func, workers=1, semaphore=None):
+        self.name, self.func, self.workers, self.semaphore = name, func, max(1, workers), semaphore
+
+
+class _Failure(object):
+    '''
+    an exception raised by a stage, passed down the pipeline in place of the item.
+    '''
+    def __init__(self, excInfo):
+        self.excInfo = excInfo
+
+
+_DONE = object()
+
+
+class Pipeline(object):
+    '''
+    Example:
+        pipeline = Pipeline([Stage('hits', getHits, 2), Stage('align', align, 4)])
+        for result in pipeline.run(queryIds):
+            ...
+    '''
+    def __init__(self, stages, queueSize=DEFAULT_QUEUE_SIZE, maxInFlight=None):
+        '''
+        stages: a list of Stage.
+        queueSize: the maximum number of items waiting between two stages.
+        maxInFlight: the maximum number of items that have entered the pipeline and have not been returned by run().
+          Defaults to enough to keep every queue and worker busy.
+        '''
+        self.stages = stages
+        self.queueSize = queueSize
+        self.maxInFlight = maxInFlight or (queueSize + 1) * len(stages) + sum(stage.workers for stage in stages)
+
+    def run(self, items, ordered=True):
+        '''
+        items: an iterable of items, consumed as the pipeline has room for them.
+        ordered: if False, results are yielded as soon as they are done, so a slow item does not hold back the results
+          after it, or stop new items from entering the pipeline.
+        yields: the result of the last stage for each item, in the order of items, unless not ordered.  If a stage
+          raises an exception for an item, it is raised when that item would have been yielded, and the pipeline is
+          stopped.
+        '''
+        stopped = threading.Event()
+        inFlight = threading.Semaphore(self.maxInFlight)
+        queues = [Queue.Queue(self.queueSize) for stage in self.stages] + [Queue.Queue()]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], inFlight, stopped))]
+        for stage, inQueue, outQueue in zip(self.stages, queues, queues[1:]):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for i in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, args=(stage, inQueue, outQueue, remaining, lock, stopped),
+                                                name='{}-{}'.format(stage.name, i)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            # results that finished out of order, waiting for the results of the items before them.
+            pending = {}
+            nextIndex = 0
+            while True:
+                index, result = queues[-1].get()
+                if index is _DONE:
+                    break
+                if not ordered:
+                    inFlight.release()
+                    if isinstance(result, _Failure):
+                        raise result.excInfo[0], result.excInfo[1], result.excInfo[2]
+                    yield result
+                    continue
+                pending[index] = result
+                while nextIndex in pending:
+                    result = pending.pop(nextIndex)
+                    nextIndex += 1
+                    inFlight.release()
+                    if isinstance(result, _Failure):
+                        raise result.excInfo[0], result.excInfo[1], result.excInfo[2]
+                    yield result
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _feed(self, items, queue, inFlight, stopped):
+        index = 0
+        try:
+            for item in items:
+                while not inFlight.acquire(False):
+                    if stopped.wait(STOP_CHECK_INTERVAL):
+                        return
+                if not _put(queue, (index, item), stopped):
+                    return
+                index += 1
+        except:
+            # the items iterable failed.  pass the failure on, so run() raises it after the items before it.
+            _put(queue, (index, _Failure(sys.exc_info())), stopped)
+        _put(queue, (_DONE, None), stopped)
+
+    def _work(self, stage, inQueue, outQueue, remaining, lock, stopped):
+        while not stopped.is_set():
+            try:
+                index, item = inQueue.get(True, STOP_CHECK_INTERVAL)
+            except Queue.Empty:
+                continue
+            if index is _DONE:
+                # the last worker of the stage to finish tells the next stage.
+                inQueue.put((_DONE, None))
+                with lock:
+                    remaining[0] -= 1
+                    isLast = not remaining[0]
+                if isLast:
+                    _put(outQueue, (_DONE, None), stopped)
+                return
+            if not isinstance(item, _Failure):
+                try:
+                    if stage.semaphore:
+                        with stage.semaphore:
+                            item = stage.func(item)
+                    else:
+                        item = stage.func(item)
+                except:
+                    item = _Failure(sys.exc_info())
+            if not _put(outQueue, (index, item), stopped):
+                return
+
+
+def _put(queue, item, stopped):
+    '''
+    puts item on queue, waiting for room unless the pipeline is stopped.
+    returns: True if item was put, False if the pipeline was stopped first.
+    '''
+    while not stopped.is_set():
+        try:
+            queue.put(item, True, STOP_CHECK_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+# last line
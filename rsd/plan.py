@@ -0,0 +1,202 @@
+'''
+Dry-run cost planning for rsd_search: estimates how many hit lookups,
+alignments and distance computations a run will do, how many residues it will
+align, and how long it will take with a given number of workers, without
+aligning anything.
+
+The work is counted from saved blast hits if there are any (see
+rsd.estimateOrthologsWork()), and otherwise from the on-the-fly hits of a random
+sample of sequences, scaled up to the whole genome.  Both directions are
+estimated, query to subject and swapped, and the cheaper one is chosen.  A run
+makes the same choice to decide whether to swap the genomes (see
+rsd.shouldSwapGenomes()).
+
+Seconds per unit of work default to rsd.SECONDS_PER_UNIT and can be calibrated
+from recorded timings: the JSON written by rsd_bench, or a snapshot of
+rsd.STAGE_TIMER.
+'''
+
+import json
+import random
+
+import fasta
+import rsd
+
+
+DEFAULT_SAMPLE_SIZE = 50
+# the stages that run concurrently with each other in the ortholog pipeline, and the keys of their worker counts.
+PIPELINE_STAGES = ('hits', 'align', 'distance')
+# blast modes: hits read from files, computed for every sequence before computing orthologs, or looked up on-the-fly.
+HITS_SAVED = 'saved'
+HITS_PRECOMPUTED = 'precomputed'
+HITS_ON_THE_FLY = 'on_the_fly'
+
+
+def secondsPerUnitFromStages(stages, blastResiduePairs=None):
+    '''
+    stages: a snapshot of rsd.STAGE_TIMER, a dict from stage name to a dict of seconds, calls and units.
+    blastResiduePairs: the number of pairs of query and subject residues blasted while the snapshot was recorded.  The
+      'blast' stage does not record units.
+    returns: a dict from stage to seconds per unit, for the stages with recorded work.
+    '''
+    secondsPerUnit = {}
+    for stage in ('align', 'distance'):
+        data = stages.get(stage)
+        if data and data['units']:
+            secondsPerUnit[stage] = data['seconds'] / float(data['units'])
+    if blastResiduePairs and stages.get('blast'):
+        secondsPerUnit['blast'] = stages['blast']['seconds'] / float(blastResiduePairs)
+    return secondsPerUnit
+
+
+def secondsPerUnitFromBench(results):
+    '''
+    results: benchmark results from rsd.bench.runBenchmark(), as written by rsd_bench.
+    returns: a dict from stage to seconds per unit, pooled over every run.
+    '''
+    stages = {}
+    blastResiduePairs = 0
+    for run in results['runs']:
+        for stage, data in run['stages'].items():
+            total = stages.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'units': 0})
+            for key in total:
+                total[key] += data[key]
+        # rsd_bench blasts the query genome against the subject genome and back.
+        blastResiduePairs += 2 * run['queryResidues'] * run['subjectResidues']
+    return secondsPerUnitFromStages(stages, blastResiduePairs)
+
+
+def loadCalibration(path):
+    '''
+    path: a JSON file of rsd_bench results, a snapshot of rsd.STAGE_TIMER ({'stages': {...}}), or a dict from stage to
+      seconds per unit.
+    returns: a dict from stage to seconds per unit.
+    '''
+    with open(path) as fh:
+        data = json.load(fh)
+    if 'runs' in data:
+        return secondsPerUnitFromBench(data)
+    elif 'stages' in data:
+        return secondsPerUnitFromStages(data['stages'], data.get('blastResiduePairs'))
+    else:
+        return dict((stage, float(value)) for stage, value in data.items())
+
+
+def sampleHits(seqIds, getSeqFunc, getHitSeqFunc, getForwardHits, getReverseHits, sampleSize=DEFAULT_SAMPLE_SIZE, seed=0):
+    '''
+    getSeqFunc, getHitSeqFunc: functions that return the sequence of an id of seqIds, or of a hit.
+    getForwardHits, getReverseHits: functions that take a seq id and a seq and return its blast hits, e.g. from
+      rsd.makeGetHitsOnTheFly().
+    Looks up the forward hits of a random sample of seqIds, and the reverse hits of the best hit of each.
+    returns: the sampled ids, and mappings from seq id to forward hits and from hit id to reverse hits, for
+      rsd.estimateOrthologsWork().
+    '''
+    sample = sorted(random.Random(seed).sample(seqIds, min(sampleSize, len(seqIds))))
+    forwardHits = {}
+    reverseHits = {}
+    for seqId in sample:
+        forwardHits[seqId] = hits = getForwardHits(seqId, getSeqFunc(seqId))
+        if hits:
+            hitId = rsd.getHitId(hits[0])
+            if hitId not in reverseHits:
+                reverseHits[hitId] = getReverseHits(hitId, getHitSeqFunc(hitId))
+    return sample, forwardHits, reverseHits
+
+
+def scaleWork(work, factor):
+    return dict((key, value * factor) for key, value in work.items())
+
+
+def estimateSeconds(work, numResidues, otherResidues, hitsMode, workers=None, secondsPerUnit=None):
+    '''
+    work: a dict of counts from rsd.estimateOrthologsWork().
+    numResidues, otherResidues: the total residues of the genome iterated over and of the other genome.
+    hitsMode: HITS_SAVED, HITS_PRECOMPUTED or HITS_ON_THE_FLY.
+    workers: a dict from pipeline stage ('hits', 'align', 'distance') to worker count.  Defaults to 1 each.
+    returns: a dict of estimated seconds per stage, 'serialSeconds', the sum of the stages, and 'wallSeconds', the
+      wall time given that the pipeline stages overlap and each runs on its workers.
+    '''
+    secondsPerUnit = dict(rsd.SECONDS_PER_UNIT, **(secondsPerUnit or {}))
+    workers = dict(dict.fromkeys(PIPELINE_STAGES, 1), **(workers or {}))
+    seconds = {'align': work['alignResidues'] * secondsPerUnit['align'],
+               'distance': work['distanceResidues'] * secondsPerUnit['distance']}
+    if hitsMode == HITS_PRECOMPUTED:
+        # every sequence of each genome is blasted against the other genome, once, before computing orthologs.
+        seconds['blast'] = 2 * numResidues * otherResidues * secondsPerUnit['blast']
+    elif hitsMode == HITS_ON_THE_FLY:
+        # each query is blasted against the other genome, and each best hit, assumed to be as long as a query, is blasted back.
+        numReverse = work['hitLookups'] - work['queries']
+        meanLength = work['queryResidues'] / float(work['queries']) if work['queries'] else 0
+        seconds['hits'] = (work['queryResidues'] * otherResidues + numReverse * meanLength * numResidues) * secondsPerUnit['blast']
+    pipelineSeconds = max([seconds.get(stage, 0.0) / workers[stage] for stage in PIPELINE_STAGES])
+    seconds['serialSeconds'] = sum(seconds.values())
+    seconds['wallSeconds'] = seconds.get('blast', 0.0) + pipelineSeconds
+    return seconds
+
+
+def planRun(queryFastaPath, subjectFastaPath, evalue, hitsMode, forwardHits=None, reverseHits=None, getForwardHits=None,
+            getReverseHits=None, querySeqIds=None, sampleSize=None, workers=None, secondsPerUnit=None):
+    '''
+    evalue: the loosest evalue threshold of the run, a float.
+    hitsMode: HITS_SAVED, HITS_PRECOMPUTED or HITS_ON_THE_FLY.
+    forwardHits, reverseHits: mappings from seq id to saved blast hits, e.g. from rsd.loadBlastHits().  If not given,
+      hits are sampled with getForwardHits and getReverseHits, functions that look up hits on-the-fly.
+    querySeqIds: the query sequence ids of the run, if limited.  Limiting the ids disables the genome swap.
+    sampleSize: the number of sequences of each genome to sample.  Defaults to rsd.SWAP_SAMPLE_SIZE.
+    returns: a dict describing the plan: the estimated work and seconds of each direction that is allowed ('forward'
+      and 'swapped'), and 'direction', the one with fewer serial seconds, which is the direction a run takes.
+    '''
+    sampleSize = sampleSize or rsd.SWAP_SAMPLE_SIZE
+    queryLengths = rsd.loadSeqLengths(queryFastaPath)
+    subjectLengths = rsd.loadSeqLengths(subjectFastaPath)
+    sampling = forwardHits is None or reverseHits is None
+    if sampling:
+        getQuerySeqFunc = rsd.makeGetSeqForId(queryFastaPath)
+        getSubjectSeqFunc = rsd.makeGetSeqForId(subjectFastaPath)
+    directions = [('forward', querySeqIds or list(fasta.readIds(queryFastaPath)), queryLengths, subjectLengths,
+                   forwardHits, reverseHits, getForwardHits, getReverseHits)]
+    if not querySeqIds:
+        directions.append(('swapped', list(fasta.readIds(subjectFastaPath)), subjectLengths, queryLengths,
+                           reverseHits, forwardHits, getReverseHits, getForwardHits))
+    plan = {'hitsMode': hitsMode, 'evalue': evalue, 'workers': dict(dict.fromkeys(PIPELINE_STAGES, 1), **(workers or {})),
+            'secondsPerUnit': dict(rsd.SECONDS_PER_UNIT, **(secondsPerUnit or {}))}
+    for direction, seqIds, seqLengths, hitSeqLengths, fHits, rHits, getF, getR in directions:
+        if sampling:
+            # look up the hits of a sample and scale its work up to every sequence.
+            getSeqFunc, getHitSeqFunc = (getQuerySeqFunc, getSubjectSeqFunc) if direction == 'forward' else (getSubjectSeqFunc, getQuerySeqFunc)
+            sampledIds, fHits, rHits = sampleHits(seqIds, getSeqFunc, getHitSeqFunc, getF, getR, sampleSize)
+            work = rsd.estimateOrthologsWork(sampledIds, seqLengths, hitSeqLengths, fHits, rHits, evalue)
+            work = scaleWork(work, len(seqIds) / float(len(sampledIds)) if sampledIds else 0)
+        else:
+            sampledIds = seqIds
+            work = rsd.estimateOrthologsWork(seqIds, seqLengths, hitSeqLengths, fHits, rHits, evalue)
+        seconds = estimateSeconds(work, sum(seqLengths.values()), sum(hitSeqLengths.values()), hitsMode, workers, secondsPerUnit)
+        plan[direction] = {'numSeqs': len(seqIds), 'numSampled': len(sampledIds), 'work': work, 'seconds': seconds}
+    # on a tie, do not swap.
+    plan['direction'] = min((plan[direction]['seconds']['serialSeconds'], direction) for direction in ('forward', 'swapped') if direction in plan)[1]
+    return plan
+
+
+def formatPlan(plan):
+    '''
+    returns: a human readable description of plan, as a list of lines.
+    '''
+    lines = []
+    for direction in ('forward', 'swapped'):
+        if direction not in plan:
+            continue
+        data = plan[direction]
+        work, seconds = data['work'], data['seconds']
+        chosen = ' (chosen)' if direction == plan['direction'] else ''
+        lines.append('{} direction{}: {} sequences, work estimated from {}'.format(
+            direction, chosen, data['numSeqs'], 'all of them' if data['numSampled'] == data['numSeqs'] else 'a sample of {}'.format(data['numSampled'])))
+        lines.append('  hit lookups: {:.0f}, alignments: {:.0f} ({:.0f} residues), distances: {:.0f} ({:.0f} residues)'.format(
+            work['hitLookups'], work['alignments'], work['alignResidues'], work['distances'], work['distanceResidues']))
+        stages = ', '.join('{} {:.3g}s'.format(stage, seconds[stage]) for stage in ('blast', 'hits', 'align', 'distance') if stage in seconds)
+        lines.append('  estimated seconds: {}; serial {:.3g}s; wall {:.3g}s with workers {}'.format(
+            stages, seconds['serialSeconds'], seconds['wallSeconds'],
+            ', '.join('{}={}'.format(stage, plan['workers'][stage]) for stage in PIPELINE_STAGES)))
+    return lines
+
+
+# last line
@@ -0,0 +1,224 @@
+'''
+A content-addressed cache of the orthologs of whole rsd_search runs, shared by
+every run that points at the same cache directory, e.g. the pipelines of a lab
+that request the same genome pairs with the same thresholds again and again.
+
+The key of a run (see resultKey()) is a digest of everything its orthologs
+depend on: the contents of the query and subject genomes (decompressed, so a
+genome and its gzipped copy share results), the divergence and evalue
+thresholds, the query sequence ids, the contents of any saved hits files, the
+executables of the external tools (see toolDigests()) and the settings of the
+engine (see engineSettings()).  Names of files play no part, so renaming or
+moving a genome still finds its results.
+
+Each result is a file of orthologs in format 3 (see orthutil), named by its key
+and nested (see nested.makeNestedPath()) so no directory gets too big.  Results
+are written to a temp file in the same directory and renamed into place, so
+readers on any node see a whole result or none, and two runs publishing the
+same key write the same orthologs.  Reading a result refreshes its modification
+time, and publishing a result removes the least recently used results until the
+cache fits in its size limit.
+'''
+
+import distutils.spawn
+import hashlib
+import json
+import os
+import time
+import uuid
+
+import nested
+import orthutil
+import rsd
+import util
+
+
+DEFAULT_MAX_BYTES = 10 * 2**30
+CACHE_NESTING = 2
+RESULT_SUFFIX = '.orthologs.txt'
+TMP_INFIX = '.tmp.'
+# temp files older than this were left by runs that died while publishing.
+STALE_TMP_SECONDS = 24 * 60 * 60
+# the external tools whose versions can change orthologs.
+TOOLS = ('blastp', 'makeblastdb', 'kalign', 'clustalw', 'codeml')
+
+# digests of tool executables, keyed by path and modification time.
+_toolDigests = {}
+
+
+def contentDigest(path, bufsize=2**20):
+    '''
+    returns: the SHA1 hex digest of the contents of path, decompressed if path is gzip or bzip2 compressed.
+    '''
+    digest = hashlib.sha1()
+    with util.openFile(path, 'rb') as fh:
+        for data in iter(lambda: fh.read(bufsize), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def toolDigests(tools=TOOLS):
+    '''
+    returns: a dict from the name of each tool to the digest of its executable on the PATH, which changes with every
+      version of the tool, or None if the tool is not installed.
+    '''
+    digests = {}
+    for tool in tools:
+        path = distutils.spawn.find_executable(tool)
+        if path is None:
+            digests[tool] = None
+            continue
+        key = (os.path.realpath(path), os.path.getmtime(path))
+        if key not in _toolDigests:
+            _toolDigests[key] = util.fileDigest(key[0])
+        digests[tool] = _toolDigests[key]
+    return digests
+
+
+def engineSettings():
+    '''
+    returns: a dict of the settings of rsd that change orthologs.  Settings that only change how fast orthologs are
+      computed, like worker counts and disk-backed stores, are left out.
+    '''
+    return {
+        'rsdVersion': rsd.__version__,
+        'searchBackend': rsd.SEARCH_BACKEND,
+        'alignMode': rsd.ALIGN_MODE,
+        'maxHits': rsd.MAX_HITS,
+        'useClustalw': rsd.USE_CLUSTALW,
+    }
+
+
+def resultKey(queryFastaPath, subjectFastaPath, divEvalues, ids=None, hitsPaths=(), tools=None, settings=None):
+    '''
+    queryFastaPath: the query genome.  Can be gzip or bzip2 compressed.
+    subjectFastaPath: the subject genome.  Can be gzip or bzip2 compressed.
+    divEvalues: a list of (div, evalue) pairs, as strings or numbers.  Their order and formatting do not matter.
+    ids: the query seq ids for which orthologs are computed, or None for every query sequence.
+    hitsPaths: the saved hits files orthologs are computed from, e.g. the forward and reverse hits given to rsd_search.
+      None for hits that are computed.
+    tools: defaults to toolDigests().
+    settings: defaults to engineSettings().
+    returns: the key of the result of computing orthologs, a hex digest.
+    '''
+    params = {
+        'query': contentDigest(queryFastaPath),
+        'subject': contentDigest(subjectFastaPath),
+        'divEvalues': sorted(set((repr(float(div)), repr(float(evalue))) for div, evalue in divEvalues)),
+        'ids': None if ids is None else list(ids),
+        'hits': [None if path is None else contentDigest(path) for path in hitsPaths],
+        'tools': toolDigests() if tools is None else tools,
+        'settings': engineSettings() if settings is None else settings,
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    Orthologs of rsd_search runs in a directory, by the key of each run.  Safe to share between processes and nodes.
+    '''
+    def __init__(self, dir, maxBytes=DEFAULT_MAX_BYTES, nesting=CACHE_NESTING):
+        '''
+        dir: the cache directory, created if it does not exist.
+        maxBytes: the size limit of the cache.  Publishing a result removes the least recently used results until the
+          results fit.
+        '''
+        self.dir = os.path.abspath(dir)
+        self.maxBytes = maxBytes
+        self.nesting = nesting
+        if not os.path.isdir(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                # another process created it first.
+                if not os.path.isdir(self.dir):
+                    raise
+
+    def path(self, key):
+        return nested.getNestedPath(key + RESULT_SUFFIX, dir=self.dir, nesting=self.nesting)
+
+    def get(self, key, divEvalues):
+        '''
+        divEvalues: the (div, evalue) pairs of the run, as in the dict returned by rsd.computeOrthologs().
+        returns: a dict from each pair in divEvalues to its cached orthologs, a list of (qid, sid, distance) tuples with
+          float distances, or None if the result of key is not in the cache.
+        '''
+        path = self.path(key)
+        try:
+            orthDatas = orthutil.orthDatasFromFile(path)
+            # the result was just used.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        valuesToOrthologs = dict(((float(div), float(evalue)), [(qid, sid, float(dist)) for qid, sid, dist in orthologs])
+                                 for (qdb, sdb, div, evalue), orthologs in orthDatas)
+        try:
+            return dict((divEvalue, valuesToOrthologs[(float(divEvalue[0]), float(divEvalue[1]))]) for divEvalue in divEvalues)
+        except KeyError:
+            return None
+
+    def put(self, key, divEvalueToOrthologs, queryName='query', subjectName='subject'):
+        '''
+        divEvalueToOrthologs: a dict from (div, evalue) pairs to orthologs, as returned by rsd.computeOrthologs().
+        queryName: the name of the query genome written in the result, for people reading it.
+        Publishes the result of key atomically and then prunes the cache to its size limit.
+        returns: the path of the result.
+        '''
+        path = nested.makeNestedPath(key + RESULT_SUFFIX, dir=self.dir, nesting=self.nesting)
+        tmpPath = '{}{}{}'.format(path, TMP_INFIX, uuid.uuid4().hex)
+        orthDatas = [((queryName, subjectName, div, evalue), divEvalueToOrthologs[(div, evalue)])
+                     for div, evalue in sorted(divEvalueToOrthologs, key=lambda divEvalue: (float(divEvalue[0]), float(divEvalue[1])))]
+        orthutil.orthDatasToFile(orthDatas, tmpPath)
+        os.rename(tmpPath, path)
+        self.prune()
+        return path
+
+    def entries(self):
+        '''
+        returns: a list of (mtime, size, path) for every result in the cache.
+        '''
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.dir):
+            for filename in filenames:
+                if filename.endswith(RESULT_SUFFIX):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                    except OSError:
+                        # removed by another process.
+                        pass
+        return entries
+
+    def prune(self, maxBytes=None):
+        '''
+        maxBytes: defaults to the size limit of the cache.
+        Removes the least recently used results until the rest fit in maxBytes, and temp files left by runs that died.
+        returns: the number of results removed.
+        '''
+        maxBytes = self.maxBytes if maxBytes is None else maxBytes
+        staleTime = time.time() - STALE_TMP_SECONDS
+        for dirpath, dirnames, filenames in os.walk(self.dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if TMP_INFIX in filename and os.path.getmtime(path) < staleTime:
+                        os.remove(path)
+                except OSError:
+                    pass
+        entries = sorted(self.entries())
+        totalBytes = sum(size for mtime, size, path in entries)
+        numRemoved = 0
+        for mtime, size, path in entries:
+            if totalBytes <= maxBytes:
+                break
+            try:
+                os.remove(path)
+                numRemoved += 1
+            except OSError:
+                # removed by another process.
+                pass
+            totalBytes -= size
+        return numRemoved
+
+
+# last line
@@ -25,31 +25,233 @@ __version__ = '1.1.7'
 import cStringIO
 import glob
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
+import threading
 import time
 
+import banded
+import diskstore
 import fasta
+import idtable
 import nested
+import pipeline
+import plan
+import search
+import toolrunner
 import util
 
 
 PAML_ERROR_MSG = 'paml_error'
+ALIGNMENT_ERROR_MSG = 'alignment_error'
 FORWARD_DIRECTION = 0
 REVERSE_DIRECTION = 1
 DASHLEN_RE = re.compile('^(-*)(.*?)(-*)$')
+# a divergence for which the rules of isTooDiverged() never apply.
+NEVER_TOO_DIVERGED = float('-inf')
 
 MAX_HITS = 3
+# blast tabular output with the standard columns and the lengths of the query and subject, for the coverage of hits.
+BLAST_OUTFMT = '6 std qlen slen'
 MATRIX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jones.dat')
 CODEML_CONTROL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codeml.ctl')
 
 # Constants used when aligning seqs with clustalw.  Kalign does not need these.
 USE_CLUSTALW = util.getBoolFromEnv('RSD_USE_CLUSTALW', False)
+# The homology search backend used to find hits: 'blast' (blastp) or 'kmer' (the built-in k-mer index search).  See
+# rsd.search and setSearchBackend().
+SEARCH_BACKEND = os.environ.get('RSD_SEARCH_BACKEND', search.BLAST_BACKEND)
+# How sequence pairs are aligned: 'full' aligns the whole sequences with kalign (or clustalw), and 'banded' aligns hits
+# that have blast HSP coordinates in a band around the diagonals of the HSP, and other hits in full.  See rsd.banded
+# and setAlignMode().
+FULL_ALIGN_MODE = 'full'
+BANDED_ALIGN_MODE = 'banded'
+ALIGN_MODES = (FULL_ALIGN_MODE, BANDED_ALIGN_MODE)
+ALIGN_MODE = os.environ.get('RSD_ALIGN_MODE', FULL_ALIGN_MODE)
+# Whether sequences ('seqs') and saved or computed blast hits ('hits') are kept in indexed on-disk stores instead of
+# dicts in memory, and the dir in which stores are written.  See diskstore and setDiskBacked().
+DISK_BACKED = {'seqs': False, 'hits': False}
+DISK_BACKED_DIR = None
+# The number of sequences whose hits makeGetCachedHits() keeps in memory, and the number of sequences it searches at once
+# when prefetching hits missing from its hits cache.
+HITS_LRU_SIZE = 10000
+HITS_PREFETCH_BATCH_SIZE = 500
 CLUSTAL_INPUT_FILENAME = 'clustal_fasta.faa'
 CLUSTAL_ALIGNMENT_FILENAME = 'clustal_fasta.aln'
 
+# Accumulates the time spent in each stage of the pipeline (formatting, blasting, aligning, computing distances, etc.)
+# Used by rsd_bench to report per-stage costs.
+STAGE_TIMER = util.StageTimer()
+
+# The number of threads for each kind of stage of the ortholog pipeline (see _computeOrthologsSub()): blast hit lookups
+# ('hits'), fetching hit sequences ('seqs'), kalign or clustalw ('align'), codeml ('distance') and finding minimum distance
+# hits and reciprocal orthologs ('reciprocity').  The forward and reverse stages of a kind share its count, so e.g. at most
+# STAGE_WORKERS['align'] alignments run at once, whether they align the hits of one query or of several.  Blast, kalign
+# and codeml are subprocesses, so one process can keep several cores busy, and alignments and distances default to one
+# per cpu.  See setStageWorkers().
+STAGE_WORKERS = {'hits': 1, 'seqs': 1, 'align': multiprocessing.cpu_count(), 'distance': multiprocessing.cpu_count(), 'reciprocity': 1}
+# The maximum number of queries waiting between two stages of the pipeline.
+PIPELINE_QUEUE_SIZE = 16
+# If True, computeOrthologs() starts the queries with the highest estimated cost first, so a few long proteins do not
+# finish last while the other workers idle.  See estimateQueryCosts().
+LONGEST_FIRST = util.getBoolFromEnv('RSD_LONGEST_FIRST', True)
+# the sequence lengths of genomes, cached by loadSeqLengths().
+_seqLengths = {}
+_seqLengthsLock = threading.Lock()
+# The per-query latencies of every run of _computeOrthologsSub() since resetRunSummaries(), summarized by
+# latencySummary().  Like PRUNE_SUMMARY and TIMEOUT_SUMMARY, it covers every call since the last reset, so a run split
+# into chunks (e.g. by a work queue) summarizes all of its chunks.
+LATENCY_SUMMARY = {}
+_runLatencies = []
+# If True, the reverse search of a minimum distance hit computes the distance of the query first, and stops computing
+# distances once a reverse hit is closer than the query for every threshold, since the hit can then not be an ortholog
+# of the query.  Orthologs are the same either way.  See computeReciprocalHitDataDistances().  PRUNE_SUMMARY holds the
+# number of distances skipped since resetRunSummaries().
+PRUNE_DISTANCES = util.getBoolFromEnv('RSD_PRUNE_DISTANCES', True)
+PRUNE_SUMMARY = {'distances': 0}
+# Each call of kalign or codeml on a pair of sequences is killed, with any processes it started, if it runs longer than
+# TOOL_TIMEOUT_BASE seconds plus TOOL_TIMEOUT_PER_RESIDUE seconds per residue of the pair, so one pathological pair can
+# not stall a worker.  A TOOL_TIMEOUT_BASE of 0 disables timeouts.  A pair that times out is dropped, like a pair that
+# is too diverged or for which codeml computes no distance, and TIMEOUT_SUMMARY lists the pairs dropped since
+# resetRunSummaries().  See setToolTimeouts().
+TOOL_TIMEOUT_BASE = float(os.environ.get('RSD_TOOL_TIMEOUT_BASE', 120))
+TOOL_TIMEOUT_PER_RESIDUE = float(os.environ.get('RSD_TOOL_TIMEOUT_PER_RESIDUE', 0.1))
+TIMEOUT_SUMMARY = {'align': [], 'distance': []}
+_summaryLock = threading.Lock()
+# Calls that fail in ways that are sometimes transient, kalign printing no alignment or codeml writing no results file,
+# are tried up to TOOL_TRIES times, pausing TOOL_RETRY_DELAY seconds, doubled after each try.  Timeouts are not retried,
+# since a pair that exceeds its timeout once is likely to exceed it again.
+TOOL_TRIES = 3
+TOOL_RETRY_DELAY = 0.1
+
+# Rough seconds per unit of work: per residue aligned ('align'), per aligned residue run through codeml ('distance') and
+# per pair of query and subject residues blasted ('blast').  Used to estimate the cost of a run.  rsd.plan can calibrate
+# them from the timings recorded by STAGE_TIMER.
+DEFAULT_SECONDS_PER_UNIT = {'align': 1.5e-5, 'distance': 1e-4, 'blast': 1e-10}
+# The cost model of the genome swap (see shouldSwapGenomes()) and of rsd.plan: the seconds per unit of work in use, and
+# the number of sequences of each genome whose hits are looked up to estimate the work of a direction when hits are not
+# saved.  See setCostModel().
+SECONDS_PER_UNIT = dict(DEFAULT_SECONDS_PER_UNIT)
+SWAP_SAMPLE_SIZE = plan.DEFAULT_SAMPLE_SIZE
+
+
+def setStageWorkers(**workers):
+    '''
+    workers: the number of threads for kinds of stages of the ortholog pipeline, e.g. setStageWorkers(align=4, distance=8).
+      See STAGE_WORKERS.  Kinds not given are unchanged.
+    '''
+    for kind, count in workers.items():
+        if kind not in STAGE_WORKERS:
+            raise ValueError('Unknown pipeline stage.', kind, sorted(STAGE_WORKERS))
+        if count is not None:
+            if count < 1:
+                raise ValueError('A pipeline stage needs at least 1 worker.', kind, count)
+            STAGE_WORKERS[kind] = count
+
+
+def setToolTimeouts(base=None, perResidue=None):
+    '''
+    base: the seconds allowed for every call of kalign or codeml, or 0 for no timeouts.  See TOOL_TIMEOUT_BASE.
+    perResidue: the seconds added per residue of the pair.  Values not given are unchanged.
+    '''
+    global TOOL_TIMEOUT_BASE, TOOL_TIMEOUT_PER_RESIDUE
+    for value in (base, perResidue):
+        if value is not None and value < 0:
+            raise ValueError('A tool timeout can not be negative.', value)
+    if base is not None:
+        TOOL_TIMEOUT_BASE = float(base)
+    if perResidue is not None:
+        TOOL_TIMEOUT_PER_RESIDUE = float(perResidue)
+
+
+def setCostModel(secondsPerUnit=None, sampleSize=None):
+    '''
+    secondsPerUnit: a dict from stage to seconds per unit of work, e.g. from rsd.plan.loadCalibration().  Stages not
+      given are unchanged.  See SECONDS_PER_UNIT.
+    sampleSize: the number of sequences of each genome whose hits are sampled.  See SWAP_SAMPLE_SIZE.  Unchanged if not
+      given.
+    '''
+    global SWAP_SAMPLE_SIZE
+    SECONDS_PER_UNIT.update(secondsPerUnit or {})
+    if sampleSize is not None:
+        SWAP_SAMPLE_SIZE = sampleSize
+
+
+def resetRunSummaries():
+    '''
+    Starts a new run: clears LATENCY_SUMMARY, PRUNE_SUMMARY and TIMEOUT_SUMMARY, which otherwise add up every call of
+    _computeOrthologsSub().
+    '''
+    with _summaryLock:
+        LATENCY_SUMMARY.clear()
+        del _runLatencies[:]
+        PRUNE_SUMMARY['distances'] = 0
+        for pairs in TIMEOUT_SUMMARY.values():
+            del pairs[:]
+
+
+def toolTimeout(numResidues):
+    '''
+    returns: the seconds allowed for a call of kalign or codeml on a pair of sequences with numResidues residues (or
+      alignment columns) in all, or None if timeouts are disabled.
+    '''
+    if not TOOL_TIMEOUT_BASE:
+        return None
+    return TOOL_TIMEOUT_BASE + TOOL_TIMEOUT_PER_RESIDUE * numResidues
+
+
+def _recordTimeout(tool, seqId, hitSeqId):
+    logging.warning('%s of %s and %s timed out.  The pair is dropped.', tool, seqId, hitSeqId)
+    with _summaryLock:
+        TIMEOUT_SUMMARY[tool].append((seqId, hitSeqId))
+
+
+def _retryTool(operation, args, pred):
+    '''
+    runs operation(*args), retrying failures for which pred is True with a backoff, up to TOOL_TRIES tries in all.
+    '''
+    return util.retryErrorExecute(operation, args, pred=pred, numTries=TOOL_TRIES, delay=TOOL_RETRY_DELAY, backoff=2)
+
+
+def setSearchBackend(name):
+    '''
+    name: a backend in search.BACKENDS, e.g. 'blast' or 'kmer'.  Used by formatFastaArg() and getBlastHits().
+    '''
+    if name not in search.BACKENDS:
+        raise ValueError('Unknown search backend.', name, sorted(search.BACKENDS))
+    global SEARCH_BACKEND
+    SEARCH_BACKEND = name
+
+
+def setAlignMode(mode):
+    '''
+    mode: a mode in ALIGN_MODES, 'full' or 'banded'.  Used by alignHitData().
+    '''
+    if mode not in ALIGN_MODES:
+        raise ValueError('Unknown align mode.', mode, ALIGN_MODES)
+    global ALIGN_MODE
+    ALIGN_MODE = mode
+
+
+def setDiskBacked(seqs=None, hits=None, dir=None):
+    '''
+    seqs: if True, makeGetSeqForId() looks up sequences in an on-disk store instead of a dict.
+    hits: if True, makeGetSavedHits() looks up hits in an on-disk store, and computeBlastHits() writes hits stores
+      instead of pickled dicts.
+    dir: where stores of sequences and pickled hits are written.  The caller is responsible for removing them, e.g. by
+      using a temporary dir.
+    Settings not given are unchanged.
+    '''
+    global DISK_BACKED_DIR
+    for key, value in (('seqs', seqs), ('hits', hits)):
+        if value is not None:
+            DISK_BACKED[key] = value
+    if dir is not None:
+        DISK_BACKED_DIR = dir
+
 
 #################
 # BLAST FUNCTIONS
@@ -64,8 +266,9 @@ def formatForBlast(fastaPath):
     # cmd = 'formatdb -p -o -i'+fastaPath
     # redirect stdout to /dev/null to make the command quiter.
     cmd = ['makeblastdb', '-in', fastaPath, '-dbtype', 'prot', '-parse_seqids']
-    with open(os.devnull, 'w') as devnull:
-        subprocess.check_call(cmd, stdout=devnull)
+    with STAGE_TIMER.timing('format'):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, stdout=devnull)
 
 
 def getHitId(hit):
@@ -79,15 +282,36 @@ def getHitEvalue(hit):
     return hit[1]
 
 
+def getHitHsp(hit):
+    '''
+    returns: the (qstart, qend, sstart, send) coordinates of the best HSP of the hit, 1-based and inclusive, or None if
+      the hit has none, e.g. it was found by the kmer search backend or saved by an older version of RSD.
+    '''
+    return hit[2] if len(hit) > 2 else None
+
+
+def getHitStats(hit):
+    '''
+    returns: a tuple of the (bitscore, alignment length, percent identity, query coverage, subject coverage) of the
+      best HSP of the hit, or None if the hit has none.  Coverages are the fraction of each sequence the HSP spans, or
+      None if the blast results did not report sequence lengths.
+    '''
+    return hit[3] if len(hit) > 3 else None
+
+
 def loadBlastHits(path):
     '''
     path: location of stored blast hits computed by computeBlastHits()
-    returns: mapping object from query id to hits.  used to be a bsddb, now is a dict.
+    returns: mapping object from query id to hits.  used to be a bsddb, now is a dict, or a diskstore.HitsStore if path
+      is a hits store.
     '''
-    return util.loadObject(path)
+    with STAGE_TIMER.timing('load_hits'):
+        if diskstore.isSqliteFile(path):
+            return diskstore.HitsStore(path)
+        return util.loadObject(path)
 
 
-def getBlastHits(queryFastaPath, subjectIndexPath, evalue, limitHits=MAX_HITS, workingDir='.', copyToWorking=False):
+def getBlastHits(queryFastaPath, subjectIndexPath, evalue, limitHits=MAX_HITS, workingDir='.', copyToWorking=False, scratchDir=None):
     '''
     queryFastaPath: location of fasta file of query sequences
     subjectIndexPath: location and name of blast-formatted indexes.
@@ -95,32 +319,59 @@ def getBlastHits(queryFastaPath, subjectIndexPath, evalue, limitHits=MAX_HITS, w
     workingDir: creates, uses, and removes a directory under workingDir.
     copyToWorking: if True, copy query fasta path and subject index files to within the working directory and use the copies to blast.
       can improve performance if the working directory is on local disk and the files are on a slow network.
+    scratchDir: if given, an existing dir (e.g. from a nested.ScratchPool) to work in instead of creating one under workingDir.
+      The caller is responsible for cleaning it up.
     blasts every sequence in query agaist subject, adding hits that are better than evalue to a list stored in a dict keyed on the query id.
+    If SEARCH_BACKEND is not 'blast', searches with that backend instead, and subjectIndexPath is the subject fasta file.
     '''
+    if SEARCH_BACKEND != search.BLAST_BACKEND:
+        backend = search.getBackend(SEARCH_BACKEND)
+        with STAGE_TIMER.timing('search'):
+            return hitsMapFromHitsGen(backend.searchGen(queryFastaPath, subjectIndexPath, evalue, workingDir), limitHits)
+    if scratchDir:
+        return _getBlastHitsInDir(queryFastaPath, subjectIndexPath, evalue, limitHits, copyToWorking, scratchDir)
     # work in a nested tmp dir to avoid junking up the working dir.
     with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
-        if copyToWorking:
-            localFastaPath = os.path.join(tmpDir, 'query.fa')
-            shutil.copyfile(queryFastaPath, localFastaPath)
-            localIndexDir = os.path.join(tmpDir, 'local_blast')
-            os.makedirs(localIndexDir, 0770)
-            localIndexPath = os.path.join(localIndexDir, os.path.basename(subjectIndexPath))
-            for path in glob.glob(subjectIndexPath+'*'):
-                if os.path.isfile:
-                    shutil.copy(path, localIndexDir)
-            queryFastaPath = localFastaPath
-            subjectIndexPath = localIndexPath
-        blastResultsPath = os.path.join(tmpDir, 'blast_results')
-        # blast query vs subject, using /opt/blast-2.2.22/bin/blastp
-        cmd = ['blastp', '-outfmt', '6', '-evalue', str(evalue), 
-               '-query', queryFastaPath, '-db', subjectIndexPath, 
-               '-out', blastResultsPath]
-        subprocess.check_call(cmd)
-        # parse results
+        return _getBlastHitsInDir(queryFastaPath, subjectIndexPath, evalue, limitHits, copyToWorking, tmpDir)
+
+
+def _getBlastHitsInDir(queryFastaPath, subjectIndexPath, evalue, limitHits, copyToWorking, tmpDir):
+    '''
+    blasts queryFastaPath against subjectIndexPath, working in the existing dir tmpDir.  See getBlastHits().
+    '''
+    if copyToWorking:
+        localFastaPath = os.path.join(tmpDir, 'query.fa')
+        shutil.copyfile(queryFastaPath, localFastaPath)
+        localIndexDir = os.path.join(tmpDir, 'local_blast')
+        os.makedirs(localIndexDir, 0770)
+        localIndexPath = os.path.join(localIndexDir, os.path.basename(subjectIndexPath))
+        for path in glob.glob(subjectIndexPath+'*'):
+            if os.path.isfile:
+                shutil.copy(path, localIndexDir)
+        queryFastaPath = localFastaPath
+        subjectIndexPath = localIndexPath
+    blastResultsPath = runBlastp(queryFastaPath, subjectIndexPath, evalue, tmpDir)
+    # parse results
+    with STAGE_TIMER.timing('parse_hits'):
         hitsMap = parseResults(blastResultsPath, limitHits)
     return hitsMap
 
 
+def runBlastp(queryFastaPath, subjectIndexPath, evalue, tmpDir):
+    '''
+    blasts queryFastaPath against subjectIndexPath, writing tabular results in tmpDir.
+    returns: the path of the results.
+    '''
+    blastResultsPath = os.path.join(tmpDir, 'blast_results')
+    # blast query vs subject, using /opt/blast-2.2.22/bin/blastp
+    cmd = ['blastp', '-outfmt', BLAST_OUTFMT, '-evalue', str(evalue), 
+           '-query', queryFastaPath, '-db', subjectIndexPath, 
+           '-out', blastResultsPath]
+    with STAGE_TIMER.timing('blast'):
+        subprocess.check_call(cmd)
+    return blastResultsPath
+
+
 def computeBlastHits(queryFastaPath, subjectIndexPath, outPath, evalue, limitHits=MAX_HITS, workingDir='.', copyToWorking=False):
     '''
     queryFastaPath: location of fasta file of query sequences
@@ -131,42 +382,107 @@ def computeBlastHits(queryFastaPath, subjectIndexPath, outPath, evalue, limitHit
     copyToWorking: if True, copy query fasta path and subject index files to within the working directory and use the copies to blast.
       can improve performance if the working directory is on local disk and the files are on a slow network.
     Runs getBlastHits() and persists the hits to outPath.
+    If DISK_BACKED['hits'], the hits are streamed into a hits store at outPath instead, never all in memory, and
+      copyToWorking is ignored.  See diskstore.
     '''
+    if DISK_BACKED['hits']:
+        hitsGen = search.getBackend(SEARCH_BACKEND).searchGen(queryFastaPath, subjectIndexPath, evalue, workingDir)
+        with STAGE_TIMER.timing('search'):
+            diskstore.writeHitsStore(hitsListsFromHitsGen(hitsGen, limitHits), outPath)
+        return
     hitsMap = getBlastHits(queryFastaPath, subjectIndexPath, evalue, limitHits, workingDir, copyToWorking)
     util.dumpObject(hitsMap, outPath)
 
 
 def parseResults(blastResultsPath, limitHits=MAX_HITS):
     '''
-    returns: a map from query seq id to a list of tuples of (subject seq id, evalue) for the top hits of the query sequence in the subject genome
+    blastResultsPath: blast tabular output (-outfmt 6).  Can be gzip or bzip2 compressed.
+    returns: a map from query seq id to a list of tuples of (subject seq id, evalue, hsp, stats) for the top hits of the
+      query sequence in the subject genome, where hsp and stats describe the best HSP of the hit.  See getHitHsp() and
+      getHitStats().
+    '''
+    return hitsMapFromHitsGen(parseResultsGen(blastResultsPath), limitHits)
+
+
+def parseResultsGen(blastResultsPath):
+    '''
+    blastResultsPath: blast tabular output (-outfmt 6, optionally followed by the qlen and slen columns, see
+      BLAST_OUTFMT).  Can be gzip or bzip2 compressed.
+    yields: a tuple of (query seq id, subject seq id, evalue, hsp, stats) for every line of the results, where hsp is the
+      (qstart, qend, sstart, send) of the alignment, 1-based and inclusive, and stats is its (bitscore, length, percent
+      identity, query coverage, subject coverage).  Coverages are None without the qlen and slen columns.
     '''
     # parse tabular results into hits.  thank you, ncbi, for creating results this easy to parse.
+    prevLine = None
+    # each distinct name is parsed once, and every hit of a sequence shares one id string.
+    nameToId = {}
+    def parseId(name):
+        try:
+            return nameToId[name]
+        except KeyError:
+            seqId = nameToId[name] = fasta.idFromName(name) # remove namespace prefix, e.g. 'gi|'
+            return seqId
+    fh = util.openFile(blastResultsPath)
+    try:
+        for line in fh:
+            splits = line.split()
+            try:
+                seqId = parseId(splits[0])
+                hitId = parseId(splits[1])
+                hsp = qstart, qend, sstart, send = tuple(int(coordinate) for coordinate in splits[6:10])
+                hitEvalue = float(splits[10])
+                if len(splits) > 13:
+                    coverages = (abs(qend - qstart) + 1) / float(splits[12]), (abs(send - sstart) + 1) / float(splits[13])
+                else:
+                    coverages = None, None
+                stats = (float(splits[11]), int(splits[3]), float(splits[2])) + coverages
+            except Exception as e:
+                logging.exception('parseResultsGen(): prevLine: {}, line: {}'.format(prevLine, line))
+                continue
+            prevLine = line
+            yield seqId, hitId, hitEvalue, hsp, stats
+    finally:
+        fh.close()
+
+
+def hitsMapFromHitsGen(hitsGen, limitHits=MAX_HITS):
+    '''
+    hitsGen: an iterable of (query seq id, subject seq id, evalue), optionally followed by an hsp and stats, ordered by
+      query and then by evalue, e.g. from parseResultsGen() or a search backend.
+    returns: a map from query seq id to a list of tuples of (subject seq id, evalue), followed by the hsp and stats if
+      hitsGen has them, for the top limitHits hits of the query.
+    '''
     hitsMap = {}
-    hitsCountMap = {}
-    prevSeqId = None
+    for seqId, hits in hitsListsFromHitsGen(hitsGen, limitHits):
+        hits = hitsMap.setdefault(seqId, []) + hits
+        hitsMap[seqId] = hits[:limitHits] if limitHits else hits
+    return hitsMap
+
+
+def hitsListsFromHitsGen(hitsGen, limitHits=MAX_HITS):
+    '''
+    hitsGen: an iterable of (query seq id, subject seq id, evalue), optionally followed by an hsp and stats, ordered by
+      query and then by evalue.
+    yields: a pair of query seq id and a list of tuples of (subject seq id, evalue), followed by the hsp and stats if
+      hitsGen has them, the top limitHits hits of the query, for each run of hits of the same query in hitsGen.
+    '''
+    seqId = None
+    hits = None
     prevHitId = None
-    fh = open(blastResultsPath)
-    for line in fh:
-        splits = line.split()
-        try:
-            seqId = fasta.idFromName(splits[0]) # remove namespace prefix, e.g. 'gi|'
-            hitId = fasta.idFromName(splits[1])
-            hitEvalue = float(splits[10])
-        except Exception as e:
-            logging.exception('parseResults(): prevSeqId: {}, prevHitId: {}, line: {}'.format(prevSeqId, prevHitId, line))
+    for row in hitsGen:
+        hitSeqId, hitId, hitEvalue = row[:3]
+        if hits is None or hitSeqId != seqId:
+            if hits is not None:
+                yield seqId, hits
+            seqId, hits, prevHitId = hitSeqId, [], None
         # results table reports multiple "alignments" per "hit" in ascending order by evalue
-        # we only store the top hits.
-        if prevSeqId != seqId or prevHitId != hitId:
-            prevSeqId = seqId
+        # we only store the top hits, with the coordinates of their best alignment.
+        if hitId != prevHitId:
             prevHitId = hitId
-            if seqId not in hitsCountMap:
-                hitsCountMap[seqId] = 0
-                hitsMap[seqId] = []
-            if not limitHits or hitsCountMap[seqId] < limitHits:
-                hitsCountMap[seqId] += 1                
-                hitsMap[seqId].append((hitId, hitEvalue))
-    fh.close()
-    return hitsMap
+            if not limitHits or len(hits) < limitHits:
+                hits.append((hitId, hitEvalue) + tuple(row[3:]))
+    if hits is not None:
+        yield seqId, hits
     
     
 ###############
@@ -175,13 +491,10 @@ def parseResults(blastResultsPath, limitHits=MAX_HITS):
 
 
 def pamlGetDistance(path):
+    '''
+    raises: IOError if codeml wrote no 2AA.t file in path.  getDistanceForAlignedSeqPair() runs codeml again.
+    '''
     filename = '%s/2AA.t'%path
-    
-    # adding a pause on the off-chance that the filesystem might be lagging a bit, causing the open() to fail below.
-    # I think it is more likely that codeml in runPaml_all() is failing before writing the file.
-    if not os.path.isfile(filename):
-        time.sleep(0.5)
-
     with open(filename) as rst:
         get_rst = rst.readlines()
     os.unlink(filename)
@@ -202,20 +515,22 @@ def pamlGetDistance(path):
     return dist
 
 
-def alignFastaKalign(input):
+def alignFastaKalign(input, timeout=None):
     '''
     input: string containing fasta formatted sequences to be aligned.
+    timeout: seconds after which kalign is killed.  See util.run().
     runs alignment program kalign
     Returns: fasta-formatted aligned sequences
     '''
-    alignedFasta = util.run(['kalign', '-f', 'fasta'], input) # output clustalw format
+    alignedFasta = util.run(['kalign', '-f', 'fasta'], input, timeout=timeout) # output clustalw format
     return alignedFasta.replace('\n\n', '\n') # replace fixes a bug in Kalign version 2.04, where if a seq is exactly 60 chars long, an extra newline is output.
     
 
-def alignFastaClustalw(input, path):
+def alignFastaClustalw(input, path, timeout=None):
     '''
     input: string containing fasta formatted sequences to be aligned.
     path: working directory where fasta will be written and clustal will write output files.
+    timeout: seconds after which clustalw is killed.  See util.checkCall().
     runs alignment program clustalw
     Returns: fasta-formatted aligned sequences
     '''
@@ -225,7 +540,7 @@ def alignFastaClustalw(input, path):
     try:
         cmd = ['clustalw', '-output', 'fasta', '-infile', clustalFastaPath, '-outfile', clustalAlignmentPath]
         with open(os.devnull, 'w') as devnull:
-            subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+            util.checkCall(cmd, stdout=devnull, stderr=devnull, timeout=timeout)
     except Exception:
         logging.exception('runClustal Error:  clustalFastaPath data = %s'%open(clustalFastaPath).read())
         raise
@@ -262,45 +577,154 @@ def dashlen_check(seq):
 def makeGetSeqForId(genomeFastaPath):
     '''
     genomeFastaPath: location of fasta file.  also location/name of blast formatted indexes of the fasta file.
+    returns: a function that takes a sequence id and returns the sequence.  See makeGetSeqForNum().
+    '''
+    table = idtable.loadIdTable(genomeFastaPath)
+    getSeqForNum = makeGetSeqForNum(genomeFastaPath)
+    def getSeqForId(seqId):
+        return getSeqForNum(table.num(seqId))
+    return getSeqForId
+
+
+def makeGetSeqForNum(genomeFastaPath):
+    '''
+    genomeFastaPath: location of fasta file.  also location/name of blast formatted indexes of the fasta file.
+    returns: a function that takes the number of a sequence in the id table of the genome (see idtable) and returns the
+      sequence.
+    If DISK_BACKED['seqs'], sequences are looked up in an on-disk store instead of memory.
     '''
-    # suck fasta file into memory, converting it into a map from id to sequence
-    # in memory dict performs much better than on-disk retrieval with xdget or fastacmd.
+    if DISK_BACKED['seqs']:
+        with STAGE_TIMER.timing('load_seqs'):
+            seqStore = diskstore.seqStoreFromFasta(genomeFastaPath, DISK_BACKED_DIR)
+        return seqStore.__getitem__
+    # suck fasta file into memory, as a list of sequences in the order of the id table.
+    # in memory list performs much better than on-disk retrieval with xdget or fastacmd.
     # and genome fasta files do not take much space (on a modern computer).
-    fastaMap = {}
-    for (seqNameline, seq) in fasta.readFasta(genomeFastaPath):
-        seqId = fasta.idFromName(seqNameline)
-        fastaMap[seqId] = seq
-    def getSeqForIdInMemory(seqId):
-        return fastaMap[seqId]
-    return getSeqForIdInMemory
+    with STAGE_TIMER.timing('load_seqs'):
+        seqs = [seq for seqNameline, seq in fasta.readFasta(genomeFastaPath)]
+    return seqs.__getitem__
     
 
-def makeGetHitsOnTheFly(genomeIndexPath, evalue, workingDir='.'):
+def makeGetHitsOnTheFly(genomeIndexPath, evalue, workingDir='.', scratchPool=None):
     '''
     genomeIndexPath: location of blast formatted indexes.  usually same directory/name as genome fasta path
     evalue: float or string.  Hits with evalues >= evalue will not be included in the returned blast hits.
-    workingDir: a directory in which to create, use, and delete temporary files and dirs.
+    workingDir: unused.  Kept for backward compatibility.
+    scratchPool: a nested.ScratchPool in which to write queries and blast results.  Defaults to nested.getDefaultScratchPool(),
+      so a lookup recycles a scratch dir, preferably in RAM, instead of creating and deleting a dir under workingDir.
     returns: a function that returns that takes as input a sequence id and sequence and returns the blast hits
     '''
     def getHitsOnTheFly(seqid, seq):
-        with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
-            queryFastaPath = os.path.join(tmpDir, 'query.faa')
+        pool = scratchPool or nested.getDefaultScratchPool()
+        with pool.scratch() as scratchDir:
+            queryFastaPath = os.path.join(scratchDir, 'query.faa')
             # add 'lcl|' to make ncbi blast happy.
             util.writeToFile('{0}\n{1}\n'.format('>lcl|'+seqid, seq), queryFastaPath)
-            hitsDb = getBlastHits(queryFastaPath, genomeIndexPath, evalue, workingDir=workingDir)
+            hitsDb = getBlastHits(queryFastaPath, genomeIndexPath, evalue, scratchDir=scratchDir)
         return hitsDb.get(seqid)
     return getHitsOnTheFly
 
 
+def hitsCachePath(cacheDir, queryFastaPath, subjectIndexPath):
+    '''
+    returns: the path in cacheDir of the hits cache of searching the query genome against the subject genome with the
+      current search backend.  The name includes a digest of the contents of each genome, so a genome that changes, e.g.
+      with a new release, gets a new cache.  See makeGetCachedHits().
+    '''
+    names = ['{}.{}'.format(os.path.basename(path), util.fileDigest(path)[:12]) for path in (queryFastaPath, subjectIndexPath)]
+    return os.path.join(cacheDir, '{}_{}.{}.hits.sqlite'.format(names[0], names[1], SEARCH_BACKEND))
+
+
+def makeGetCachedHits(genomeIndexPath, evalue, cachePath, lruSize=HITS_LRU_SIZE, scratchPool=None):
+    '''
+    genomeIndexPath: location of blast formatted indexes of the genome to search.
+    evalue: float or string.  Hits with evalues >= evalue will not be included in the returned blast hits.
+    cachePath: a hits cache, created if it does not exist.  See diskstore.HitsCache and hitsCachePath().
+    lruSize: the number of sequences whose hits are kept in memory.
+    scratchPool: see makeGetHitsOnTheFly().
+    returns: a function that takes a sequence id and sequence and returns the blast hits, read through three tiers: the
+      hits of recently looked up sequences in memory, then the hits cache, then a search of genomeIndexPath, whose hits
+      are written back to the cache.  Runs that look up the same sequences, e.g. repeated runs with different querySeqIds,
+      get faster as the cache grows, without computing hits for every sequence in advance.  The function has a
+      prefetch(idsAndSeqs) attribute, which searches every (seq id, seq) pair missing from the cache in batches, and a
+      stats attribute, a dict of the number of lookups found in 'memory', on 'disk', and 'searched'.
+    '''
+    evalue = float(evalue)
+    cache = diskstore.HitsCache(cachePath)
+    recent = util.LruCache(lruSize)
+    stats = {'memory': 0, 'disk': 0, 'searched': 0}
+    statsLock = threading.Lock()
+
+    def searchAndCache(idsAndSeqs):
+        pool = scratchPool or nested.getDefaultScratchPool()
+        with pool.scratch() as scratchDir:
+            queryFastaPath = os.path.join(scratchDir, 'query.faa')
+            # add 'lcl|' to make ncbi blast happy.
+            util.writeToFile(''.join('>lcl|{0}\n{1}\n'.format(seqId, seq) for seqId, seq in idsAndSeqs), queryFastaPath)
+            hitsDb = getBlastHits(queryFastaPath, genomeIndexPath, evalue, scratchDir=scratchDir)
+        found = dict((seqId, hitsDb.get(seqId) or []) for seqId, seq in idsAndSeqs)
+        cache.add(found, evalue)
+        with statsLock:
+            stats['searched'] += len(found)
+        return found
+
+    def getCachedHits(seqId, seq):
+        hits = recent.get(seqId)
+        tier = 'memory'
+        if hits is None:
+            hits = cache.lookup(seqId, evalue)
+            tier = 'disk'
+            if hits is None:
+                hits = searchAndCache([(seqId, seq)])[seqId]
+                tier = None
+            recent.put(seqId, hits)
+        if tier:
+            with statsLock:
+                stats[tier] += 1
+        return hits
+
+    def prefetch(idsAndSeqs):
+        missing = ((seqId, seq) for seqId, seq in idsAndSeqs if recent.get(seqId) is None and cache.lookup(seqId, evalue) is None)
+        for batch in util.groupsOfN(missing, HITS_PREFETCH_BATCH_SIZE):
+            searchAndCache(batch)
+
+    getCachedHits.prefetch = prefetch
+    getCachedHits.stats = stats
+    return getCachedHits
+
+
+def prefetchHits(querySeqIds, getQuerySeqFunc, getSubjectSeqFunc, getForwardHits, getReverseHits, evalue):
+    '''
+    If the hit functions can prefetch hits (see makeGetCachedHits()), searches the forward hits of querySeqIds, and then the
+    reverse hits of every forward hit below evalue, in batches rather than one sequence at a time.  The reverse hits of
+    every good forward hit are fetched, though only those of the minimum distance hits are used, since one batched search
+    costs less than a search per sequence.
+    '''
+    if hasattr(getForwardHits, 'prefetch'):
+        getForwardHits.prefetch((seqId, getQuerySeqFunc(seqId)) for seqId in querySeqIds)
+    if hasattr(getReverseHits, 'prefetch'):
+        hitIds = []
+        for seqId in querySeqIds:
+            hitIds.extend(hitId for hitId, hitEvalue in filterEvalueHits(getForwardHits(seqId, getQuerySeqFunc(seqId)), evalue))
+        getReverseHits.prefetch((hitId, getSubjectSeqFunc(hitId)) for hitId in sorted(set(hitIds)))
+
+
 def makeGetSavedHits(filename):
     '''
     returns a function which can be used to get the hits
     from a file containing pre-computed blast results
     '''
     # in memory retrieval is faster than on-disk retrieval with bsddb, but this has a minor impact on overall roundup performance.
-    hitsDb = loadBlastHits(filename)
+    # on-disk retrieval is used when a run would not fit in memory.  See setDiskBacked().
+    if DISK_BACKED['hits']:
+        with STAGE_TIMER.timing('load_hits'):
+            hitsDb = diskstore.hitsStoreFromFile(filename, DISK_BACKED_DIR)
+    else:
+        hitsDb = loadBlastHits(filename)
     def getHitsInMemory(seqid, seq):
         return hitsDb.get(seqid)
+    # lets computeOrthologs() estimate the cost of each direction from the hits.  See shouldSwapGenomes().
+    getHitsInMemory.hitsDb = hitsDb
     return getHitsInMemory
 
 
@@ -309,23 +733,31 @@ def getGoodEvalueHits(seqId, seq, getHitsFunc, getSeqFunc, evalue):
     evalue: a float.
     returns: a list of pairs of (hitSeqId, hitSequence, hitEvalue) that have a hitEvalue below evalue.  hitEvalue is a float.
     '''
-    goodhits = []
+    return [(hitSeqId, getSeqFunc(hitSeqId), hitEvalue) for hitSeqId, hitEvalue in filterEvalueHits(getHitsFunc(seqId, seq), evalue)]
+
+
+def filterEvalueHits(hits, evalue):
+    '''
+    hits: the blast hits of a sequence, as returned by a getHits function.  Can be None.
+    evalue: a float.
+    returns: a list of (hitSeqId, hitEvalue) for the first MAX_HITS hits that have a hitEvalue below evalue.
+    '''
+    return [(getHitId(hit), getHitEvalue(hit)) for hit in filterGoodHits(hits, evalue)]
 
-    hits = getHitsFunc(seqId, seq)
-    
-    # check for 3 or fewer blast hits below evalue threshold
-    if hits:
-        hitCount = 0
-        for hit in hits:
-            if hitCount >= MAX_HITS:
-                break
-            hitSeqId = getHitId(hit)
-            hitEvalue = getHitEvalue(hit)
-            if hitEvalue < evalue:
-                hitCount += 1
-                hitSeq = getSeqFunc(hitSeqId)
-                goodhits.append((hitSeqId, hitSeq, hitEvalue))
 
+def filterGoodHits(hits, evalue):
+    '''
+    hits: the blast hits of a sequence, as returned by a getHits function.  Can be None.
+    evalue: a float.
+    returns: a list of the first MAX_HITS hits that have an evalue below evalue, e.g. for reading their HSPs.
+    '''
+    goodhits = []
+    # check for 3 or fewer blast hits below evalue threshold
+    for hit in hits or []:
+        if len(goodhits) >= MAX_HITS:
+            break
+        if getHitEvalue(hit) < evalue:
+            goodhits.append(hit)
     return goodhits
 
 
@@ -352,39 +784,42 @@ def getDistanceForAlignedSeqPair(seqId, alignedSeq, hitSeqId, alignedHitSeq, wor
     # write the codeml control file that will run codeml
     # run the codeml 
     
+    def runCodeml():
+        with STAGE_TIMER.timing('distance', units=len(alignedSeq)):
+            with open(os.devnull, 'w') as devnull:
+                util.checkCall(['codeml'], cwd=workPath, stdout=devnull, timeout=toolTimeout(2 * len(alignedSeq)))
+        return pamlGetDistance(workPath)
+
     try:
-        with open(os.devnull, 'w') as devnull:
-            subprocess.check_call(['codeml'], cwd=workPath, stdout=devnull)
-    
-        distance = pamlGetDistance(workPath)
-        return distance
+        # codeml occasionally exits without writing its results file.  run it again a few times.
+        return _retryTool(runCodeml, [], lambda e: isinstance(e, IOError))
     finally:
         for filePath in [dataFilePath, treeFilePath, outFilePath]:
             if os.path.exists(filePath):
                 os.remove(filePath)
             
 
-def getGoodDivergenceAlignedTrimmedSeqPair(seqId, seq, hitSeqId, hitSeq, workPath):
+def alignSeqPair(seqId, seq, hitSeqId, hitSeq, workPath):
     '''
-    aligns seq to hit.  trims aligned seq and hit seq.
-    returns: pairs of pairs of id and aligned trimmed sequences for sequences in hits,
-    and a predicate function that, given a divergence threshold, says if the divergence of the sequences exceeds the threshold.
-    e.g. ((seqId, alignedTrimmedSeq), (hitSeqId, alignedTrimmedHitSeq), divergencePredicateFunc)
+    aligns seq to hit.
+    returns: a pair of pairs of id and aligned sequence, e.g. ((seqId, alignedSeq), (hitSeqId, alignedHitSeq)).
+    The ids are parsed from the aligned fasta.
     '''
     # ALIGN SEQ and HIT
     # need to align the sequences so we'z can study the rate of evolution per site
     inputFasta = '>%s\n%s\n>%s\n%s\n'%(seqId, seq, hitSeqId, hitSeq)
-    if USE_CLUSTALW:
-        alignedFasta = alignFastaClustalw(inputFasta, workPath)
-    else:
-        alignedFasta = alignFastaKalign(inputFasta)
-        # try to recover from rare, intermittent failure of fasta alignment
+    def alignKalign():
+        alignedFasta = alignFastaKalign(inputFasta, toolTimeout(len(seq) + len(hitSeq)))
         if not alignedFasta:
-            logging.error('fasta alignment failed.\ninputFasta=%s\n' +
-                          'alignedFasta=%s\nSleep and retry alignment.',
-                          inputFasta, alignedFasta)
-            time.sleep(0.1)
-            alignedFasta = alignFastaKalign(inputFasta)
+            logging.error('fasta alignment failed.\ninputFasta=%s\nalignedFasta=%s\nRetrying alignment.', inputFasta, alignedFasta)
+            raise Exception(ALIGNMENT_ERROR_MSG, seqId, hitSeqId)
+        return alignedFasta
+    with STAGE_TIMER.timing('align', units=len(seq) + len(hitSeq)):
+        if USE_CLUSTALW:
+            alignedFasta = alignFastaClustalw(inputFasta, workPath, toolTimeout(len(seq) + len(hitSeq)))
+        else:
+            # try to recover from rare, intermittent failure of fasta alignment
+            alignedFasta = _retryTool(alignKalign, [], lambda e: e.args and e.args[0] == ALIGNMENT_ERROR_MSG)
     try:
         # parse the aligned fasta into sequence ids and sequences
         namelinesAndSeqs = list(fasta.readFasta(cStringIO.StringIO(alignedFasta)))
@@ -393,7 +828,29 @@ def getGoodDivergenceAlignedTrimmedSeqPair(seqId, seq, hitSeqId, hitSeq, workPat
     except Exception as e:
         e.args += (inputFasta, alignedFasta)
         raise
-    
+    return alignedIdAndSeq, alignedHitIdAndSeq
+
+
+def alignSeqPairBanded(seqId, seq, hitSeqId, hitSeq, hsp):
+    '''
+    aligns seq to hit in a band around the diagonals of hsp, the (qstart, qend, sstart, send) of the blast HSP of the
+    hit, where the query is seq.  See rsd.banded.
+    returns: a pair of pairs of id and aligned sequence, like alignSeqPair().
+    '''
+    with STAGE_TIMER.timing('align', units=len(seq) + len(hitSeq)):
+        alignedSeq, alignedHitSeq = banded.alignBanded(seq, hitSeq, *banded.bandForHsp(hsp, len(seq), len(hitSeq)))
+    return (seqId, alignedSeq), (hitSeqId, alignedHitSeq)
+
+
+def alignedSeqPairDivergences(alignedIdAndSeq, alignedHitIdAndSeq):
+    '''
+    alignedIdAndSeq, alignedHitIdAndSeq: pairs of id and aligned sequence, as returned by alignSeqPair().
+    Computes how much to trim from the ends of the aligned sequences and the values used to decide whether or not
+    the alignment is too diverged for a given divergence threshold.  See isTooDiverged().
+    returns: a tuple of (startTrim, endTrim, leastDivergence, trimDivergence).  An alignment is too diverged for divergence
+    threshold div if leastDivergence > div or trimDivergence >= div.  Either divergence is NEVER_TOO_DIVERGED (-inf) when
+    the corresponding rule does not apply to the alignment.
+    '''
     # CHECK FOR EXCESSIVE DIVERGENCE AND TRIMMING
     # find most diverged sequence
     # sort sequences by dash count.  why?
@@ -411,20 +868,170 @@ def getGoodDivergenceAlignedTrimmedSeqPair(seqId, seq, hitSeqId, hitSeq, workPat
     mostDivergedDashCount, mostDivergedDiv, mostDivergedId, mostDivergedSeq = divIdSeqs[1]
     # dashtrim = dashlen_check(mostDivergedSeq, divergence)
     startTrim, endTrim, trimDivergence = dashlen_check(mostDivergedSeq)
-    # logging.debug('dashtrim='+str(dashtrim))
-    # trim and add seqs to output
+    # Why this logic?  Ask Dennis.
+    leastDivergence = leastDivergedDiv if leastDivergedSeq else NEVER_TOO_DIVERGED
+    if not (startTrim or endTrim):
+        trimDivergence = NEVER_TOO_DIVERGED
+    return startTrim, endTrim, leastDivergence, trimDivergence
+
+
+def isTooDiverged(leastDivergence, trimDivergence, divergenceThreshold):
+    '''
+    leastDivergence, trimDivergence: see alignedSeqPairDivergences()
+    divergenceThreshold: a float.
+    returns: True if the alignment of the sequences is too diverged for divergenceThreshold.
+    '''
+    return leastDivergence > divergenceThreshold or trimDivergence >= divergenceThreshold
+
+
+def getGoodDivergenceAlignedTrimmedSeqPair(seqId, seq, hitSeqId, hitSeq, workPath):
+    '''
+    aligns seq to hit.  trims aligned seq and hit seq.
+    returns: pairs of pairs of id and aligned trimmed sequences for sequences in hits,
+    and a predicate function that, given a divergence threshold, says if the divergence of the sequences exceeds the threshold.
+    e.g. ((seqId, alignedTrimmedSeq), (hitSeqId, alignedTrimmedHitSeq), divergencePredicateFunc)
+    Kept for backwards compatibility.  computeOrthologs() uses alignHitData(), which does not create a closure for every pair.
+    '''
+    alignedIdAndSeq, alignedHitIdAndSeq = alignSeqPair(seqId, seq, hitSeqId, hitSeq, workPath)
+    startTrim, endTrim, leastDivergence, trimDivergence = alignedSeqPairDivergences(alignedIdAndSeq, alignedHitIdAndSeq)
     def divergencePredicate(divergenceThreshold):
-        '''Why this logic?  Ask Dennis.  Function closed over local variables that returns whether or not the alignment of the sequences is too diverged.'''
-        if leastDivergedSeq and leastDivergedDiv > divergenceThreshold:
-            return True
-        if (startTrim or endTrim) and trimDivergence >= divergenceThreshold:
-            return True
-        return False
-            
+        return isTooDiverged(leastDivergence, trimDivergence, float(divergenceThreshold))
     alignedTrimmedIdAndSeq, alignedTrimmedHitIdAndSeq = [(id, seq[startTrim:(len(seq)-endTrim)]) for id, seq in (alignedIdAndSeq, alignedHitIdAndSeq)]
     return alignedTrimmedIdAndSeq, alignedTrimmedHitIdAndSeq, divergencePredicate
 
 
+class HitData(object):
+    '''
+    A candidate hit of a sequence: the hit id, sequence, evalue and HSP, if any (see getHitHsp()), the aligned and
+    trimmed pair of sequences, the divergence values used to decide if the pair is too diverged, and the distance
+    between the pair.
+    Slots keep the millions of candidates made for a large genome compact.  The aligned sequences are dropped
+    once the distance is known.
+    '''
+    __slots__ = ('hitId', 'hitSeq', 'evalue', 'hsp', 'alignedSeq', 'alignedHitSeq', 'leastDivergence', 'trimDivergence', 'distance')
+
+    def __init__(self, hitId, hitSeq, evalue, hsp=None):
+        self.hitId = hitId
+        self.hitSeq = hitSeq
+        self.evalue = evalue
+        self.hsp = hsp
+        self.alignedSeq = None
+        self.alignedHitSeq = None
+        self.leastDivergence = None
+        self.trimDivergence = None
+        self.distance = None
+
+    def tooDiverged(self, div):
+        '''
+        div: a float divergence threshold.
+        '''
+        return self.leastDivergence > div or self.trimDivergence >= div
+
+    def __repr__(self):
+        return 'HitData({!r}, evalue={!r}, distance={!r})'.format(self.hitId, self.evalue, self.distance)
+
+
+def alignHitData(seqId, seq, hitData, workPath, hitSeqId=None):
+    '''
+    aligns seq to the hit sequence of hitData and trims the aligned pair.  If ALIGN_MODE is 'banded' and hitData has an
+    HSP, the pair is aligned around the HSP instead of with kalign.  See setAlignMode().
+    Sets the aligned sequences and divergences of hitData.  If the aligner times out, hitData is made too diverged for
+    every threshold, so the pair is dropped, and the pair is added to TIMEOUT_SUMMARY.
+    hitSeqId: the id to give the aligner for the hit.  Defaults to the id of hitData.
+    returns: the id of the hit, as parsed from the alignment, or None if the aligner timed out.
+    '''
+    hitSeqId = hitData.hitId if hitSeqId is None else hitSeqId
+    if ALIGN_MODE == BANDED_ALIGN_MODE and hitData.hsp:
+        alignedIdAndSeq, alignedHitIdAndSeq = alignSeqPairBanded(seqId, seq, hitSeqId, hitData.hitSeq, hitData.hsp)
+    else:
+        try:
+            alignedIdAndSeq, alignedHitIdAndSeq = alignSeqPair(seqId, seq, hitSeqId, hitData.hitSeq, workPath)
+        except util.CommandTimeout:
+            _recordTimeout('align', seqId, hitSeqId)
+            hitData.leastDivergence, hitData.trimDivergence = float('inf'), NEVER_TOO_DIVERGED
+            return None
+    startTrim, endTrim, hitData.leastDivergence, hitData.trimDivergence = alignedSeqPairDivergences(alignedIdAndSeq, alignedHitIdAndSeq)
+    alignedSeq = alignedIdAndSeq[1]
+    alignedHitSeq = alignedHitIdAndSeq[1]
+    hitData.alignedSeq = alignedSeq[startTrim:(len(alignedSeq)-endTrim)]
+    hitData.alignedHitSeq = alignedHitSeq[startTrim:(len(alignedHitSeq)-endTrim)]
+    return alignedIdAndSeq[0]
+
+
+def computeHitDataDistance(seqId, hitData, workPath, hitSeqId=None):
+    '''
+    computes the distance between seqId and the hit of hitData.  The aligned sequences of hitData are dropped once its
+    distance is known.
+    hitSeqId: the id to give codeml for the hit.  Defaults to the id of hitData.
+    returns: True if hitData has a distance, False if paml generated no rst data for it or timed out, in which case
+      the pair is added to TIMEOUT_SUMMARY.
+    '''
+    try:
+        hitSeqId = hitData.hitId if hitSeqId is None else hitSeqId
+        hitData.distance = getDistanceForAlignedSeqPair(seqId, hitData.alignedSeq, hitSeqId, hitData.alignedHitSeq, workPath)
+        return True
+    except util.CommandTimeout:
+        _recordTimeout('distance', seqId, hitSeqId)
+        return False
+    except Exception as e:
+        if e.args and e.args[0] == PAML_ERROR_MSG:
+            return False
+        else:
+            raise
+    finally:
+        hitData.alignedSeq = hitData.alignedHitSeq = None
+
+
+def computeReciprocalHitDataDistances(hitDatas, requiredId, thresholds, hasDistances, batchSize=1):
+    '''
+    Computes the distances of hitDatas for a reverse search, which finds an ortholog for a threshold only if the hit with
+    id requiredId, the query, is a minimum distance hit among the hitDatas passing the threshold.  The distance of
+    requiredId is computed first, and then the others in order, batchSize at a time, stopping once, for every threshold
+    requiredId passes, some hit passing the threshold is closer than requiredId.
+    thresholds: a list of (divEvalue, div, evalue) tuples, where div and evalue are floats.
+    hasDistances: a function that computes the distances of a list of hitDatas, e.g. concurrently, and returns a parallel
+      list of True for the hitDatas that have a distance and False for those for which paml generates no rst data.  See
+      computeHitDataDistance().
+    batchSize: the number of distances computed at once, e.g. the number of codeml calls that can run at once.
+    returns: a pair of the list of hitDatas that have a distance, or an empty list if requiredId can not be a minimum
+      distance hit for any threshold, and the number of distances skipped.  Either way, sweepMinimumDistanceHitDatas()
+      finds requiredId to be a minimum distance hit for the same thresholds as when every distance is computed.
+    '''
+    def passes(hitData, threshold):
+        divEvalue, div, evalue = threshold
+        return hitData.evalue < evalue and not hitData.tooDiverged(div)
+    requiredHitDatas = [hitData for hitData in hitDatas if hitData.hitId == requiredId]
+    required = [hitData for hitData, hasDistance in zip(requiredHitDatas, hasDistances(requiredHitDatas)) if hasDistance]
+    # the distance to beat for each threshold requiredId passes.
+    toBeat = {}
+    for i, threshold in enumerate(thresholds):
+        requiredDistances = [hitData.distance for hitData in required if passes(hitData, threshold)]
+        if requiredDistances:
+            toBeat[i] = min(requiredDistances)
+    others = [hitData for hitData in hitDatas if hitData.hitId != requiredId]
+    for start in range(0, len(others), batchSize):
+        if not toBeat:
+            for skipped in others[start:]:
+                skipped.alignedSeq = skipped.alignedHitSeq = None
+            return [], len(others) - start
+        batch = others[start:start + batchSize]
+        for hitData, hasDistance in zip(batch, hasDistances(batch)):
+            if hasDistance:
+                for i in [i for i in toBeat if hitData.distance < toBeat[i] and passes(hitData, thresholds[i])]:
+                    del toBeat[i]
+    if not toBeat:
+        return [], 0
+    return [hitData for hitData in hitDatas if hitData.distance is not None], 0
+
+
+def prepareDistanceDir(path):
+    '''
+    copies the codeml control file and the amino acid substitution matrix into path, so codeml can run in path.
+    '''
+    shutil.copy(MATRIX_PATH, path)
+    shutil.copy(CODEML_CONTROL_PATH, path)
+
+
 def minimumDicts(dicts, key):
     '''
     dicts: list of dictionaries.
@@ -448,14 +1055,11 @@ def computeOrthologs(queryFastaPath, subjectFastaPath, divEvalues, getForwardHit
     getReverseHits: a function mapping a subject seq id to a list of query genome blast hits.  see makeGetSavedHits() and makeGetHitsOnTheFly().
     querySeqIds: a list of sequence ids for the query genome.  orthologs are only computed for those sequences.
       If False, orthologs are computed for every sequence in the query genome.
-    workingDir: under workingDir, a temp directory is created, worked in (files and dirs created and deleted), and removed.
+    workingDir: unused.  Temporary files are written to dirs recycled from nested.getDefaultScratchPool().
     returns: a mapping from (div, evalue) tuples to lists of orthologs.
     '''
-    # optimization: internally swap query and subject if subject has fewer sequences than query and no querySeqIds were given.
-    #   compute orthologs and unswap results.
-    #   roundup time complexity is roughly linear in the number of sequences in the query genome.
-    genomeSwapOptimization = True
-    if not querySeqIds and genomeSwapOptimization and fasta.numSeqsInFastaDb(subjectFastaPath) < fasta.numSeqsInFastaDb(queryFastaPath):
+    maxEvalue = max(float(evalue) for div, evalue in divEvalues)
+    if shouldSwapGenomes(queryFastaPath, subjectFastaPath, querySeqIds, getForwardHits=getForwardHits, getReverseHits=getReverseHits, evalue=maxEvalue):
         # print 'roundup(): subject genome has fewer sequences than query genome.  internally swapping query and subject to improve speed.'
         isSwapped = True
         # swap query and subject, forward and reverse
@@ -464,30 +1068,277 @@ def computeOrthologs(queryFastaPath, subjectFastaPath, divEvalues, getForwardHit
     else:
         isSwapped = False
 
-    # make functions to look up a sequence from a sequence id.
-    getQuerySeqFunc = makeGetSeqForId(queryFastaPath)
-    getSubjectSeqFunc = makeGetSeqForId(subjectFastaPath)
+    # sequences are numbered by the id tables of the genomes and handled as numbers, restoring ids for the orthologs.
+    queryTable = idtable.loadIdTable(queryFastaPath)
+    subjectTable = idtable.loadIdTable(subjectFastaPath)
+    # make functions to look up a sequence from a sequence number.
+    getQuerySeqFunc = makeGetSeqForNum(queryFastaPath)
+    getSubjectSeqFunc = makeGetSeqForNum(subjectFastaPath)
 
     # if no querySeqIds were specified, get orthologs for every query sequence
-    if not querySeqIds:
-        querySeqIds = list(fasta.readIds(queryFastaPath))
+    if querySeqIds:
+        queryNums = [queryTable.num(seqId) for seqId in querySeqIds]
+    else:
+        queryNums = range(len(queryTable))
+        querySeqIds = queryTable.ids
+
+    prefetchHits(querySeqIds, lambda seqId: getQuerySeqFunc(queryTable.num(seqId)), lambda seqId: getSubjectSeqFunc(subjectTable.num(seqId)),
+                 getForwardHits, getReverseHits, max(float(evalue) for div, evalue in divEvalues))
         
+    costs = None
+    if LONGEST_FIRST:
+        maxEvalue = max(float(evalue) for div, evalue in divEvalues)
+        idCosts = estimateQueryCosts(querySeqIds, loadSeqLengths(queryFastaPath), loadSeqLengths(subjectFastaPath),
+                                     getattr(getForwardHits, 'hitsDb', None), maxEvalue)
+        costs = dict((queryTable.num(seqId), cost) for seqId, cost in idCosts.iteritems())
+
     # get orthologs for every (div, evalue) combination
-    with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
-        divEvalueToOrthologs = _computeOrthologsSub(querySeqIds, getQuerySeqFunc, getSubjectSeqFunc, divEvalues, getForwardHits, getReverseHits, workingDir)
+    divEvalueToOrthologs = _computeOrthologsSub(queryNums, getQuerySeqFunc, getSubjectSeqFunc, divEvalues,
+                                                numberHitsFunc(getForwardHits, queryTable, subjectTable),
+                                                numberHitsFunc(getReverseHits, subjectTable, queryTable), workingDir,
+                                                queryTable.seqId, subjectTable.seqId, costs)
+    for orthologs in divEvalueToOrthologs.values():
+        orthologs[:] = [(queryTable.seqId(queryNum), subjectTable.seqId(subjectNum), distance) for queryNum, subjectNum, distance in orthologs]
 
     # if swapped query and subject genome, need to swap back the ids in orthologs before returning them.
     if isSwapped:
-        swappedDivEvalueToOrthologs = divEvalueToOrthologs
-        divEvalueToOrthologs = {}
-        for divEvalue, swappedOrthologs in swappedDivEvalueToOrthologs.items():
-            orthologs = [(query, subject, distance) for subject, query, distance in swappedOrthologs]
-            divEvalueToOrthologs[divEvalue] = orthologs
+        divEvalueToOrthologs = swapDivEvalueToOrthologs(divEvalueToOrthologs)
 
     return divEvalueToOrthologs
 
+
+def numberHitsFunc(getHits, table, hitTable):
+    '''
+    getHits: a function from a seq id and sequence to the hits of the sequence, e.g. from makeGetSavedHits().
+    table, hitTable: the id tables of the genome of the sequences and of the genome of the hits.
+    returns: a function from the number of a sequence in table and the sequence to its hits, with the id of each hit
+      replaced by its number in hitTable.
+    '''
+    def getHitsForNum(num, seq):
+        hits = getHits(table.seqId(num), seq)
+        return hits and [(hitTable.num(getHitId(hit)),) + tuple(hit[1:]) for hit in hits]
+    return getHitsForNum
+
+
+def computeOrthologsForChunk(queryFastaPath, subjectFastaPath, divEvalues, getForwardHits, getReverseHits, chunkIds, isSwapped, workingDir='.'):
+    '''
+    Computes orthologs for a chunk of the sequences a full run of computeOrthologs() would iterate over, for splitting a
+    run into pieces.  Since querySeqIds disables the genome swap optimization of computeOrthologs(), the swap decided
+    for the full run (see shouldSwapGenomes()) is applied here.
+    chunkIds: sequence ids of the query genome, or of the subject genome if isSwapped.
+    isSwapped: True if the full run swaps query and subject genomes.
+    returns: a mapping from (div, evalue) tuples to lists of orthologs, as (query id, subject id, distance).
+    '''
+    if isSwapped:
+        return swapDivEvalueToOrthologs(computeOrthologs(subjectFastaPath, queryFastaPath, divEvalues, getReverseHits, getForwardHits, chunkIds, workingDir))
+    else:
+        return computeOrthologs(queryFastaPath, subjectFastaPath, divEvalues, getForwardHits, getReverseHits, chunkIds, workingDir)
+
+
+def shouldSwapGenomes(queryFastaPath, subjectFastaPath, querySeqIds=None, forwardHits=None, reverseHits=None,
+                      getForwardHits=None, getReverseHits=None, evalue=float('inf')):
+    '''
+    optimization: internally swap query and subject if that is cheaper and no querySeqIds were given.
+      compute orthologs and unswap results.
+    forwardHits, reverseHits: optional mappings from query (subject) seq ids to their blast hits in the subject (query)
+      genome, e.g. from loadBlastHits().  Default to the hits of getForwardHits and getReverseHits, if they read saved
+      hits (see makeGetSavedHits()).
+    getForwardHits, getReverseHits: functions that take a seq id and a seq and return its hits, used to look up the hits
+      of a sample of sequences when the hits are not saved, e.g. from makeGetHitsOnTheFly() or makeGetCachedHits().
+    evalue: the loosest evalue threshold of the run, a float.  Only hits below it count.
+    Every way of running, with saved, cached or on-the-fly hits, whole or split into shards or queue chunks, makes the
+    same decision: the cheaper direction of plan.planRun(), which rsd_search --plan reports.  The work of each direction
+    is estimated from the hits of every sequence if they are saved, and otherwise from the hits of a sample of
+    SWAP_SAMPLE_SIZE sequences, the same sample for every process, and priced with SECONDS_PER_UNIT.
+    returns: True if computing orthologs with query and subject swapped would be faster.
+    '''
+    genomeSwapOptimization = True
+    if querySeqIds or not genomeSwapOptimization:
+        return False
+    if forwardHits is None:
+        forwardHits = getattr(getForwardHits, 'hitsDb', None)
+    if reverseHits is None:
+        reverseHits = getattr(getReverseHits, 'hitsDb', None)
+    hitsMode = plan.HITS_ON_THE_FLY if forwardHits is None or reverseHits is None else plan.HITS_SAVED
+    return plan.planRun(queryFastaPath, subjectFastaPath, evalue, hitsMode, forwardHits, reverseHits, getForwardHits,
+                        getReverseHits)['direction'] == 'swapped'
+
+
+def estimateOrthologsWork(seqIds, seqLengths, hitSeqLengths, forwardHits, reverseHits, evalue=float('inf')):
+    '''
+    seqIds: the query sequence ids to estimate the work of.
+    seqLengths, hitSeqLengths: dicts from the ids of the query and subject genomes to sequence lengths.
+    forwardHits, reverseHits: mappings from query (subject) seq ids to their blast hits in the subject (query) genome.
+    evalue: a float.  Only hits below evalue count.
+    Estimates the work _computeOrthologsSub() does for seqIds without aligning anything.  Every good evalue forward hit
+    is aligned and, unless too diverged, run through codeml, so those counts are upper bounds.  The reverse hits of the
+    best evalue forward hit are counted as the reverse search, since that hit is usually the minimum distance hit.
+    returns: a dict of counts: 'queries', 'queryResidues', 'hitLookups', 'alignments', 'distances', 'alignResidues'
+      (residues of both sequences of every alignment) and 'distanceResidues' (the length of the longer sequence of every
+      distance).
+    '''
+    work = dict.fromkeys(['queries', 'queryResidues', 'hitLookups', 'alignments', 'distances', 'alignResidues', 'distanceResidues'], 0)
+    def addPairs(seqLength, hitIdsAndEvalues, lengths):
+        for hitId, hitEvalue in hitIdsAndEvalues:
+            hitLength = lengths.get(hitId, 0)
+            work['alignments'] += 1
+            work['distances'] += 1
+            work['alignResidues'] += seqLength + hitLength
+            work['distanceResidues'] += max(seqLength, hitLength)
+    for seqId in seqIds:
+        work['queries'] += 1
+        work['hitLookups'] += 1
+        seqLength = seqLengths.get(seqId, 0)
+        work['queryResidues'] += seqLength
+        hits = filterEvalueHits(forwardHits.get(seqId), evalue)
+        addPairs(seqLength, hits, hitSeqLengths)
+        if hits:
+            bestHitId = hits[0][0]
+            work['hitLookups'] += 1
+            revHits = filterEvalueHits(reverseHits.get(bestHitId), evalue)
+            if seqId in set(revHitId for revHitId, revHitEvalue in revHits):
+                addPairs(hitSeqLengths.get(bestHitId, 0), revHits, seqLengths)
+    return work
+
+
+def loadSeqLengths(fastaPath):
+    '''
+    returns: a dict from every seq id of fastaPath to the length of its sequence.  Lengths are cached, like id tables
+      (see idtable.loadIdTable()), so a process computing many chunks or shards of a run reads each genome once, and
+      every caller gets the same dict, which must not be modified, until fastaPath changes.
+    '''
+    key = (fastaPath, os.path.getmtime(fastaPath))
+    with _seqLengthsLock:
+        if key not in _seqLengths:
+            for oldKey in [oldKey for oldKey in _seqLengths if oldKey[0] == fastaPath]:
+                del _seqLengths[oldKey]
+            _seqLengths[key] = fasta.readSeqLengths(fastaPath)
+        return _seqLengths[key]
+
+
+def estimateQueryCosts(seqIds, seqLengths, hitSeqLengths, forwardHits=None, evalue=float('inf')):
+    '''
+    seqIds: the query sequence ids to estimate the cost of.
+    seqLengths, hitSeqLengths: dicts from the ids of the query and subject genomes to sequence lengths.
+    forwardHits: an optional mapping from query seq ids to their blast hits in the subject genome, e.g. a hits store.
+    evalue: a float.  Only hits below evalue count.
+    Alignment and codeml time grow with the lengths of both sequences, so the cost of a query is its length times the
+    total length of its good forward hits.  Without saved hits, its hits are assumed to be as long as the query.
+    returns: a dict from each seq id to its estimated cost, a relative number.
+    '''
+    costs = {}
+    for seqId in seqIds:
+        seqLength = seqLengths.get(seqId, 0)
+        if forwardHits is None:
+            costs[seqId] = seqLength * seqLength
+        else:
+            costs[seqId] = seqLength * sum(hitSeqLengths.get(hitId, 0) for hitId, hitEvalue in filterEvalueHits(forwardHits.get(seqId), evalue))
+    return costs
+
+
+def latencySummary(latencies, tailSeconds):
+    '''
+    latencies: the seconds each query spent in the pipeline, from its first stage starting to its last stage finishing.
+    tailSeconds: the seconds from the last query starting to the run finishing, during which workers run out of work.
+    returns: a dict of the number of 'queries', the 'p50', 'p95' and 'max' latency, and the 'tail' seconds.
+    '''
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+    return {'queries': len(latencies), 'p50': percentile(0.5), 'p95': percentile(0.95), 'max': percentile(1.0), 'tail': tailSeconds}
+
+
+def swapDivEvalueToOrthologs(divEvalueToOrthologs):
+    '''
+    returns: a mapping from (div, evalue) to orthologs with the query and subject ids of every ortholog swapped.
+      Used to unswap the orthologs computed with query and subject genomes swapped.
+    '''
+    return dict((divEvalue, [(query, subject, distance) for subject, query, distance in swappedOrthologs])
+                for divEvalue, swappedOrthologs in divEvalueToOrthologs.items())
+
     
-def _computeOrthologsSub(querySeqIds, getQuerySeqFunc, getSubjectSeqFunc, divEvalues, getForwardHits, getReverseHits, workingDir):
+def sweepMinimumDistanceHitDatas(hitDatas, thresholds):
+    '''
+    hitDatas: a list of HitData, with distances.
+    thresholds: a list of (divEvalue, div, evalue) tuples, where div and evalue are floats.
+    For every threshold, finds the hitDatas which pass the threshold (hitData.evalue < evalue and not hitData.tooDiverged(div))
+    and have the minimum distance among those passing hitDatas.  Rather than filtering hitDatas for every threshold, the
+    thresholds are swept in order of increasing evalue and divergence, adding hitDatas to the running minimum as the
+    thresholds loosen, so the cost grows with the number of thresholds plus candidates instead of their product.
+    This is important when computing orthologs for a dense grid of divergence and evalue thresholds.
+    returns: a list, parallel to thresholds, of lists of minimum distance hitDatas, in their original order.
+    '''
+    results = [None] * len(thresholds)
+    # group thresholds by evalue.  every hit passing a smaller evalue passes a larger one.
+    evalueToThresholdIndices = {}
+    for i, (divEvalue, div, evalue) in enumerate(thresholds):
+        evalueToThresholdIndices.setdefault(evalue, []).append(i)
+    # sort hits by the smallest divergence threshold they pass.  a hit passes div if div >= leastDivergence and div > trimDivergence.
+    # if a hit passes div, so does every hit before it in this order.
+    def divergenceKey(indexAndHitData):
+        hitData = indexAndHitData[1]
+        return (max(hitData.leastDivergence, hitData.trimDivergence), hitData.trimDivergence >= hitData.leastDivergence)
+    byEvalue = sorted(enumerate(hitDatas), key=lambda indexAndHitData: indexAndHitData[1].evalue)
+    numEligible = 0
+    for evalue in sorted(evalueToThresholdIndices):
+        # hits passing this evalue, sorted by divergence
+        while numEligible < len(byEvalue) and byEvalue[numEligible][1].evalue < evalue:
+            numEligible += 1
+        eligible = sorted(byEvalue[:numEligible], key=divergenceKey)
+        indices = sorted(evalueToThresholdIndices[evalue], key=lambda i: thresholds[i][1])
+        numPassing = 0
+        minDistance = None
+        minimums = []
+        for i in indices:
+            div = thresholds[i][1]
+            while numPassing < len(eligible) and not eligible[numPassing][1].tooDiverged(div):
+                index, hitData = eligible[numPassing]
+                numPassing += 1
+                if minDistance is None or hitData.distance < minDistance:
+                    minDistance = hitData.distance
+                    minimums = [(index, hitData)]
+                elif hitData.distance == minDistance:
+                    minimums.append((index, hitData))
+            results[i] = [hitData for index, hitData in sorted(minimums)]
+    return results
+
+
+class _QuerySearch(object):
+    '''
+    The state of the search for the orthologs of one query sequence, as it passes through the stages of the pipeline in
+    _computeOrthologsSub().  Fields are dropped once the later stages no longer need them.
+    '''
+    __slots__ = ('queryId', 'rank', 'started', 'finished', 'querySeq', 'hits', 'hitDatas', 'reverseSearches', 'orthologs')
+
+    def __init__(self, queryId, rank=0):
+        self.queryId = queryId
+        self.rank = rank
+        self.started = self.finished = None
+        self.querySeq = None
+        self.hits = None
+        self.hitDatas = None
+        self.reverseSearches = None
+        self.orthologs = None
+
+
+class _ReverseSearch(object):
+    '''
+    The reverse search from a minimum distance hit of a query: the hit, the thresholds for which it is a minimum hit,
+    the loosest evalue and divergence among them, and the reverse hits.
+    '''
+    __slots__ = ('hitData', 'thresholds', 'evalue', 'div', 'hits', 'revHitDatas')
+
+    def __init__(self, hitData, thresholds):
+        self.hitData = hitData
+        self.thresholds = thresholds
+        self.evalue = max(evalue for divEvalue, div, evalue in thresholds)
+        self.div = max(div for divEvalue, div, evalue in thresholds)
+        self.hits = None
+        self.revHitDatas = None
+
+
+def _computeOrthologsSub(querySeqIds, getQuerySeqFunc, getSubjectSeqFunc, divEvalues, getForwardHits, getReverseHits, workingDir,
+                         getQueryName=None, getSubjectName=None, costs=None):
     '''
     querySeqIds: a list of sequence ids from query genome.  Only orthologs for these ids are searched for.
     getQuerySeqFunc: a function that takes a seq id and returns the matching sequence from the query genome.
@@ -496,115 +1347,170 @@ def _computeOrthologsSub(querySeqIds, getQuerySeqFunc, getSubjectSeqFunc, divEva
       div can be a float or string.  So can evalue.
     getForwardHits: a function that takes a query seq id and a query seq and returns the blast hits in the subject genome.
     getReverseHits: a function that takes a subject seq id and a subject seq and returns the blast hits in the query genome.
+    workingDir: unused.  Alignment and codeml files are written to dirs from nested.getDefaultScratchPool().
+    getQueryName, getSubjectName: optional functions from the seq ids of each genome to the ids given to the aligner and
+      codeml, e.g. when the seq ids are numbers from id tables.  Default: the seq ids.
+    costs: an optional dict from query seq ids to estimated costs (see estimateQueryCosts()).  If given, queries enter the
+      pipeline costliest first and are collected as they finish, so the longest queries do not finish last while the
+      other workers idle.  The orthologs are in the same order either way.
     find orthologs for every sequence in querySeqIds and every (div, evalue) combination.
+    Each query flows through a pipeline of stages (see rsd.pipeline): forward hits, hit sequences, alignment and trimming,
+    distances, minimum distance hits, then the same stages for the reverse hits of each minimum hit, and finally the
+    reciprocal decision.  The stages overlap, each run by STAGE_WORKERS threads, the alignments and distances of the hits
+    of each query run concurrently, and orthologs are found in the same order as if the queries were processed one at a
+    time.
     return: a mapping from (div, evalue) pairs to lists of orthologs.
     '''
-    # Note: the divs and evalues in divEvalues are strings which need to be converted to floats at the appropriate times below.
-    
-    # copy config files to working dir
-    shutil.copy(MATRIX_PATH, workingDir)
-    shutil.copy(CODEML_CONTROL_PATH, workingDir)
-
     divEvalueToOrthologs = dict(((div, evalue), list()) for div, evalue in divEvalues)
-    maxEvalue = max(float(evalue) for div, evalue in divEvalues)
-    maxDiv = max(float(div) for div, evalue in divEvalues)
+    # the divs and evalues in divEvalues can be strings, so parse them once.
+    thresholds = [((div, evalue), float(div), float(evalue)) for div, evalue in divEvalues]
+    maxEvalue = max(evalue for divEvalue, div, evalue in thresholds)
+    maxDiv = max(div for divEvalue, div, evalue in thresholds)
+
+    getQueryName = getQueryName or (lambda seqId: seqId)
+    getSubjectName = getSubjectName or (lambda seqId: seqId)
+
+    # every alignment and distance call holds a dir while it runs, and hit lookups borrow dirs from the same pool.
+    scratchPool = nested.getDefaultScratchPool()
+    scratchPool.grow(STAGE_WORKERS['hits'] + STAGE_WORKERS['align'] + STAGE_WORKERS['distance'])
+    # the forward and reverse stages of each tool share its pool of runner threads, so at most STAGE_WORKERS[tool] calls
+    # of the tool run at once, across every query and hit.
+    with toolrunner.ToolRunner({'align': STAGE_WORKERS['align'], 'distance': STAGE_WORKERS['distance']}) as runner, \
+            toolrunner.WorkDirs(scratchPool, limit=STAGE_WORKERS['align']) as alignDirs, \
+            toolrunner.WorkDirs(scratchPool, prepareDistanceDir, limit=STAGE_WORKERS['distance']) as distanceDirs:
+
+        def alignOne(seqName, seq, hitData, hitName):
+            with alignDirs.dir() as workPath:
+                alignHitData(seqName, seq, hitData, workPath, hitName)
+
+        def distanceOne(seqName, hitData, hitName):
+            with distanceDirs.dir() as workPath:
+                return computeHitDataDistance(seqName, hitData, workPath, hitName)
+
+        def align(seqName, seq, hitDatas, div, getHitName):
+            '''
+            aligns every hit concurrently.
+            returns: the hitDatas whose alignment to seq is not too diverged for div.
+            '''
+            runner.map('align', alignOne, [(seqName, seq, hitData, getHitName(hitData.hitId)) for hitData in hitDatas])
+            return [hitData for hitData in hitDatas if not hitData.tooDiverged(div)]
+
+        def distances(seqName, hitDatas, getHitName, requiredId=None, thresholds=None):
+            '''
+            computes the distances of the hits concurrently.
+            requiredId: if given and PRUNE_DISTANCES, the id of the query of a reverse search, and thresholds the thresholds
+              of the reverse search, with which distances are pruned by computeReciprocalHitDataDistances().
+            returns: the hitDatas that have a distance, discarding hits for which paml generates no rst data.
+            '''
+            def hasDistances(someHitDatas):
+                return runner.map('distance', distanceOne, [(seqName, hitData, getHitName(hitData.hitId)) for hitData in someHitDatas])
+            if requiredId is None or not PRUNE_DISTANCES:
+                return [hitData for hitData, hasDistance in zip(hitDatas, hasDistances(hitDatas)) if hasDistance]
+            hitDatas, numSkipped = computeReciprocalHitDataDistances(hitDatas, requiredId, thresholds, hasDistances, STAGE_WORKERS['distance'])
+            with _summaryLock:
+                PRUNE_SUMMARY['distances'] += numSkipped
+            return hitDatas
 
-    # get ortholog(s) for each query sequence
-    for queryId in querySeqIds:
-        querySeq = getQuerySeqFunc(queryId)
         # get forward hits, evalues, alignments, divergences, and distances that meet the loosest standards of all the divs and evalues.
-        # get forward hits and evalues, filtered by max evalue
-        idSeqEvalueOfForwardHits = getGoodEvalueHits(queryId, querySeq, getForwardHits, getSubjectSeqFunc, maxEvalue)
-        hitDataList = [{'hitId': hitId, 'hitSeq': hitSeq, 'hitEvalue': hitEvalue} for hitId, hitSeq, hitEvalue in idSeqEvalueOfForwardHits]
-        # get alignments and divergences
-        for hitData in hitDataList:
-            (queryId, alignedQuerySeq), (hitId, alignedHitSeq), tooDivergedPred = getGoodDivergenceAlignedTrimmedSeqPair(queryId, querySeq, hitData['hitId'], hitData['hitSeq'], workingDir)
-            hitData['alignedQuerySeq'] = alignedQuerySeq
-            hitData['alignedHitSeq'] = alignedHitSeq
-            hitData['tooDivergedPred'] = tooDivergedPred
-        # filter by max divergence.
-        hitDataList = [hitData for hitData in hitDataList if not hitData['tooDivergedPred'](maxDiv)]
-        # get distances of remaining hits, discarding hits for which paml generates no rst data.
-        distancesHitDataList = []
-        for hitData in hitDataList:
-            try:
-                hitData['distance'] = getDistanceForAlignedSeqPair(queryId, hitData['alignedQuerySeq'], hitData['hitId'], hitData['alignedHitSeq'], workingDir)
-                distancesHitDataList.append(hitData)
-            except Exception as e:
-                if e.args and e.args[0] == PAML_ERROR_MSG:
-                    continue
+        def forwardHits(search):
+            search.started = time.time()
+            search.querySeq = getQuerySeqFunc(search.queryId)
+            search.hits = getForwardHits(search.queryId, search.querySeq)
+            return search
+
+        def forwardSeqs(search):
+            search.hitDatas = [HitData(getHitId(hit), getSubjectSeqFunc(getHitId(hit)), getHitEvalue(hit), getHitHsp(hit))
+                               for hit in filterGoodHits(search.hits, maxEvalue)]
+            search.hits = None
+            return search
+
+        def forwardAlign(search):
+            search.hitDatas = align(getQueryName(search.queryId), search.querySeq, search.hitDatas, maxDiv, getSubjectName)
+            return search
+
+        def forwardDistances(search):
+            search.hitDatas = distances(getQueryName(search.queryId), search.hitDatas, getSubjectName)
+            return search
+
+        def minimumHits(search):
+            # filter hits by specific div and evalue combinations.
+            minimumHitIdToThresholds = {}
+            minimumHitIdToHitData = {}
+            for threshold, minimumHitDatas in zip(thresholds, sweepMinimumDistanceHitDatas(search.hitDatas, thresholds)):
+                for hitData in minimumHitDatas:
+                    minimumHitIdToThresholds.setdefault(hitData.hitId, []).append(threshold)
+                    minimumHitIdToHitData[hitData.hitId] = hitData # possibly redundant, since if two divEvalues have same minimum hit, it gets inserted into dict twice.
+            # since a minimum hit might not be associated with all divs and evalues, each reverse search uses the loosest div and evalue associated with its minimum hit.
+            search.reverseSearches = [_ReverseSearch(minimumHitIdToHitData[hitId], minimumHitIdToThresholds[hitId]) for hitId in minimumHitIdToHitData]
+            search.querySeq = search.hitDatas = None
+            return search
+
+        # get reverese hits that meet the loosest standards of the divs and evalues associated with each minimum distance hit.
+        def reverseHits(search):
+            for reverse in search.reverseSearches:
+                reverse.hits = getReverseHits(reverse.hitData.hitId, reverse.hitData.hitSeq)
+            return search
+
+        def reverseSeqs(search):
+            for reverse in search.reverseSearches:
+                revHits = filterGoodHits(reverse.hits, reverse.evalue)
+                # if the query is not in the reverese hits, there is no way we can find an ortholog
+                if search.queryId in set(getHitId(revHit) for revHit in revHits):
+                    reverse.revHitDatas = [HitData(getHitId(revHit), getQuerySeqFunc(getHitId(revHit)), getHitEvalue(revHit), getHitHsp(revHit))
+                                           for revHit in revHits]
                 else:
-                    raise
-                
-        # filter hits by specific div and evalue combinations.
-        divEvalueToMinimumDistanceHitDatas = {}
-        minimumHitIdToDivEvalues = {}
-        minimumHitIdToHitData = {}
-        for divEvalue in divEvalues:
-            div, evalue = divEvalue
-            # collect hit datas that pass thresholds.
-            goodHitDatas = []
-            for hitData in distancesHitDataList:
-                if hitData['hitEvalue'] < float(evalue) and not hitData['tooDivergedPred'](float(div)):
-                    goodHitDatas.append(hitData)
-            # get the minimum hit or hits.
-            minimumHitDatas = minimumDicts(goodHitDatas, 'distance')
-            divEvalueToMinimumDistanceHitDatas[divEvalue] = minimumHitDatas
-            for hitData in minimumHitDatas:
-                minimumHitIdToDivEvalues.setdefault(hitData['hitId'], []).append(divEvalue)
-                minimumHitIdToHitData[hitData['hitId']] = hitData # possibly redundant, since if two divEvalues have same minimum hit, it gets inserted into dict twice.  
-        
-        # get reverese hits that meet the loosest standards of the divs and evalues associated with that minimum distance hit.
-        # performance note: wasteful or necessary to realign and compute distance between minimum hit and query seq?
-        for hitId in minimumHitIdToHitData:
-            hitData = minimumHitIdToHitData[hitId]
-            hitSeq = hitData['hitSeq']
-            # since minimum hit might not be associated with all divs and evalues, need to find the loosest div and evalue associated with this minimum hit.
-            maxHitEvalue = max(float(evalue) for div, evalue in minimumHitIdToDivEvalues[hitId])
-            maxHitDiv = max(float(div) for div, evalue in minimumHitIdToDivEvalues[hitId])
-            # get reverse hits and evalues, filtered by max evalue
-            idSeqEvalueOfReverseHits = getGoodEvalueHits(hitId, hitSeq, getReverseHits, getQuerySeqFunc, maxHitEvalue)
-            revHitDataList = [{'revHitId': revHitId, 'revHitSeq': revHitSeq, 'revHitEvalue': revHitEvalue} for revHitId, revHitSeq, revHitEvalue in idSeqEvalueOfReverseHits]
-            # if the query is not in the reverese hits, there is no way we can find an ortholog
-            if queryId not in [revHitData['revHitId'] for revHitData in revHitDataList]:
-                continue
-            for revHitData in revHitDataList:
-                values = getGoodDivergenceAlignedTrimmedSeqPair(hitId, hitSeq, revHitData['revHitId'], revHitData['revHitSeq'], workingDir)
-                (hitId, alignedHitSeq), (revHitId, alignedRevHitSeq), tooDivergedPred = values
-                revHitData['alignedHitSeq'] = alignedHitSeq
-                revHitData['alignedRevHitSeq'] = alignedRevHitSeq
-                revHitData['tooDivergedPred'] = tooDivergedPred
-            # filter by max divergence.
-            revHitDataList = [revHitData for revHitData in revHitDataList if not revHitData['tooDivergedPred'](maxHitDiv)]
-            # if the query is not in the reverese hits, there is no way we can find an ortholog
-            if queryId not in [revHitData['revHitId'] for revHitData in revHitDataList]:
-                continue
-            # get distances of remaining reverse hits, discarding reverse hits for which paml generates no rst data.
-            distancesRevHitDataList = []
-            for revHitData in revHitDataList:
-                try:
-                    revHitData['distance'] = getDistanceForAlignedSeqPair(hitId, revHitData['alignedHitSeq'], revHitData['revHitId'], revHitData['alignedRevHitSeq'], workingDir)
-                    distancesRevHitDataList.append(revHitData)
-                except Exception as e:
-                    if e.args and e.args[0] == PAML_ERROR_MSG:
-                        continue
-                    else:
-                        raise
-
-
+                    reverse.revHitDatas = []
+                reverse.hits = None
+            return search
+
+        def reverseAlign(search):
+            for reverse in search.reverseSearches:
+                reverse.revHitDatas = align(getSubjectName(reverse.hitData.hitId), reverse.hitData.hitSeq, reverse.revHitDatas, reverse.div, getQueryName)
+                # if the query is not in the reverese hits, there is no way we can find an ortholog
+                if search.queryId not in set(revHitData.hitId for revHitData in reverse.revHitDatas):
+                    reverse.revHitDatas = []
+            return search
+
+        def reverseDistances(search):
+            for reverse in search.reverseSearches:
+                reverse.revHitDatas = distances(getSubjectName(reverse.hitData.hitId), reverse.revHitDatas, getQueryName,
+                                                search.queryId, reverse.thresholds)
+            return search
+
+        def reciprocity(search):
             # if passes div and evalue thresholds of the minimum hit and minimum reverse hit == query, write ortholog.
-            # filter hits by specific div and evalue combinations.
-            for divEvalue in minimumHitIdToDivEvalues[hitId]:
-                div, evalue = divEvalue
-                # collect hit datas that pass thresholds.
-                goodRevHitDatas = []
-                for revHitData in distancesRevHitDataList:
-                    if revHitData['revHitEvalue'] < float(evalue) and not revHitData['tooDivergedPred'](float(div)):
-                        goodRevHitDatas.append(revHitData)
-                # get the minimum hit or hits.
-                minimumRevHitDatas = minimumDicts(goodRevHitDatas, 'distance')
-                if queryId in [revHitData['revHitId'] for revHitData in minimumRevHitDatas]:
-                    divEvalueToOrthologs[divEvalue].append((queryId, hitId, hitData['distance']))
+            search.orthologs = []
+            search.finished = time.time()
+            for reverse in search.reverseSearches:
+                for (divEvalue, div, evalue), minimumRevHitDatas in zip(reverse.thresholds, sweepMinimumDistanceHitDatas(reverse.revHitDatas, reverse.thresholds)):
+                    if search.queryId in set(revHitData.hitId for revHitData in minimumRevHitDatas):
+                        search.orthologs.append((divEvalue, (search.queryId, reverse.hitData.hitId, reverse.hitData.distance)))
+            search.reverseSearches = None
+            return search
+
+        # the forward and reverse stages of each kind share a limit on the number of calls running at once.  The align and
+        # distance stages are limited by the runner instead, since each of their calls runs a tool call per hit.
+        semaphores = dict((kind, threading.BoundedSemaphore(workers)) for kind, workers in STAGE_WORKERS.items() if kind not in runner.limits)
+        def stage(kind, func):
+            return pipeline.Stage(func.__name__, func, STAGE_WORKERS[kind], semaphores.get(kind))
+        stages = [stage('hits', forwardHits), stage('seqs', forwardSeqs), stage('align', forwardAlign), stage('distance', forwardDistances),
+                  stage('reciprocity', minimumHits), stage('hits', reverseHits), stage('seqs', reverseSeqs), stage('align', reverseAlign),
+                  stage('distance', reverseDistances), stage('reciprocity', reciprocity)]
+        searches = [_QuerySearch(queryId, rank) for rank, queryId in enumerate(querySeqIds)]
+        if costs:
+            # longest processing time first.  sorted() is stable, so queries of equal cost keep their order.
+            searches.sort(key=lambda search: -costs.get(search.queryId, 0))
+        finished = [None] * len(searches)
+        for search in pipeline.Pipeline(stages, PIPELINE_QUEUE_SIZE).run(searches, ordered=not costs):
+            finished[search.rank] = search
+        if searches:
+            tail = max(search.finished for search in searches) - max(search.started for search in searches)
+            with _summaryLock:
+                _runLatencies.extend(search.finished - search.started for search in searches)
+                LATENCY_SUMMARY.update(latencySummary(_runLatencies, max(tail, LATENCY_SUMMARY.get('tail', 0.0))))
+        for search in finished:
+            for divEvalue, ortholog in search.orthologs:
+                divEvalueToOrthologs[divEvalue].append(ortholog)
 
     return divEvalueToOrthologs
 
@@ -635,6 +1541,22 @@ def computeOrthologsUsingSavedHits(queryFastaPath, subjectFastaPath, divEvalues,
     getReverseHits = makeGetSavedHits(reverseHitsPath)
     divEvalueToOrthologs = computeOrthologs(queryFastaPath, subjectFastaPath, divEvalues, getForwardHits, getReverseHits, querySeqIds, workingDir)
     return divEvalueToOrthologs
+
+
+def computeOrthologsUsingCachedHits(queryFastaPath, subjectFastaPath, divEvalues, cacheDir, querySeqIds=None, workingDir='.'):
+    '''
+    Convenience function around computeOrthologs()
+    cacheDir: a directory of hits caches, which is created if needed.  Hits missing from the caches of the genome pair are
+      searched and added to them.  See makeGetCachedHits().
+    returns: a mapping from (div, evalue) pairs to lists of orthologs.
+    '''
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    maxEvalue = max(float(evalue) for div, evalue in divEvalues)
+    getForwardHits = makeGetCachedHits(subjectFastaPath, maxEvalue, hitsCachePath(cacheDir, queryFastaPath, subjectFastaPath))
+    getReverseHits = makeGetCachedHits(queryFastaPath, maxEvalue, hitsCachePath(cacheDir, subjectFastaPath, queryFastaPath))
+    divEvalueToOrthologs = computeOrthologs(queryFastaPath, subjectFastaPath, divEvalues, getForwardHits, getReverseHits, querySeqIds, workingDir)
+    return divEvalueToOrthologs
     
 
 def writeToOutfile(orthologs, outfile):
@@ -644,7 +1566,7 @@ def writeToOutfile(orthologs, outfile):
     write the orthologs to the outfile in the canonical format: one ortholog per line.  each line is tab-separated query id subject id and distance.
     '''
     data = ''.join(['%s\t%s\t%s\n'%(query, subject, distance) for query, subject, distance in orthologs])
-    with open(outfile, 'w') as fh:
+    with util.openFile(outfile, 'w') as fh:
         fh.write(data)
 
 
@@ -654,14 +1576,20 @@ def writeToOutfile(orthologs, outfile):
 
 def copyFastaArg(srcFile, destDir):
     '''
-    srcFile: FASTA format genome file.
+    srcFile: FASTA format genome file.  Can be gzip or bzip2 compressed.
     destDir: where to move the fasta file.
     Copy the source file to the destination dir.  If the source file is already in the destination dir, it will not be copied.
+    A compressed source file is decompressed while it is copied, since blast can not read compressed files, and the
+    '.gz' or '.bz2' extension is removed from the name of the copy.
     return: path of the copied fasta file.
     '''
     # use absolute paths
     srcFile = os.path.abspath(os.path.expanduser(srcFile))
     destDir = os.path.abspath(os.path.expanduser(destDir))
+    if util.compressionOfFile(srcFile):
+        destFile = os.path.join(destDir, os.path.basename(util.stripCompressionExtension(srcFile)))
+        util.decompressFile(srcFile, destFile)
+        return destFile
     destFile = os.path.join(destDir, os.path.basename(srcFile))
     
     # copy GENOME to DIR if necessary
@@ -672,14 +1600,85 @@ def copyFastaArg(srcFile, destDir):
     
 def formatFastaArg(fastaFile):
     '''
-    formatting puts blast indexes in the same dir as fastaFile.
-    returns: fastaFile
+    formatting puts blast indexes in the same dir as fastaFile.  Backends other than blast need no indexes on disk.
+    The id table and offset index of fastaFile are also written there, in one pass over fastaFile that first checks
+    that its ids are unique and parsable.  See idtable.indexGenome().
+    If fastaFile is compressed, it is decompressed to a file next to it, without the '.gz' or '.bz2' extension,
+    and that file is formatted instead, since blast can not read compressed files.
+    raises: Exception if fastaFile has invalid or duplicated ids, before any index is built.
+    returns: fastaFile, or the decompressed file.
     '''
     fastaFile = os.path.abspath(os.path.expanduser(fastaFile))
-    formatForBlast(fastaFile)
+    if util.compressionOfFile(fastaFile):
+        fastaFile = copyFastaArg(fastaFile, os.path.dirname(fastaFile))
+    idtable.indexGenome(fastaFile)
+    search.getBackend(SEARCH_BACKEND).prepare(fastaFile)
     return fastaFile
 
 
+def isFormatted(fastaFile):
+    '''
+    fastaFile: a fasta file, or a compressed fasta file, in which case its decompressed copy is checked.
+    returns: True if everything formatFastaArg() writes for fastaFile exists and is up to date with fastaFile.
+    '''
+    fastaFile = os.path.abspath(os.path.expanduser(fastaFile))
+    if util.compressionOfFile(fastaFile):
+        copyFile = util.stripCompressionExtension(fastaFile)
+        if not os.path.exists(copyFile) or os.path.getmtime(copyFile) < os.path.getmtime(fastaFile):
+            return False
+        fastaFile = copyFile
+    return idtable.isIndexed(fastaFile) and search.getBackend(SEARCH_BACKEND).isPrepared(fastaFile)
+
+
+def _formatGenome(args):
+    '''
+    formats one genome for formatGenomes(), in a worker process.
+    returns: a dict describing the genome, see formatGenomes().
+    '''
+    fastaFile, destDir, force = args
+    result = {'genome': fastaFile, 'path': None, 'numSeqs': None, 'formatted': False, 'error': None}
+    try:
+        if destDir:
+            destFile = os.path.join(destDir, os.path.basename(util.stripCompressionExtension(fastaFile)))
+            if force or not os.path.exists(destFile) or os.path.getmtime(destFile) < os.path.getmtime(fastaFile):
+                copyFastaArg(fastaFile, destDir)
+            fastaFile = destFile
+        if force or not isFormatted(fastaFile):
+            fastaFile = formatFastaArg(fastaFile)
+            result['formatted'] = True
+        elif util.compressionOfFile(fastaFile):
+            fastaFile = util.stripCompressionExtension(fastaFile)
+        result['path'] = fastaFile
+        with open(idtable.idTablePath(fastaFile)) as fh:
+            result['numSeqs'] = sum(1 for line in fh)
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def formatGenomes(fastaFiles, workers=1, destDir=None, force=False):
+    '''
+    fastaFiles: a list of fasta files.  Can be gzip or bzip2 compressed.
+    workers: the number of genomes formatted at once, each in its own process.
+    destDir: if given, each genome is copied to destDir and formatted there, as by copyFastaArg().
+    force: if False, genomes whose indexes are up to date (see isFormatted()) are not formatted again.
+    Formats each genome with formatFastaArg().  A genome that fails, e.g. because of duplicated ids, does not stop the
+    others.
+    returns: a list, parallel to fastaFiles, of dicts with the 'genome', the 'path' of the formatted fasta file, its
+      'numSeqs', whether it was 'formatted' or already up to date, and the 'error' message if it failed, else None.
+    '''
+    tasks = [(os.path.abspath(os.path.expanduser(fastaFile)), destDir and os.path.abspath(os.path.expanduser(destDir)), force)
+             for fastaFile in fastaFiles]
+    if workers == 1 or len(tasks) < 2:
+        return [_formatGenome(task) for task in tasks]
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        return pool.map(_formatGenome, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 if __name__ == '__main__':
     pass
 
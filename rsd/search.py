@@ -0,0 +1,394 @@
+'''
+Pluggable homology search backends, which find the hits of query sequences in a
+subject genome as a stream of (query id, hit id, evalue) tuples, ordered by query
+and then by increasing evalue.
+
+BlastBackend runs makeblastdb and blastp, as RSD always has.  Its tuples also
+carry the (qstart, qend, sstart, send) coordinates of each HSP, which banded
+alignment uses (see rsd.banded).
+
+KmerBackend is an in-process search engine for small and medium genomes, which
+needs no blast database and starts no processes:
+
+  1. Index every k-mer (default 3 residues) of the subject genome.
+  2. For each query, count the k-mers it shares with each subject sequence on each
+     diagonal (subject position - query position).  Subject sequences with at
+     least MIN_SEEDS seeds on one diagonal are candidates, best first.
+  3. Score each candidate with Smith-Waterman local alignment of the query and a
+     window of the candidate around its best diagonal, using BLOSUM62 and affine
+     gap costs (11 to open, 1 to extend).  With numpy, every candidate of a query
+     is aligned at once, a row of the dynamic programming matrices at a time.
+  4. Compute Karlin-Altschul evalues, E = K * m * n * exp(-lambda * S), where m is
+     the query length and n is the number of residues in the subject genome.
+
+The backend used by rsd.getBlastHits() and rsd.formatFastaArg() is chosen by
+rsd.setSearchBackend(), or the RSD_SEARCH_BACKEND environment variable.
+'''
+
+import glob
+import math
+import os
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import fasta
+
+
+BLAST_BACKEND = 'blast'
+KMER_BACKEND = 'kmer'
+
+DEFAULT_KMER_SIZE = 3
+# the number of k-mers a query and subject sequence must share on one diagonal to be aligned.
+MIN_SEEDS = 2
+# the maximum number of candidates aligned per query.
+MAX_CANDIDATES = 20
+# each candidate is aligned in a window of the subject sequence spanning its seeded diagonals, extended by the length
+# of the query and this many residues on each side.
+WINDOW_MARGIN = 64
+# k-mers that occur more often than this in the subject genome (e.g. low complexity repeats) are not used as seeds.
+MAX_KMER_OCCURRENCES = 2000
+GAP_OPEN = 11
+GAP_EXTEND = 1
+# Karlin-Altschul parameters of gapped BLOSUM62 alignments with gap costs 11/1, as used by blastp.
+KARLIN_LAMBDA = 0.267
+KARLIN_K = 0.041
+# the score of aligning a query residue to the padding after the end of a subject sequence.
+PADDING_SCORE = -1000
+
+BLOSUM62_TEXT = '''
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+'''
+
+
+def _parseMatrix(text):
+    '''
+    returns: the alphabet of the matrix, as a string, and a list of lists of scores, indexed by position in the alphabet.
+    '''
+    lines = text.strip().splitlines()
+    alphabet = ''.join(lines[0].split())
+    return alphabet, [[int(score) for score in line.split()[1:]] for line in lines[1:]]
+
+
+ALPHABET, BLOSUM62 = _parseMatrix(BLOSUM62_TEXT)
+# residues not in the alphabet (e.g. U, O, lowercase) are scored as X.
+_CODE_TABLE = [ALPHABET.index('X')] * 256
+for _i, _aa in enumerate(ALPHABET):
+    _CODE_TABLE[ord(_aa)] = _CODE_TABLE[ord(_aa.lower())] = _i
+
+
+def encode(seq):
+    '''
+    returns: a list of the indices of the residues of seq in ALPHABET.
+    '''
+    return [_CODE_TABLE[ord(aa)] for aa in seq]
+
+
+def karlinAltschulEvalue(score, queryLength, dbResidues):
+    return KARLIN_K * queryLength * dbResidues * math.exp(-KARLIN_LAMBDA * score)
+
+
+def _smithWatermanPython(query, subject):
+    '''
+    query, subject: encoded sequences.
+    returns: the best local alignment score, with affine gap costs (Gotoh).
+    '''
+    n = len(query)
+    openCost = GAP_OPEN + GAP_EXTEND
+    prevH = [0] * (n + 1)
+    prevF = [0] * (n + 1)
+    best = 0
+    for s in subject:
+        row = BLOSUM62[s]
+        h = [0] * (n + 1)
+        f = [0] * (n + 1)
+        e = 0
+        for j in xrange(1, n + 1):
+            e = max(h[j - 1] - openCost, e - GAP_EXTEND)
+            f[j] = fj = max(prevH[j] - openCost, prevF[j] - GAP_EXTEND)
+            hj = prevH[j - 1] + row[query[j - 1]]
+            if e > hj:
+                hj = e
+            if fj > hj:
+                hj = fj
+            if hj < 0:
+                hj = 0
+            h[j] = hj
+            if hj > best:
+                best = hj
+        prevH, prevF = h, f
+    return best
+
+
+def _smithWatermanNumpy(query, subjects):
+    '''
+    query: an encoded sequence.
+    subjects: a list of encoded sequences.
+    Computes the dynamic programming matrices of every subject at once with numpy, a row (a subject position) at a
+    time.  Subjects shorter than the longest are padded with a residue that scores too low to align, so their scores
+    stop growing once they end.  Gaps along a row are computed from a running maximum over the row before they are
+    added, which is exact since opening a gap costs at least as much as extending one.
+    returns: a list of the best local alignment score of query and each subject, with affine gap costs.
+    '''
+    n = len(query)
+    numSubjects = len(subjects)
+    maxLength = max(len(subject) for subject in subjects)
+    # the padding residue is the last row of the profile.
+    profile = numpy.array(BLOSUM62 + [[PADDING_SCORE] * len(ALPHABET)], dtype=numpy.int32)[:, query]
+    padded = numpy.full((numSubjects, maxLength), len(ALPHABET), dtype=numpy.int32)
+    for i, subject in enumerate(subjects):
+        padded[i, :len(subject)] = subject
+    openCost = GAP_OPEN + GAP_EXTEND
+    # row gap costs grow by GAP_EXTEND per column, so H[k] + GAP_EXTEND * k is comparable across columns.
+    ramp = numpy.arange(n + 1, dtype=numpy.int32) * GAP_EXTEND
+    prevH = numpy.zeros((numSubjects, n + 1), dtype=numpy.int32)
+    prevF = numpy.zeros((numSubjects, n + 1), dtype=numpy.int32)
+    best = numpy.zeros(numSubjects, dtype=numpy.int32)
+    for row in xrange(maxLength):
+        h = numpy.zeros((numSubjects, n + 1), dtype=numpy.int32)
+        f = numpy.maximum(prevH - openCost, prevF - GAP_EXTEND)
+        h[:, 1:] = numpy.maximum(numpy.maximum(prevH[:, :-1] + profile[padded[:, row]], f[:, 1:]), 0)
+        # e[j] = max over k < j of h[k] - openCost - GAP_EXTEND * (j - 1 - k)
+        runningMax = numpy.maximum.accumulate(h + ramp, axis=1)
+        h[:, 1:] = numpy.maximum(h[:, 1:], runningMax[:, :-1] - ramp[:-1] - openCost)
+        best = numpy.maximum(best, h.max(axis=1))
+        prevH, prevF = h, f
+    return [int(score) for score in best]
+
+
+def smithWatermanScores(query, subjects):
+    '''
+    query: an encoded sequence, see encode().
+    subjects: a list of encoded sequences.
+    returns: a list of the Smith-Waterman local alignment score of query and each subject under BLOSUM62 and gap costs
+      GAP_OPEN and GAP_EXTEND.  Uses numpy if it is installed.
+    '''
+    if not subjects:
+        return []
+    if numpy is not None:
+        return _smithWatermanNumpy(query, subjects)
+    else:
+        return [_smithWatermanPython(query, subject) for subject in subjects]
+
+
+class KmerIndex(object):
+    '''
+    An in-memory index from every k-mer of a genome to the sequences and positions where it occurs.
+    '''
+    def __init__(self, fastaPath, k=DEFAULT_KMER_SIZE):
+        self.k = k
+        self.ids = []
+        self.seqs = []
+        self.kmers = {}
+        for nameline, seq in fasta.readFasta(fastaPath):
+            index = len(self.ids)
+            self.ids.append(fasta.idFromName(nameline))
+            encoded = encode(seq)
+            self.seqs.append(encoded)
+            for pos in xrange(len(encoded) - k + 1):
+                self.kmers.setdefault(tuple(encoded[pos:pos + k]), []).append((index, pos))
+        self.numResidues = sum(len(seq) for seq in self.seqs)
+        for kmer in [kmer for kmer, occurrences in self.kmers.items() if len(occurrences) > MAX_KMER_OCCURRENCES]:
+            del self.kmers[kmer]
+
+    def candidates(self, query, maxCandidates=MAX_CANDIDATES, minSeeds=MIN_SEEDS):
+        '''
+        query: an encoded sequence.
+        returns: a list of (index, lowDiagonal, highDiagonal) for the subject sequences that share at least minSeeds
+          k-mers with query on one diagonal, where index is the index of the subject and lowDiagonal and highDiagonal
+          are the lowest and highest diagonals (subject position minus query position) with minSeeds seeds, ordered by
+          decreasing number of seeds on the best diagonal.
+        '''
+        k = self.k
+        diagonalSeeds = {}
+        for pos in xrange(len(query) - k + 1):
+            for index, subjectPos in self.kmers.get(tuple(query[pos:pos + k]), ()):
+                key = (index, subjectPos - pos)
+                diagonalSeeds[key] = diagonalSeeds.get(key, 0) + 1
+        # index -> [best seeds, lowest diagonal, highest diagonal]
+        seeded = {}
+        for (index, diagonal), seeds in diagonalSeeds.iteritems():
+            if seeds >= minSeeds:
+                if index in seeded:
+                    data = seeded[index]
+                    data[0] = max(data[0], seeds)
+                    data[1] = min(data[1], diagonal)
+                    data[2] = max(data[2], diagonal)
+                else:
+                    seeded[index] = [seeds, diagonal, diagonal]
+        ranked = sorted((-seeds, index, low, high) for index, (seeds, low, high) in seeded.iteritems())
+        return [(index, low, high) for negSeeds, index, low, high in ranked[:maxCandidates]]
+
+
+class KmerBackend(object):
+    '''
+    Searches with a k-mer index and Smith-Waterman scoring, in this process.  Indexes are built when a subject genome is
+    first searched and kept for later searches, e.g. the on-the-fly lookups of every query of a run.
+    '''
+    name = KMER_BACKEND
+
+    def __init__(self, k=DEFAULT_KMER_SIZE):
+        self.k = k
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def prepare(self, fastaPath):
+        '''
+        The index is built in memory when it is first needed, so there is nothing to prepare.
+        '''
+        pass
+
+    def isPrepared(self, fastaPath):
+        return True
+
+    def getIndex(self, subjectPath):
+        '''
+        returns: the KmerIndex of subjectPath, rebuilt if the file has changed.
+        '''
+        key = (subjectPath, os.path.getmtime(subjectPath))
+        with self.lock:
+            if key not in self.indexes:
+                for oldKey in [oldKey for oldKey in self.indexes if oldKey[0] == subjectPath]:
+                    del self.indexes[oldKey]
+                self.indexes[key] = KmerIndex(subjectPath, self.k)
+            return self.indexes[key]
+
+    def searchSeqGen(self, queryId, querySeq, subjectPath, evalue):
+        '''
+        yields: (queryId, hitId, hitEvalue) for every hit of querySeq in subjectPath with hitEvalue < evalue, in order of
+          increasing hitEvalue.
+        '''
+        index = self.getIndex(subjectPath)
+        query = encode(querySeq)
+        candidates = index.candidates(query)
+        windows = [index.seqs[candidate][max(0, low - WINDOW_MARGIN):high + len(query) + WINDOW_MARGIN]
+                   for candidate, low, high in candidates]
+        hits = []
+        for (candidate, low, high), score in zip(candidates, smithWatermanScores(query, windows)):
+            hitEvalue = karlinAltschulEvalue(score, len(query), index.numResidues)
+            if hitEvalue < evalue:
+                hits.append((hitEvalue, candidate))
+        for hitEvalue, candidate in sorted(hits):
+            yield queryId, index.ids[candidate], hitEvalue
+
+    def searchGen(self, queryFastaPath, subjectPath, evalue, workingDir='.'):
+        '''
+        queryFastaPath: a fasta file of query sequences.
+        subjectPath: the fasta file of the subject genome.
+        yields: (queryId, hitId, hitEvalue) for every hit with hitEvalue < evalue, by query, in order of increasing hitEvalue.
+        '''
+        for nameline, seq in fasta.readFasta(queryFastaPath):
+            for hit in self.searchSeqGen(fasta.idFromName(nameline), seq, subjectPath, float(evalue)):
+                yield hit
+
+
+class BlastBackend(object):
+    '''
+    Searches with blastp against a database made by makeblastdb.
+    '''
+    name = BLAST_BACKEND
+
+    def prepare(self, fastaPath):
+        # imported here because rsd imports this module.
+        import rsd
+        rsd.formatForBlast(fastaPath)
+
+    def isPrepared(self, fastaPath):
+        '''
+        returns: True if the blast database of fastaPath, in one volume or many, exists and is not older than fastaPath.
+        '''
+        indexPaths = glob.glob(fastaPath + '.pin') + glob.glob(fastaPath + '.[0-9][0-9].pin')
+        fastaTime = os.path.getmtime(fastaPath)
+        return bool(indexPaths) and all(os.path.getmtime(path) >= fastaTime for path in indexPaths)
+
+    def searchGen(self, queryFastaPath, subjectPath, evalue, workingDir='.'):
+        import rsd
+        import nested
+        with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
+            blastResultsPath = rsd.runBlastp(queryFastaPath, subjectPath, evalue, tmpDir)
+            for hit in rsd.parseResultsGen(blastResultsPath):
+                yield hit
+
+
+BACKENDS = {BLAST_BACKEND: BlastBackend, KMER_BACKEND: KmerBackend}
+_backends = {}
+_backendsLock = threading.Lock()
+
+
+def getBackend(name):
+    '''
+    returns: the backend named name, one instance per process, so the indexes a backend builds are reused.
+    '''
+    if name not in BACKENDS:
+        raise ValueError('Unknown search backend.', name, sorted(BACKENDS))
+    with _backendsLock:
+        if name not in _backends:
+            _backends[name] = BACKENDS[name]()
+        return _backends[name]
+
+
+def compareBackends(queryFastaPath, subjectPath, evalue, limitHits=3, backends=(BLAST_BACKEND, KMER_BACKEND), workingDir='.'):
+    '''
+    subjectPath: the fasta file of the subject genome.  Each backend prepares it, e.g. formats it for blast.
+    Searches every query sequence with each backend.  The first backend is the reference.
+    returns: a dict from backend name to a dict of 'prepareSeconds', 'seconds' (searching), 'numHits' (the number of
+      queries with hits), and, for
+      every backend but the reference, 'recall', the fraction of the reference's best hits that the backend finds among
+      its top limitHits hits, and 'topHitAgreement', the fraction of queries with reference hits whose best hit is the
+      same.
+    '''
+    import rsd
+    results = {}
+    hitsMaps = {}
+    for name in backends:
+        backend = getBackend(name)
+        start = time.time()
+        backend.prepare(subjectPath)
+        prepareSeconds = time.time() - start
+        start = time.time()
+        hitsMaps[name] = rsd.hitsMapFromHitsGen(backend.searchGen(queryFastaPath, subjectPath, evalue, workingDir), limitHits)
+        results[name] = {'prepareSeconds': prepareSeconds, 'seconds': time.time() - start, 'numHits': sum(1 for hits in hitsMaps[name].values() if hits)}
+    reference = hitsMaps[backends[0]]
+    for name in backends[1:]:
+        hitsMap = hitsMaps[name]
+        numReference = numFound = numTopAgree = 0
+        for queryId, referenceHits in reference.items():
+            foundIds = [rsd.getHitId(hit) for hit in hitsMap.get(queryId, [])]
+            numReference += len(referenceHits)
+            numFound += sum(1 for hit in referenceHits if rsd.getHitId(hit) in foundIds)
+            numTopAgree += bool(referenceHits and foundIds and foundIds[0] == rsd.getHitId(referenceHits[0]))
+        numQueries = sum(1 for hits in reference.values() if hits)
+        results[name]['recall'] = numFound / float(numReference) if numReference else None
+        results[name]['topHitAgreement'] = numTopAgree / float(numQueries) if numQueries else None
+    return results
+
+
+# last line
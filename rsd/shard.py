@@ -0,0 +1,183 @@
+'''
+Deterministic sharding of one RSD run across the tasks of a job array, without a
+coordinator, and reassembly of the shards into the output of a single run.
+
+Every task runs rsd_search with the same arguments and its own --shard I/N.
+Each task independently assigns the query sequences to N shards, so every task
+gets the same assignment.  Sequences are assigned longest first, each to the
+shard with the least total sequence length so far (the LPT heuristic), because
+the cost of a sequence grows with its length.  Ties between sequences of equal
+length are broken by a hash of their ids, so the assignment does not depend on
+the order of the fasta file.
+
+A shard is written as a partial format 3 file and a JSON sidecar
+(<partial file>.shard.json), written last, describing the shard: its number, the
+genomes, the divergence and evalue thresholds, the rank of each of its
+sequences in the order a single run processes them, and the pairs of sequences
+dropped while computing the shard, e.g. because a tool timed out.
+mergeShards() checks that every shard of a run is present and complete, and
+orders the orthologs by those ranks, reproducing the output of a single run.
+Since a dropped pair can change the orthologs, shards that dropped pairs are
+only merged if asked to.
+'''
+
+import hashlib
+import heapq
+import json
+import os
+
+import fasta
+import orthutil
+
+
+SIDECAR_SUFFIX = '.shard.json'
+
+
+def parseShard(arg):
+    '''
+    arg: a string 'I/N', where N >= 1 is the number of shards and 1 <= I <= N is the shard number.
+    Raises ValueError if arg is malformed.
+    returns: (I, N) as ints.
+    '''
+    try:
+        shard, numShards = [int(part) for part in arg.split('/')]
+    except ValueError:
+        raise ValueError('A shard must be given as I/N, e.g. 3/10.', arg)
+    if numShards < 1 or not 1 <= shard <= numShards:
+        raise ValueError('A shard I/N must have 1 <= I <= N.', arg)
+    return shard, numShards
+
+
+def _tieBreak(seqId):
+    return hashlib.md5(seqId).hexdigest()
+
+
+def assignShards(idsAndLengths, numShards):
+    '''
+    idsAndLengths: a list of (sequence id, sequence length) pairs.
+    numShards: the number of shards.
+    Assigns sequences to shards longest first, each to the shard with the least total length, breaking ties between
+    sequences by a hash of their id and between shards by shard number.
+    returns: a dict from sequence id to shard number, from 1 to numShards.
+    '''
+    # a heap of (total length, shard number), so the least loaded shard is first.
+    loads = [(0, shard) for shard in range(1, numShards + 1)]
+    assignment = {}
+    for seqId, length in sorted(idsAndLengths, key=lambda (seqId, length): (-length, _tieBreak(seqId))):
+        load, shard = loads[0]
+        heapq.heapreplace(loads, (load + length, shard))
+        assignment[seqId] = shard
+    return assignment
+
+
+def shardIdsAndRanks(fastaPath, shard, numShards, seqIds=None):
+    '''
+    fastaPath: the genome a single run iterates over (the query genome, or the subject genome if the genomes are swapped).
+    seqIds: the sequence ids a single run iterates over, e.g. from --ids.  Defaults to every sequence in fastaPath.
+    returns: the ids of shard, in the order of a single run, the rank of each of those ids in that order, and the
+      number of ids in all shards.
+    '''
+    lengths = dict((fasta.idFromName(nameline), len(seq)) for nameline, seq in fasta.readFasta(fastaPath))
+    if seqIds is None:
+        seqIds = list(fasta.readIds(fastaPath))
+    assignment = assignShards([(seqId, lengths.get(seqId, 0)) for seqId in seqIds], numShards)
+    ranked = [(rank, seqId) for rank, seqId in enumerate(seqIds) if assignment[seqId] == shard]
+    return [seqId for rank, seqId in ranked], [rank for rank, seqId in ranked], len(seqIds)
+
+
+def sidecarPath(path):
+    return path + SIDECAR_SUFFIX
+
+
+def writeShard(path, orthDatas, shard, numShards, queryGenome, subjectGenome, divEvalues, isSwapped, ids, ranks, numIds, dropped=None):
+    '''
+    path: where to write the partial format 3 file.  The sidecar is written next to it, after it.
+    orthDatas: the orthDatas computed for the shard, one per (div, evalue) in divEvalues.
+    isSwapped: True if ids are subject genome ids because the genomes are swapped.
+    ids, ranks, numIds: see shardIdsAndRanks().
+    dropped: a dict from a reason, e.g. a tool that timed out, to a list of the pairs of sequence ids dropped for that
+      reason while computing the shard, or None.
+    '''
+    orthutil.orthDatasToFile(orthDatas, path)
+    sidecar = {'shard': shard, 'numShards': numShards, 'queryGenome': queryGenome, 'subjectGenome': subjectGenome,
+               'divEvalues': divEvalues, 'isSwapped': isSwapped, 'ids': ids, 'ranks': ranks, 'numIds': numIds,
+               'dropped': dict((reason, pairs) for reason, pairs in (dropped or {}).items() if pairs),
+               'size': os.path.getsize(path)}
+    tmpPath = sidecarPath(path) + '.tmp.{}'.format(os.getpid())
+    with open(tmpPath, 'w') as fh:
+        json.dump(sidecar, fh)
+    os.rename(tmpPath, sidecarPath(path))
+
+
+def readSidecar(path):
+    '''
+    path: a partial format 3 file written by writeShard().
+    Raises an exception if the sidecar is missing or the partial file is incomplete.
+    returns: the sidecar of path, as a dict.
+    '''
+    if not os.path.exists(sidecarPath(path)):
+        raise Exception('Shard is missing its sidecar, so it may be incomplete.', path, sidecarPath(path))
+    with open(sidecarPath(path)) as fh:
+        sidecar = json.load(fh)
+    if os.path.getsize(path) != sidecar['size']:
+        raise Exception('Shard has a different size than when it was written.', path)
+    return sidecar
+
+
+def droppedPairs(sidecars):
+    '''
+    returns: a dict from each reason pairs were dropped to a list of the pairs dropped for that reason, as (id, id)
+      tuples, in every shard of sidecars.
+    '''
+    dropped = {}
+    for sidecar in sorted(sidecars, key=lambda sidecar: sidecar['shard']):
+        for reason, pairs in sorted(sidecar.get('dropped', {}).items()):
+            dropped.setdefault(reason, []).extend(tuple(pair) for pair in pairs)
+    return dropped
+
+
+def mergeShards(paths, outPath, allowDropped=False):
+    '''
+    paths: the partial format 3 files of every shard of a run.  Their sidecars must be next to them.
+    outPath: where to write the merged orthologs, in format 3.
+    allowDropped: if False, shards that dropped pairs (see writeShard()) are not merged, since their orthologs can
+      differ from those of a single run that did not drop them.
+    Checks that the shards are all from the same run, that every shard from 1 to N is present exactly once, and that
+    together they cover every sequence exactly once.  Writes the orthologs for each (div, evalue) in the order a single
+    run would find them.
+    '''
+    sidecars = [readSidecar(path) for path in paths]
+    first = sidecars[0]
+    runKeys = ('numShards', 'queryGenome', 'subjectGenome', 'divEvalues', 'isSwapped', 'numIds')
+    for path, sidecar in zip(paths, sidecars):
+        if [sidecar[key] for key in runKeys] != [first[key] for key in runKeys]:
+            raise Exception('Shards are from different runs.', paths[0], path)
+    shards = sorted(sidecar['shard'] for sidecar in sidecars)
+    if shards != range(1, first['numShards'] + 1):
+        raise Exception('Missing or duplicate shards.  Expected shards 1 to {}.'.format(first['numShards']), shards)
+    idToRank = {}
+    for sidecar in sidecars:
+        idToRank.update(zip(sidecar['ids'], sidecar['ranks']))
+    if sorted(idToRank.values()) != range(first['numIds']):
+        raise Exception('Shards do not cover every sequence exactly once.', paths)
+    dropped = droppedPairs(sidecars)
+    if dropped and not allowDropped:
+        raise Exception('Shards dropped pairs of sequences, so the merged orthologs could differ from a single run.', dropped)
+
+    divEvalueToOrthologs = dict((('{}'.format(div), '{}'.format(evalue)), []) for div, evalue in first['divEvalues'])
+    for path in paths:
+        for (qdb, sdb, div, evalue), orthologs in orthutil.orthDatasFromFileGen(path):
+            divEvalueToOrthologs[(div, evalue)].extend(orthologs)
+    # a single run iterates over subject ids if the genomes are swapped.
+    idIndex = 1 if first['isSwapped'] else 0
+    orthDatas = []
+    for div, evalue in first['divEvalues']:
+        divEvalue = ('{}'.format(div), '{}'.format(evalue))
+        # the sort is stable, so orthologs of the same sequence stay in the order they were found.
+        orthologs = sorted(divEvalueToOrthologs[divEvalue], key=lambda ortholog: idToRank[ortholog[idIndex]])
+        orthDatas.append(((first['queryGenome'], first['subjectGenome']) + divEvalue, orthologs))
+    orthutil.orthDatasToFile(orthDatas, outPath)
+    return outPath
+
+
+# last line
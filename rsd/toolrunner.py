@@ -0,0 +1,214 @@
+'''
+Runs calls to external tools (blast, kalign, codeml) concurrently from one
+process, with a separate concurrency limit for each tool.
+
+The tools run as subprocesses and Python waits on them without holding the GIL,
+so a few threads per tool keep many cores busy without the memory cost of a
+process pool.  Each tool has its own pool of worker threads, sized by its limit,
+so a backlog of one kind of call never starves another.
+
+Tools that write files (codeml, clustalw) need a directory of their own for each
+concurrent call.  WorkDirs recycles directories from a nested.ScratchPool,
+preparing each one once (e.g. copying the codeml control file into it).
+'''
+
+import sys
+import threading
+import Queue
+
+
+class Future(object):
+    '''
+    The eventual result of a call submitted to a ToolRunner.
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._excInfo = None
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except:
+            self._excInfo = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        '''
+        waits for the call to finish.
+        returns: the value returned by the call.  If the call raised an exception, it is raised here, with its traceback.
+        '''
+        self._done.wait()
+        if self._excInfo:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+
+
+class _WorkerPool(object):
+    '''
+    a fixed number of daemon threads running calls from a queue.
+    '''
+    def __init__(self, numWorkers, name):
+        self.calls = Queue.Queue()
+        self.threads = [threading.Thread(target=self._work, name='{}-{}'.format(name, i)) for i in range(numWorkers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            future, func, args = call
+            future._run(func, args)
+
+    def submit(self, func, args):
+        future = Future()
+        self.calls.put((future, func, args))
+        return future
+
+    def close(self):
+        for thread in self.threads:
+            self.calls.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class ToolRunner(object):
+    '''
+    Runs calls concurrently, at most limits[tool] calls of each tool at once.  Can be used as a context manager, which
+    stops the worker threads on exit.
+    Example:
+        with ToolRunner({'align': 4, 'distance': 8}) as runner:
+            alignments = runner.map('align', alignSeqPair, pairs)
+    '''
+    def __init__(self, limits):
+        '''
+        limits: a dict from tool name to the maximum number of concurrent calls of that tool.  Tools without a limit
+          run one call at a time.
+        '''
+        self.limits = dict(limits)
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _pool(self, tool):
+        with self.lock:
+            if tool not in self.pools:
+                self.pools[tool] = _WorkerPool(max(1, self.limits.get(tool, 1)), tool)
+            return self.pools[tool]
+
+    def submit(self, tool, func, *args):
+        '''
+        returns: a Future for the call func(*args), which runs when fewer than limits[tool] calls of tool are running.
+        '''
+        return self._pool(tool).submit(func, args)
+
+    def map(self, tool, func, argsList):
+        '''
+        argsList: a list of tuples of arguments.
+        Runs func(*args) for every args in argsList concurrently and waits for all of them.
+        returns: a list of the results, in the order of argsList.  If any call raised an exception, the first one in
+          argsList order is raised after all the calls have finished.
+        '''
+        futures = [self.submit(tool, func, *args) for args in argsList]
+        for future in futures:
+            future._done.wait()
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class WorkDirs(object):
+    '''
+    Recycles work dirs from a nested.ScratchPool for concurrent calls of a tool that writes files, preparing each
+    dir once.  Dirs are returned to the scratch pool, cleaned, when the WorkDirs is closed.  A WorkDirs takes at most
+    limit dirs from the scratch pool, and then waits for one of its own dirs to be released, so several WorkDirs
+    sharing a pool can not take every dir and wait on each other forever.  Thread-safe.
+    Example:
+        with WorkDirs(nested.getDefaultScratchPool(), prepareCodemlDir) as workDirs:
+            with workDirs.dir() as workPath:
+                ... run codeml in workPath ...
+    '''
+    def __init__(self, scratchPool, prepare=None, limit=None):
+        '''
+        prepare: a function called with the path of each new dir, e.g. to copy config files into it.
+        limit: the most dirs to take from scratchPool, e.g. the number of threads calling the tool.  Defaults to no limit.
+        '''
+        self.scratchPool = scratchPool
+        self.prepare = prepare
+        self.limit = limit
+        self.free = Queue.Queue()
+        self.all = []
+        self.numTaken = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.free.get(False)
+        except Queue.Empty:
+            pass
+        with self.lock:
+            isFull = self.limit is not None and self.numTaken >= self.limit
+            if not isFull:
+                self.numTaken += 1
+        if isFull:
+            return self.free.get()
+        path = self.scratchPool.acquire()
+        if self.prepare:
+            self.prepare(path)
+        with self.lock:
+            self.all.append(path)
+        return path
+
+    def release(self, path):
+        self.free.put(path)
+
+    def dir(self):
+        '''
+        returns: a context manager that acquires a prepared dir, 'returns' its path, and releases it on exit.
+        '''
+        return _WorkDir(self)
+
+    def close(self):
+        with self.lock:
+            paths, self.all = self.all, []
+            self.numTaken = 0
+        for path in paths:
+            self.scratchPool.release(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _WorkDir(object):
+
+    def __init__(self, workDirs):
+        self.workDirs = workDirs
+        self.path = None
+
+    def __enter__(self):
+        self.path = self.workDirs.acquire()
+        return self.path
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.workDirs.release(self.path)
+
+
+# last line
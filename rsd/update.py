@@ -0,0 +1,244 @@
+'''
+Incremental recomputation of the hits and orthologs of a pair of genomes when
+one or both genomes are updated, e.g. by a new proteome release that changes a
+few proteins.
+
+The sequences of the old and new versions of each genome are compared by a hash
+of their content.  Sequences that are new or changed are searched against the
+other genome, keeping every hit, and every sequence of the other genome is
+searched against only the new and changed sequences, which finds the sequences
+whose hits they may have joined in either direction, since an evalue depends on
+which sequence is the query.  Hits are then recomputed for:
+
+  - new and changed sequences,
+  - sequences whose saved hits include a changed or removed sequence,
+  - sequences hit by a new or changed sequence, or that hit one.
+
+Every other sequence keeps its saved hits, with evalues rescaled by the change
+in the size of the genome searched, since evalues grow with the number of
+residues searched.
+
+Orthologs are recomputed for the query sequences whose hit neighbourhood
+touches a changed sequence or changed hits: the query itself, its hits, or
+the reverse hits of its hits.  Every other ortholog is carried forward from the
+previous results, and the orthologs are ordered as a full run from the updated
+hits would order them: by query, or by subject if that run would swap the
+genomes (see rsd.shouldSwapGenomes()).  The result is the same as recomputing
+the pair from scratch, except for hits near the evalue threshold of genomes that
+shrink, since hits just above the threshold were never saved.
+'''
+
+import hashlib
+import os
+
+import fasta
+import nested
+import rsd
+
+
+def seqHashes(fastaPath):
+    '''
+    returns: a dict from every seq id in fastaPath to a hash of its sequence.
+    '''
+    return dict((fasta.idFromName(nameline), hashlib.md5(seq.upper()).hexdigest()) for nameline, seq in fasta.readFasta(fastaPath))
+
+
+def diffGenomes(oldFastaPath, newFastaPath):
+    '''
+    returns: a pair of sets of seq ids, those in newFastaPath that are new or whose sequence changed, and those in
+      oldFastaPath that were removed.
+    '''
+    oldHashes = seqHashes(oldFastaPath)
+    newHashes = seqHashes(newFastaPath)
+    changed = set(seqId for seqId, seqHash in newHashes.iteritems() if oldHashes.get(seqId) != seqHash)
+    removed = set(oldHashes) - set(newHashes)
+    return changed, removed
+
+
+def writeFastaSubset(fastaPath, seqIds, outPath):
+    '''
+    writes the sequences of fastaPath whose ids are in seqIds to outPath, in the order of fastaPath.
+    returns: outPath
+    '''
+    with open(outPath, 'w') as fh:
+        for nameline, seq in fasta.readFasta(fastaPath):
+            if fasta.idFromName(nameline) in seqIds:
+                fh.write('{}\n{}'.format(nameline, fasta.prettySeq(seq)))
+    return outPath
+
+
+def searchSubset(queryFastaPath, seqIds, subjectIndexPath, evalue, limitHits, workingDir):
+    '''
+    returns: the hits of the sequences of queryFastaPath whose ids are in seqIds in the subject genome.  See
+      rsd.getBlastHits().
+    '''
+    if not seqIds:
+        return {}
+    with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
+        subsetPath = writeFastaSubset(queryFastaPath, seqIds, os.path.join(tmpDir, 'subset.faa'))
+        return rsd.getBlastHits(subsetPath, subjectIndexPath, evalue, limitHits, workingDir=tmpDir)
+
+
+def searchAgainstSubset(queryFastaPath, subjectFastaPath, seqIds, evalue, workingDir):
+    '''
+    searches every sequence of queryFastaPath against only the sequences of subjectFastaPath whose ids are in seqIds.
+    Evalues against the subset are lower than against the whole subject genome, so every query with a hit below evalue
+    in the subset of the whole genome is found, and maybe a few more.
+    returns: the set of query seq ids with a hit in the subset.
+    '''
+    if not seqIds:
+        return set()
+    with nested.NestedTempDir(dir=workingDir, nesting=0) as tmpDir:
+        subsetPath = rsd.formatFastaArg(writeFastaSubset(subjectFastaPath, seqIds, os.path.join(tmpDir, 'subset.faa')))
+        hits = rsd.getBlastHits(queryFastaPath, subsetPath, evalue, None, workingDir=tmpDir)
+        return set(seqId for seqId, seqHits in hits.iteritems() if seqHits)
+
+
+def rescaleHits(hits, factor, evalue):
+    '''
+    returns: hits with their evalues multiplied by factor, without the hits no longer below evalue.
+    '''
+    return [(rsd.getHitId(hit), rsd.getHitEvalue(hit) * factor) + tuple(hit[2:]) for hit in hits if rsd.getHitEvalue(hit) * factor < evalue]
+
+
+def updateHits(oldHits, queryFastaPath, subjectIndexPath, changedIds, removedIds, changedHitIds, removedHitIds,
+               probeHits, extraIds, evalue, evalueFactor, workingDir):
+    '''
+    oldHits: a mapping from query seq id to the saved hits of the query in the subject genome.
+    queryFastaPath, subjectIndexPath: the new query genome, and the new subject genome, formatted for searching.
+    changedIds, removedIds: query seq ids that are new or changed, and that were removed.
+    changedHitIds, removedHitIds: the same for the subject genome.
+    probeHits: the unlimited hits of every changed query seq id, whose top hits are used as is.
+    extraIds: other query seq ids whose hits must be recomputed, e.g. because a changed subject sequence hits them.
+    evalueFactor: the ratio of the residues of the new subject genome to those of the old one.
+    returns: a pair of the updated hits, a dict, and the set of query seq ids whose hits were recomputed.
+    '''
+    touched = changedHitIds | removedHitIds
+    recompute = set(extraIds) - changedIds - removedIds
+    hits = {}
+    for seqId, seqHits in oldHits.iteritems():
+        if seqId in removedIds or seqId in changedIds:
+            continue
+        if any(rsd.getHitId(hit) in touched for hit in seqHits):
+            recompute.add(seqId)
+        elif seqId not in recompute:
+            rescaled = rescaleHits(seqHits, evalueFactor, evalue)
+            if rescaled:
+                hits[seqId] = rescaled
+    for seqId in changedIds:
+        if probeHits.get(seqId):
+            hits[seqId] = probeHits[seqId][:rsd.MAX_HITS]
+    for seqId, seqHits in searchSubset(queryFastaPath, recompute, subjectIndexPath, evalue, rsd.MAX_HITS, workingDir).iteritems():
+        if seqHits:
+            hits[seqId] = seqHits
+    return hits, recompute | changedIds
+
+
+def changedHitsIds(oldHits, newHits, thresholds):
+    '''
+    thresholds: evalue thresholds, floats.
+    returns: the set of seq ids whose hits differ between oldHits and newHits in their ids or in which thresholds their
+      evalues are below.
+    '''
+    def signature(hits):
+        return [(rsd.getHitId(hit), [rsd.getHitEvalue(hit) < threshold for threshold in thresholds]) for hit in (hits or [])]
+    return set(seqId for seqId in set(oldHits) | set(newHits) if signature(oldHits.get(seqId)) != signature(newHits.get(seqId)))
+
+
+def affectedQueryIds(queryIds, forwardHits, reverseHits, dirtyQueryIds, dirtySubjectIds):
+    '''
+    queryIds: the query seq ids of the new query genome.
+    forwardHits, reverseHits: lists of mappings from seq id to hits, e.g. the saved and the updated hits of each direction.
+    dirtyQueryIds, dirtySubjectIds: seq ids of each genome that changed, were removed, or whose hits changed.
+    returns: the query seq ids whose orthologs may have changed: those that are dirty, or have a dirty hit, or a hit
+      with a dirty reverse hit, in the old or new hits.
+    '''
+    affected = set()
+    for queryId in queryIds:
+        if queryId in dirtyQueryIds:
+            affected.add(queryId)
+            continue
+        hitIds = set(rsd.getHitId(hit) for hitsMap in forwardHits for hit in (hitsMap.get(queryId) or []))
+        if hitIds & dirtySubjectIds:
+            affected.add(queryId)
+            continue
+        reverseIds = set(rsd.getHitId(hit) for hitsMap in reverseHits for hitId in hitIds for hit in (hitsMap.get(hitId) or []))
+        if reverseIds & dirtyQueryIds:
+            affected.add(queryId)
+    return affected
+
+
+def updateGenomePair(oldQueryFastaPath, queryFastaPath, oldSubjectFastaPath, subjectFastaPath, forwardHits, reverseHits,
+                     orthDatas, evalue, workingDir='.'):
+    '''
+    oldQueryFastaPath, oldSubjectFastaPath: the genomes the previous hits and orthologs were computed from.
+    queryFastaPath, subjectFastaPath: the new versions of the genomes, formatted for searching (see rsd.formatFastaArg()).
+      A genome that has not changed can be given as both its old and new version.
+    forwardHits, reverseHits: the previous hits, mappings from seq id to hits, e.g. from rsd.loadBlastHits().
+    orthDatas: the previous orthologs, a list of orthDatas (see orthutil), for every divergence and evalue to compute.
+    evalue: the evalue threshold of the hits, at least the loosest evalue of orthDatas.
+    returns: a tuple of the updated forward hits, reverse hits and orthDatas, and a dict of statistics: the number of
+      sequences 'changed' and 'removed' in each genome, of sequences whose hits were recomputed ('forwardSearched',
+      'reverseSearched'), and of queries whose orthologs were recomputed ('recomputed') or carried forward ('carried').
+    '''
+    changedQueryIds, removedQueryIds = diffGenomes(oldQueryFastaPath, queryFastaPath)
+    changedSubjectIds, removedSubjectIds = diffGenomes(oldSubjectFastaPath, subjectFastaPath)
+    queryResidues = sum(fasta.readSeqLengths(queryFastaPath).values())
+    subjectResidues = sum(fasta.readSeqLengths(subjectFastaPath).values())
+    queryFactor = queryResidues / float(sum(fasta.readSeqLengths(oldQueryFastaPath).values()) or 1)
+    subjectFactor = subjectResidues / float(sum(fasta.readSeqLengths(oldSubjectFastaPath).values()) or 1)
+
+    # every hit of the changed sequences, which also shows which sequences of the other genome they may now hit, and
+    # the sequences of the other genome that may now hit them, since evalues are not symmetric.
+    forwardProbe = searchSubset(queryFastaPath, changedQueryIds, subjectFastaPath, evalue, None, workingDir)
+    reverseProbe = searchSubset(subjectFastaPath, changedSubjectIds, queryFastaPath, evalue, None, workingDir)
+    probedSubjectIds = set(rsd.getHitId(hit) for hits in forwardProbe.values() for hit in hits)
+    probedSubjectIds |= searchAgainstSubset(subjectFastaPath, queryFastaPath, changedQueryIds, evalue, workingDir)
+    probedQueryIds = set(rsd.getHitId(hit) for hits in reverseProbe.values() for hit in hits)
+    probedQueryIds |= searchAgainstSubset(queryFastaPath, subjectFastaPath, changedSubjectIds, evalue, workingDir)
+
+    newForwardHits, forwardSearched = updateHits(forwardHits, queryFastaPath, subjectFastaPath, changedQueryIds, removedQueryIds,
+                                                 changedSubjectIds, removedSubjectIds, forwardProbe, probedQueryIds, evalue,
+                                                 subjectFactor, workingDir)
+    newReverseHits, reverseSearched = updateHits(reverseHits, subjectFastaPath, queryFastaPath, changedSubjectIds, removedSubjectIds,
+                                                 changedQueryIds, removedQueryIds, reverseProbe, probedSubjectIds, evalue,
+                                                 queryFactor, workingDir)
+
+    divEvalues = [(div, orthEvalue) for (qdb, sdb, div, orthEvalue), orthologs in orthDatas]
+    thresholds = sorted(set(float(orthEvalue) for div, orthEvalue in divEvalues))
+    queryIds = list(fasta.readIds(queryFastaPath))
+    dirtyQueryIds = changedQueryIds | removedQueryIds | changedHitsIds(forwardHits, newForwardHits, thresholds)
+    dirtySubjectIds = changedSubjectIds | removedSubjectIds | changedHitsIds(reverseHits, newReverseHits, thresholds)
+    affected = affectedQueryIds(queryIds, [forwardHits, newForwardHits], [reverseHits, newReverseHits], dirtyQueryIds, dirtySubjectIds)
+
+    recomputedIds = [queryId for queryId in queryIds if queryId in affected]
+    divEvalueToOrthologs = {}
+    if recomputedIds:
+        getForwardHits = lambda seqId, seq: newForwardHits.get(seqId)
+        getReverseHits = lambda seqId, seq: newReverseHits.get(seqId)
+        divEvalueToOrthologs = rsd.computeOrthologs(queryFastaPath, subjectFastaPath, divEvalues, getForwardHits, getReverseHits,
+                                                    recomputedIds, workingDir)
+
+    # carry forward the orthologs of unaffected queries, ordered as in a full run, which goes through the subject
+    # genome instead if it swaps the genomes.
+    ranks = dict((queryId, rank) for rank, queryId in enumerate(queryIds))
+    if rsd.shouldSwapGenomes(queryFastaPath, subjectFastaPath, None, newForwardHits, newReverseHits, evalue=max(thresholds or [evalue])):
+        orderRanks, orderIndex = dict((subjectId, rank) for rank, subjectId in enumerate(fasta.readIds(subjectFastaPath))), 1
+    else:
+        orderRanks, orderIndex = ranks, 0
+    queryName, subjectName = os.path.basename(queryFastaPath), os.path.basename(subjectFastaPath)
+    newOrthDatas = []
+    for (qdb, sdb, div, orthEvalue), orthologs in orthDatas:
+        carried = [ortholog for ortholog in orthologs if ortholog[0] in ranks and ortholog[0] not in affected]
+        merged = carried + list(divEvalueToOrthologs.get((div, orthEvalue), []))
+        merged.sort(key=lambda ortholog: orderRanks[ortholog[orderIndex]])
+        newOrthDatas.append(((queryName, subjectName, div, orthEvalue), merged))
+
+    stats = {'queryChanged': len(changedQueryIds), 'queryRemoved': len(removedQueryIds),
+             'subjectChanged': len(changedSubjectIds), 'subjectRemoved': len(removedSubjectIds),
+             'forwardSearched': len(forwardSearched), 'reverseSearched': len(reverseSearched),
+             'recomputed': len(recomputedIds), 'carried': len(queryIds) - len(recomputedIds)}
+    return newForwardHits, newReverseHits, newOrthDatas, stats
+
+
+# last line
@@ -7,6 +7,7 @@ to fill in some gaps in the python language
 ONLY DEPENDENCIES ON STANDARD LIBRARY MODULES ALLOWED.
 '''
 
+import collections
 import datetime
 import math
 import hashlib # sha
@@ -15,8 +16,11 @@ import tempfile
 import shutil
 import time
 import os
+import re
+import signal
 import sys
 import subprocess
+import threading
 
 
 def humanBytes(num):
@@ -32,7 +36,77 @@ def humanBytes(num):
         num /= 1024.0
 
 
-def run(args, stdin=None, shell=False):
+def parseBytes(text):
+    '''
+    text: a number of bytes, optionally followed by a unit, e.g. '512M', '4G', '1.5GB' or '1000000'.  Units are powers
+      of 1024, as in humanBytes().
+    returns: the number of bytes, an int.
+    raises: ValueError if text is not a number of bytes.
+    '''
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([KMGTP]?)B?\s*$', text, re.IGNORECASE)
+    if not match:
+        raise ValueError('Not a number of bytes.', text)
+    return int(float(match.group(1)) * 1024 ** ' KMGTP'.index(match.group(2).upper() or ' '))
+
+
+class CommandTimeout(Exception):
+    '''
+    Raised when a command runs longer than its timeout and is killed.  Has the command and arguments, 'cmd', and the
+    'timeout' in seconds as attributes.
+    '''
+    def __init__(self, args, timeout):
+        Exception.__init__(self, 'Command timed out and was killed.  args={} timeout={}'.format(args, timeout))
+        self.cmd = args
+        self.timeout = timeout
+
+
+def communicate(args, stdin=None, timeout=None, **keywords):
+    '''
+    args: command and arguments, as for subprocess.Popen().
+    stdin: string to be sent to stdin of command, or None.
+    timeout: seconds after which the command is killed, or None to wait forever.
+    keywords: passed to subprocess.Popen(), e.g. stdout, stderr, cwd.  stdin is a pipe if stdin is given.
+    Runs the command in a process group of its own, so if it times out, it and any processes it started are killed
+    together with SIGKILL.
+    returns: a tuple of the returncode, stdout and stderr of the command.  stdout and stderr are None unless they are pipes.
+    raises: CommandTimeout if the command timed out.
+    '''
+    if stdin is not None:
+        keywords['stdin'] = subprocess.PIPE
+    p = subprocess.Popen(args, preexec_fn=os.setsid, **keywords)
+    timedOut = []
+    def kill():
+        timedOut.append(True)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            # the command already exited.
+            pass
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+    try:
+        output, error = p.communicate(stdin)
+    finally:
+        if timer:
+            timer.cancel()
+    if timedOut:
+        raise CommandTimeout(args, timeout)
+    return p.returncode, output, error
+
+
+def checkCall(args, timeout=None, **keywords):
+    '''
+    Like subprocess.check_call(), with a timeout.  See communicate().
+    raises: subprocess.CalledProcessError if the command fails, or CommandTimeout if it timed out.
+    '''
+    returncode, output, error = communicate(args, timeout=timeout, **keywords)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def run(args, stdin=None, shell=False, timeout=None):
     '''
     for python 2.7 and above, consider using subprocess.check_output().
     
@@ -49,15 +123,16 @@ def run(args, stdin=None, shell=False):
     on the shell.  If shell=False, executes command (the first item in args) with the other items in args as arguments.
     If args is a string, it is executed as a command.  If the string includes arguments, strange behavior will ensue.
     This is a convenience function wrapped around the subprocess module.
+    timeout: seconds after which the command and its process group are killed.  See communicate().
 
     returns: stdout of cmd (as string), if returncode is zero.
     if returncode is non-zero, throws Exception with the 'returncode' and 'stderr' of the cmd as attributes.
+    raises: CommandTimeout if the command timed out.
     '''
-    p = subprocess.Popen(args, shell=shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = p.communicate(stdin)
-    if p.returncode != 0:
-        e = Exception('Error running command.  args='+str(args)+' returncode='+str(p.returncode)+'\nstdin='+str(stdin)+'\nstderr='+str(error))
-        e.returncode = p.returncode
+    returncode, output, error = communicate(args, stdin=stdin or '', timeout=timeout, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if returncode != 0:
+        e = Exception('Error running command.  args='+str(args)+' returncode='+str(returncode)+'\nstdin='+str(stdin)+'\nstderr='+str(error))
+        e.returncode = returncode
         e.stderr = error
         raise e
     else:
@@ -242,6 +317,78 @@ def withOpenFile(name, mode='r', bufsize=-1):
 # DATES AND TIME
 ################
 
+class StageTimer(object):
+    '''
+    Accumulates the wall time, number of calls, and units of work (e.g. residues aligned) spent in named stages of a computation.
+    Safe to use from multiple threads.
+    usage:
+      timer = StageTimer()
+      with timer.timing('align', units=len(seq)):
+          align(seq)
+      timer.snapshot() # {'align': {'seconds': 0.01, 'calls': 1, 'units': 350}}
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, seconds, calls=1, units=0):
+        with self.lock:
+            data = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'units': 0})
+            data['seconds'] += seconds
+            data['calls'] += calls
+            data['units'] += units
+
+    def timing(self, stage, units=0):
+        '''
+        returns: a context manager which adds the time spent within the context to stage.
+        '''
+        return _StageTiming(self, stage, units)
+
+    def snapshot(self):
+        '''
+        returns: a copy of the accumulated stage data, a dict from stage name to a dict of seconds, calls, and units.
+        '''
+        with self.lock:
+            return dict((stage, dict(data)) for stage, data in self.stages.items())
+
+    def merge(self, snapshot):
+        '''
+        snapshot: the return value of snapshot() from another timer, e.g. one from a worker process.
+        adds the stage data in snapshot to this timer.
+        '''
+        for stage, data in snapshot.items():
+            self.add(stage, data['seconds'], data['calls'], data['units'])
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+
+class _StageTiming(object):
+    def __init__(self, timer, stage, units):
+        self.timer, self.stage, self.units = timer, stage, units
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timer.add(self.stage, time.time() - self.start, units=self.units)
+
+
+def maxRssBytes(children=True):
+    '''
+    children: if True, include the peak resident set size of terminated child processes which have been waited for (e.g. blastp, kalign, codeml).
+    returns: the peak resident set size in bytes of this process (and its children).  Children are counted as the largest child, not the sum.
+    '''
+    import resource
+    # ru_maxrss is in kilobytes on linux and bytes on mac os x.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    if children:
+        rss = max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+    return rss
+
+
 def lastMonth(thisMonth=None):
     '''
     thisMonth: datetime or date obj.  defaults to today.
@@ -269,6 +416,35 @@ class SimpleNamespace(object):
     pass
 
 
+class LruCache(object):
+    '''
+    A dict-like cache of at most size items, which evicts the least recently used item when full.  Safe to use from
+    several threads.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
 def mergeListOfLists(lists):
     '''
     lists: a list of lists
@@ -426,6 +602,96 @@ def any(pred, seq):
     return False
 
 
+#####################
+# COMPRESSED FILES
+#####################
+
+GZIP_MAGIC = '\x1f\x8b'
+BZ2_MAGIC = 'BZh'
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2'}
+
+
+def compressionOfFile(path):
+    '''
+    path: an existing file.
+    Detects compression from the magic bytes at the start of the file, not from the file name.
+    returns: 'gzip', 'bz2', or None if the file is not compressed.
+    '''
+    with open(path, 'rb') as fh:
+        magic = fh.read(3)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    elif magic.startswith(BZ2_MAGIC):
+        return 'bz2'
+    else:
+        return None
+
+
+def compressionOfName(path):
+    '''
+    returns: 'gzip' or 'bz2' if path ends in '.gz' or '.bz2'.  Otherwise None.
+    '''
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+def stripCompressionExtension(path):
+    '''
+    returns: path without a trailing '.gz' or '.bz2', if it has one.  e.g. 'genome.faa.gz' -> 'genome.faa'
+    '''
+    root, ext = os.path.splitext(path)
+    return root if ext in COMPRESSION_EXTENSIONS else path
+
+
+def openFile(path, mode='r'):
+    '''
+    path: a file to read or write.
+    mode: 'r', 'w', or 'a', optionally with 'b'.
+    Opens path like the builtin function open(), transparently decompressing gzip or bzip2 compressed files when reading and
+    compressing files when writing.  When reading, the compression is detected from the magic bytes at the start of the file.
+    When writing or appending, files are compressed if path ends in '.gz' or '.bz2'.  Appending to bzip2 files is not supported.
+    Compressed files are streamed, never decompressed to disk.
+    returns: an open file-like object, which can be used as a context manager.
+    '''
+    import bz2
+    import gzip
+    if mode.startswith('r'):
+        compression = compressionOfFile(path)
+    else:
+        compression = compressionOfName(path)
+    binaryMode = mode[0] + 'b'
+    if compression == 'gzip':
+        return gzip.open(path, binaryMode)
+    elif compression == 'bz2':
+        if binaryMode == 'ab':
+            raise ValueError('Appending to a bzip2 compressed file is not supported.', path)
+        return bz2.BZ2File(path, binaryMode)
+    else:
+        return open(path, mode)
+
+
+def uncompressedSize(path, bufsize=2**20):
+    '''
+    returns: the size in bytes of the contents of path, decompressed if path is gzip or bzip2 compressed.  Compressed
+      files are streamed to count their bytes, since bzip2 does not record the size and gzip records it modulo 4GB.
+    '''
+    if not compressionOfFile(path):
+        return os.path.getsize(path)
+    size = 0
+    with openFile(path, 'rb') as fh:
+        for data in iter(lambda: fh.read(bufsize), ''):
+            size += len(data)
+    return size
+
+
+def decompressFile(srcPath, destPath, bufsize=2**20):
+    '''
+    Copies srcPath to destPath, decompressing srcPath if it is compressed.
+    '''
+    with openFile(srcPath, 'rb') as src:
+        with open(destPath, 'wb') as dest:
+            shutil.copyfileobj(src, dest, bufsize)
+
+
 ################################
 # SERIALIZATION HELPER FUNCTIONS
 ################################
@@ -435,7 +701,7 @@ def loadObject(pickleFilename, protocol=-1, mode='rb'):
     use 'rb' mode for protocol 2, 'r' for protocol 0
     '''
     import cPickle
-    fh = open(pickleFilename, mode)
+    fh = openFile(pickleFilename, mode)
     obj = cPickle.load(fh)
     fh.close()
     return obj
@@ -446,7 +712,7 @@ def dumpObject(obj, pickleFilename, protocol=-1, mode='wb'):
     use 'wb' mode for protocol 2, 'w' for protocol 0
     '''
     import cPickle
-    fh = open(pickleFilename, mode)
+    fh = openFile(pickleFilename, mode)
     cPickle.dump(obj, fh, protocol=protocol)
     fh.close()
     return obj
@@ -501,6 +767,17 @@ def differentFiles(filename1, filename2):
     return isDifferent
 
 
+def fileDigest(filename, bufsize=2**20):
+    '''
+    returns: the SHA1 hex digest of the contents of filename.
+    '''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for data in iter(lambda: fh.read(bufsize), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
 if __name__ == '__main__':
     pass
 
@@ -0,0 +1,477 @@
+'''
+A work queue on a shared POSIX filesystem, for computing orthologs for chunks of
+query sequences on many nodes without a scheduler.
+
+A queue is a directory.  The process that creates the queue writes a config
+file describing the job and one ticket per chunk of query sequence ids.  Worker
+processes on any node claim tickets, compute orthologs for the chunk, and save
+the results.  The queue directory contains:
+
+    config.json: the job description, written last, so a queue with a config is
+      complete.
+    todo/: tickets waiting to be claimed.
+    claimed/: tickets being worked on.  The name of a claimed ticket ends with the
+      id of the worker that claimed it.
+    done/: tickets whose results have been saved.
+    results/: the orthologs of each chunk in format 3 (see orthutil), and the
+      pairs dropped while computing it, if any, as json.
+    creating/: a lock held by the process creating the queue.
+    merging/: a lock held by the process merging the results, renamed to
+      merged/ once the merged results are written.
+
+Tickets, claimed tickets and results are nested (see nested.makeNestedPath()) so
+no directory gets too big.  Every state change is an atomic rename on the shared
+filesystem, so exactly one worker wins each claim.  A worker holds a lease on its
+claimed ticket by refreshing the ticket's modification time.  If a worker dies,
+its lease expires and other workers move the ticket back to todo/.  Results are
+written before a ticket is marked done, and computing a chunk twice writes the
+same results, so a worker whose lease expired can not corrupt the job.  The
+creating and merging locks are leased the same way, so if the process creating
+the queue or merging its results dies, another worker takes over.
+'''
+
+import json
+import os
+import random
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+import nested
+import orthutil
+
+
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_CHUNK_SIZE = 100
+QUEUE_NESTING = 2
+CONFIG_NAME = 'config.json'
+CREATING_NAME = 'creating'
+MERGING_NAME = 'merging'
+MERGED_NAME = 'merged'
+OWNER_NAME = 'owner'
+TICKET_PREFIX = 'chunk'
+DROPPED_SUFFIX = '.dropped.json'
+
+
+class Ticket(object):
+    '''
+    A claimed chunk of query sequence ids.
+    '''
+    def __init__(self, name, path, ids):
+        self.name, self.path, self.ids = name, path, ids
+
+
+class Lease(object):
+    '''
+    context manager that refreshes the modification time of a claimed ticket or a held lock from a background thread, so
+    other workers do not reclaim it, until the 'with' statement exits.
+    '''
+    def __init__(self, path, interval):
+        self.path, self.interval = path, interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._refresh)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _refresh(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                # the ticket or lock was reclaimed by another worker.
+                return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class QueueLock(object):
+    '''
+    A step of the job that only one worker may do at a time, e.g. creating the queue or merging its results.  The lock
+    is a directory, which only one worker can make, holding a file with the id of its holder.  The holder keeps a lease
+    on the lock by refreshing its modification time, like a claimed ticket, so if the holder dies, the lease expires and
+    another worker takes the lock over.
+    '''
+    def __init__(self, path, leaseSeconds, workerId, donePath=None):
+        '''
+        path: the lock directory.
+        donePath: if not None, releasing the lock renames it to donePath, to record that the step is done.  Otherwise
+          releasing the lock removes it.
+        '''
+        self.path, self.leaseSeconds, self.workerId, self.donePath = path, leaseSeconds, workerId, donePath
+        self.lease = None
+
+    def owner(self, path=None):
+        '''
+        path: the lock directory, or a lock renamed away from it.  Defaults to the lock directory.
+        returns: the id of the worker holding the lock, or None if the lock is free or its holder has not written its id.
+        '''
+        try:
+            with open(os.path.join(path or self.path, OWNER_NAME)) as fh:
+                return fh.read()
+        except IOError:
+            return None
+
+    def isStale(self, path=None):
+        try:
+            return time.time() - os.path.getmtime(path or self.path) >= self.leaseSeconds
+        except OSError:
+            # the lock was released.
+            return False
+
+    def acquire(self):
+        '''
+        A stale lock is taken over by renaming it away, which only one worker can do.  Another worker may have taken the
+        lock over and made a fresh one since this worker found it stale, in which case the rename moves the fresh lock.
+        So the renamed lock is checked again, and if it is not the stale lock, it is renamed back.
+        returns: True if this worker now holds the lock, because it was free or because the lease of its holder expired.
+        '''
+        try:
+            os.mkdir(self.path)
+        except OSError:
+            staleOwner = self.owner()
+            if not self.isStale():
+                return False
+            stalePath = '{}.stale.{}'.format(self.path, self.workerId)
+            try:
+                os.rename(self.path, stalePath)
+            except OSError:
+                # another worker took the lock over first.
+                return False
+            if self.owner(stalePath) != staleOwner or not self.isStale(stalePath):
+                # another worker took the lock over after it was found stale.  give it back.
+                try:
+                    os.rename(stalePath, self.path)
+                except OSError:
+                    pass
+                return False
+            shutil.rmtree(stalePath, ignore_errors=True)
+            try:
+                os.mkdir(self.path)
+            except OSError:
+                return False
+        try:
+            # fails if another worker replaced the new lock with its own.
+            fd = os.open(os.path.join(self.path, OWNER_NAME), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError:
+            return False
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(self.workerId)
+        self.lease = Lease(self.path, max(1.0, self.leaseSeconds / 4.0))
+        self.lease.start()
+        return True
+
+    def release(self, done=True):
+        '''
+        done: if False, the step was not finished, so the lock is removed even if it has a donePath, and another worker
+          can do the step.
+        '''
+        self.lease.stop()
+        if self.owner() != self.workerId:
+            # the lease expired and another worker took the lock over.
+            return
+        try:
+            if done and self.donePath:
+                os.rename(self.path, self.donePath)
+            else:
+                shutil.rmtree(self.path)
+        except OSError:
+            pass
+
+
+class WorkQueue(object):
+
+    def __init__(self, queueDir, leaseSeconds=DEFAULT_LEASE_SECONDS, workerId=None):
+        '''
+        queueDir: the queue directory, on a filesystem shared by all workers.
+        leaseSeconds: a claimed ticket whose modification time is older than this is considered abandoned and reclaimed.
+        workerId: a name for this worker, unique across nodes.  Defaults to the hostname, pid and a random suffix.
+        '''
+        self.queueDir = os.path.abspath(queueDir)
+        self.leaseSeconds = leaseSeconds
+        self.workerId = workerId or '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.configPath = os.path.join(self.queueDir, CONFIG_NAME)
+        self.todoDir, self.claimedDir, self.doneDir, self.resultsDir = [os.path.join(self.queueDir, name) for name in ('todo', 'claimed', 'done', 'results')]
+        # the rank of each ticket name in the claim order of the queue, read from its config by claim().
+        self.claimRanks = None
+
+    def exists(self):
+        return os.path.exists(self.configPath)
+
+    def create(self, config, chunks, costs=None, wait=1.0):
+        '''
+        config: a json serializable dict describing the job.  Saved as config.json.
+        chunks: a list of lists of query sequence ids.  A ticket is created for each chunk, in order.
+        costs: an optional list of the estimated cost of each chunk (see rsd.estimateQueryCosts()).  If given, workers
+          claim the costliest chunks first, so a chunk of long sequences does not start last and finish long after the
+          others.  The order of the results does not change.
+        wait: seconds between checks for the config, if another process is creating the queue.
+        Creates the queue, unless it already exists.  If several processes try to create the queue at once, one of them
+        creates it and the others wait until it is complete.  If the creating process dies, its lease on the creating
+        lock expires and a waiting process creates the queue again from scratch.
+        returns: the config of the queue, which was created by this or another process.
+        '''
+        if not os.path.isdir(self.queueDir):
+            try:
+                os.makedirs(self.queueDir)
+            except OSError:
+                if not os.path.isdir(self.queueDir):
+                    raise
+        lock = QueueLock(os.path.join(self.queueDir, CREATING_NAME), self.leaseSeconds, self.workerId)
+        while not self.exists():
+            if lock.acquire():
+                break
+            time.sleep(wait)
+        else:
+            return self.config()
+
+        try:
+            # the creator finished just before this process took the lock.
+            if self.exists():
+                return self.config()
+            # remove what a creator that died left behind.
+            for dir in (self.todoDir, self.claimedDir, self.doneDir, self.resultsDir):
+                if os.path.isdir(dir):
+                    shutil.rmtree(dir)
+                os.mkdir(dir)
+            for i, ids in enumerate(chunks):
+                name = '{}{:08d}'.format(TICKET_PREFIX, i)
+                _writeAtomically(nested.makeNestedPath(name, dir=self.todoDir, nesting=QUEUE_NESTING), json.dumps(ids))
+            config = dict(config, numChunks=len(chunks))
+            if costs is not None:
+                # sorted() is stable, so chunks of equal cost are claimed in order.
+                config['claimOrder'] = sorted(range(len(chunks)), key=lambda i: -costs[i])
+            _writeAtomically(self.configPath, json.dumps(config, indent=2, sort_keys=True))
+            return config
+        finally:
+            lock.release()
+
+    def config(self):
+        with open(self.configPath) as fh:
+            return json.load(fh)
+
+    def _ticketNames(self, dir):
+        '''
+        returns: the names of the ticket files under dir.
+        '''
+        names = []
+        for dirpath, dirnames, filenames in os.walk(dir):
+            names.extend(filename for filename in filenames if filename.startswith(TICKET_PREFIX) and '.tmp.' not in filename)
+        return names
+
+    def _claimedPath(self, name):
+        '''
+        name: the name of a ticket or claimed ticket.  Claimed tickets are nested by their ticket name.
+        '''
+        return os.path.join(nested.makeNestedSeedDir(name.split('.')[0], dir=self.claimedDir, nesting=QUEUE_NESTING), name)
+
+    def reclaimStale(self):
+        '''
+        Moves claimed tickets whose lease has expired back to todo, so other workers can claim them.
+        returns: the number of tickets reclaimed.
+        '''
+        numReclaimed = 0
+        now = time.time()
+        for claimedName in self._ticketNames(self.claimedDir):
+            claimedPath = self._claimedPath(claimedName)
+            name = claimedName.split('.')[0]
+            try:
+                if now - os.path.getmtime(claimedPath) < self.leaseSeconds:
+                    continue
+                os.rename(claimedPath, nested.makeNestedPath(name, dir=self.todoDir, nesting=QUEUE_NESTING))
+                numReclaimed += 1
+            except OSError:
+                # the ticket was completed or reclaimed by another worker.
+                pass
+        return numReclaimed
+
+    def claim(self):
+        '''
+        Claims a ticket waiting in todo.  Tickets are tried costliest first if the queue was created with costs, and
+        otherwise in random order to reduce contention between workers.
+        returns: a Ticket, or None if no ticket is waiting.
+        '''
+        names = self._ticketNames(self.todoDir)
+        if self.claimRanks is None:
+            self.claimRanks = dict(('{}{:08d}'.format(TICKET_PREFIX, i), rank) for rank, i in enumerate(self.config().get('claimOrder', [])))
+        if self.claimRanks:
+            names.sort(key=lambda name: self.claimRanks.get(name, len(self.claimRanks)))
+        else:
+            random.shuffle(names)
+        for name in names:
+            claimedPath = self._claimedPath(name + '.' + self.workerId)
+            try:
+                os.rename(nested.getNestedPath(name, dir=self.todoDir, nesting=QUEUE_NESTING), claimedPath)
+            except OSError:
+                # another worker claimed it first.
+                continue
+            # refresh the lease.  rename preserves the modification time of the todo ticket.
+            os.utime(claimedPath, None)
+            with open(claimedPath) as fh:
+                ids = json.load(fh)
+            return Ticket(name, claimedPath, ids)
+        return None
+
+    def lease(self, ticket):
+        '''
+        returns: a context manager that keeps the lease on ticket while the orthologs of its chunk are computed.
+        '''
+        return Lease(ticket.path, max(1.0, self.leaseSeconds / 4.0))
+
+    def resultPath(self, name):
+        return nested.makeNestedPath(name, dir=self.resultsDir, nesting=QUEUE_NESTING)
+
+    def isResultSaved(self, ticket):
+        return os.path.exists(self.resultPath(ticket.name))
+
+    def complete(self, ticket, orthDatas=None, dropped=None):
+        '''
+        ticket: a claimed ticket.
+        orthDatas: the orthologs computed for the chunk of the ticket.  If None, the results were already saved, e.g. by
+          a worker whose lease expired, and the ticket is only marked done.
+        dropped: a dict from a reason, e.g. a tool that timed out, to a list of the pairs of sequence ids dropped for
+          that reason while computing the chunk, or None.  Saved with the results.  See dropped().
+        Saves the results of a ticket and then moves the ticket to done.
+        returns: True if the ticket was marked done by this worker.  False if the lease expired and the ticket was
+          reclaimed, in which case the saved results are still valid.
+        '''
+        if orthDatas is not None:
+            resultPath = self.resultPath(ticket.name)
+            if dropped:
+                _writeAtomically(resultPath + DROPPED_SUFFIX, json.dumps(dropped))
+            tmpPath = '{}.tmp.{}'.format(resultPath, self.workerId)
+            orthutil.orthDatasToFile(orthDatas, tmpPath)
+            os.rename(tmpPath, resultPath)
+        try:
+            os.rename(ticket.path, nested.makeNestedPath(ticket.name, dir=self.doneDir, nesting=QUEUE_NESTING))
+            return True
+        except OSError:
+            return False
+
+    def numDone(self):
+        return len(self._ticketNames(self.doneDir))
+
+    def numClaimed(self):
+        return len(self._ticketNames(self.claimedDir))
+
+    def isDone(self):
+        return self.numDone() == self.config()['numChunks']
+
+    def isMerged(self):
+        return os.path.isdir(os.path.join(self.queueDir, MERGED_NAME))
+
+    def claimMerge(self):
+        '''
+        Only one worker at a time can hold the merge.  If the merging worker dies, its lease expires and another worker
+        takes the merge over.
+        returns: a held QueueLock, for the worker that should merge the results once the queue is done and then release
+          the lock to mark the queue merged.  None if another worker is merging or has merged the results.
+        '''
+        lock = QueueLock(os.path.join(self.queueDir, MERGING_NAME), self.leaseSeconds, self.workerId,
+                         donePath=os.path.join(self.queueDir, MERGED_NAME))
+        if self.isMerged() or not lock.acquire():
+            return None
+        if self.isMerged():
+            # the merge finished just before this worker took the lock.
+            lock.release(done=False)
+            return None
+        return lock
+
+    def resultsGen(self):
+        '''
+        yields: the orthDatas of every chunk, in chunk order.
+        '''
+        for i in range(self.config()['numChunks']):
+            path = nested.getNestedPath('{}{:08d}'.format(TICKET_PREFIX, i), dir=self.resultsDir, nesting=QUEUE_NESTING)
+            if not os.path.exists(path):
+                raise Exception('The results of chunk {} in {} are missing.  There is nothing to merge until the chunk is computed.'.format(i, self.queueDir))
+            for orthData in orthutil.orthDatasFromFileGen(path):
+                yield orthData
+
+
+    def dropped(self):
+        '''
+        returns: a dict from each reason pairs were dropped to a list of the pairs dropped for that reason, as (id, id)
+          tuples, for every chunk, in chunk order.
+        '''
+        dropped = {}
+        for i in range(self.config()['numChunks']):
+            path = nested.getNestedPath('{}{:08d}'.format(TICKET_PREFIX, i), dir=self.resultsDir, nesting=QUEUE_NESTING) + DROPPED_SUFFIX
+            if os.path.exists(path):
+                with open(path) as fh:
+                    for reason, pairs in sorted(json.load(fh).items()):
+                        dropped.setdefault(reason, []).extend(tuple(pair) for pair in pairs)
+        return dropped
+
+
+def _writeAtomically(path, data):
+    tmpPath = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmpPath, 'w') as fh:
+        fh.write(data)
+    os.rename(tmpPath, path)
+
+
+def chunkIds(ids, chunkSize=DEFAULT_CHUNK_SIZE):
+    '''
+    returns: a list of consecutive chunks of ids, each with at most chunkSize ids.
+    '''
+    return [ids[i:i+chunkSize] for i in range(0, len(ids), chunkSize)]
+
+
+def runWorker(queue, computeChunk, poll=None, verbose=False):
+    '''
+    queue: a created WorkQueue.
+    computeChunk: a function that takes a list of query sequence ids and returns their orthDatas and the pairs dropped
+      while computing them (see WorkQueue.complete()).
+    poll: seconds to wait between checks for work when no ticket is waiting but some are claimed by other workers.
+      Defaults to a quarter of the lease.
+    Claims and completes tickets until the queue is done.  While other workers hold tickets, waits and reclaims any
+    tickets whose lease expires, so the queue is finished as long as one worker keeps running.
+    returns: the number of tickets completed by this worker.
+    '''
+    poll = poll if poll is not None else max(1.0, queue.leaseSeconds / 4.0)
+    numCompleted = 0
+    while not queue.isDone():
+        queue.reclaimStale()
+        ticket = queue.claim()
+        if ticket is None:
+            time.sleep(poll)
+            continue
+        if verbose:
+            print 'claimed', ticket.name, 'with', len(ticket.ids), 'query sequences'
+        if queue.isResultSaved(ticket):
+            orthDatas, dropped = None, None
+        else:
+            with queue.lease(ticket):
+                orthDatas, dropped = computeChunk(ticket.ids)
+        if queue.complete(ticket, orthDatas, dropped):
+            numCompleted += 1
+    return numCompleted
+
+
+def mergedOrthologsGen(queue, divEvalue):
+    '''
+    divEvalue: a (div, evalue) pair from the config of the queue.
+    yields: the orthologs of every chunk for divEvalue, in chunk order, which is the order a single run would find them.
+    '''
+    div, evalue = ('{}'.format(param) for param in divEvalue)
+    for (qdb, sdb, chunkDiv, chunkEvalue), orthologs in queue.resultsGen():
+        if (chunkDiv, chunkEvalue) == (div, evalue):
+            for ortholog in orthologs:
+                yield ortholog
+
+
+# last line
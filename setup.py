@@ -38,12 +38,12 @@ setup(
     platforms = "Posix; MacOS X",
     url = "https://github.com/todddeluca/reciprocal_smallest_distance",   # project home page, if any
     download_url = "https://github.com/todddeluca/reciprocal_smallest_distance/downloads",
-    scripts = ['bin/rsd_search', 'bin/rsd_format', 'bin/rsd_blast'],
+    scripts = ['bin/rsd_search', 'bin/rsd_format', 'bin/rsd_blast', 'bin/rsd_bench', 'bin/rsd_index', 'bin/rsd_merge', 'bin/rsd_update'],
     packages = ['rsd'],
     package_data = {
         'rsd': ['*.ctl', '*.dat'],
         },
-    test_suite='tests.test_search.TestSearch',
+    test_suite='tests',
     classifiers = [
         'Development Status :: 5 - Production/Stable',
         'Environment :: Console',
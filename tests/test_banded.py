@@ -0,0 +1,85 @@
+
+import random
+import shutil
+import tempfile
+import unittest
+
+import rsd.banded
+import rsd.rsd
+import rsd.search
+from tests.test_orthologs import FakeTools, QUERY_SEQS, SUBJECT_SEQS, FORWARD_HITS, REVERSE_HITS, getHitsFunc
+
+
+def withHsps(hitsMap, seqs, hitSeqs):
+    '''
+    returns: hitsMap with an hsp spanning both sequences added to every hit.
+    '''
+    return dict((seqId, [(hitId, evalue, (1, len(seqs[seqId]), 1, len(hitSeqs[hitId]))) for hitId, evalue in hits])
+                for seqId, hits in hitsMap.items())
+
+
+class TestBandedAlignment(unittest.TestCase):
+
+    def test_alignments(self):
+        seq = 'MKTAYIAKQRQISFVKSHFSRQ'
+        self.assertEqual((seq, seq), rsd.banded.alignBanded(seq, seq, -3, 3))
+        # overhanging ends are aligned to gaps for free.
+        self.assertEqual(('WWWWWWWW' + seq + '-----', '--------' + seq + 'YYYYY'),
+                         rsd.banded.alignBanded('WWWWWWWW' + seq, seq + 'YYYYY', -10, -6))
+        self.assertEqual((0, 6), rsd.banded.bandForHsp((3, 20, 5, 24), 22, 30, margin=2))
+        self.assertEqual((-22, 30), rsd.banded.bandForHsp((3, 20, 5, 24), 22, 30))
+
+    def test_python_matches_numpy(self):
+        if rsd.banded.numpy is None:
+            return
+        rand = random.Random(4)
+        alphabet = rsd.search.ALPHABET[:20]
+        for i in range(100):
+            seq = ''.join(rand.choice(alphabet) for j in range(rand.randint(1, 50)))
+            hitSeq = list(seq)
+            for k in range(rand.randint(0, 8)):
+                pos = rand.randrange(len(hitSeq) + 1)
+                if rand.random() < 0.5:
+                    hitSeq.insert(pos, rand.choice(alphabet))
+                elif pos < len(hitSeq):
+                    del hitSeq[pos]
+            hitSeq = ''.join(hitSeq) or 'W'
+            low = rand.randint(-len(seq), len(hitSeq))
+            high = rand.randint(low, len(hitSeq))
+            aligned = rsd.banded.alignBanded(seq, hitSeq, low, high)
+            matrices = rsd.banded._bandedMatricesPython(rsd.search.encode(seq), rsd.search.encode(hitSeq), low, high)
+            self.assertEqual(aligned, rsd.banded._traceback(seq, hitSeq, low, *matrices))
+            self.assertEqual((seq, hitSeq), tuple(alignedSeq.replace('-', '') for alignedSeq in aligned))
+            # every aligned pair of residues is in the band.
+            self.assertTrue(all(low <= j - i <= high for i, j in rsd.banded.alignedResiduePairs(*aligned)))
+
+
+class TestBandedAlignMode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.alignMode = rsd.rsd.ALIGN_MODE
+
+    def tearDown(self):
+        rsd.rsd.setAlignMode(self.alignMode)
+        shutil.rmtree(self.tmpDir)
+
+    def computeOrthologs(self, forwardHits, reverseHits):
+        divEvalues = [('0.8', '1e-5'), ('0.8', '1e-2')]
+        with FakeTools() as tools:
+            divEvalueToOrthologs = rsd.rsd._computeOrthologsSub(['q1', 'q2', 'q3'], QUERY_SEQS.get, SUBJECT_SEQS.get, divEvalues,
+                                                                getHitsFunc(forwardHits), getHitsFunc(reverseHits), self.tmpDir)
+        return divEvalueToOrthologs, tools.numAlignments
+
+    def test_hits_with_hsps_are_aligned_in_band(self):
+        forwardHits = withHsps(FORWARD_HITS, QUERY_SEQS, SUBJECT_SEQS)
+        reverseHits = withHsps(REVERSE_HITS, SUBJECT_SEQS, QUERY_SEQS)
+        expected, numAlignments = self.computeOrthologs(forwardHits, reverseHits)
+        self.assertTrue(numAlignments)
+        rsd.rsd.setAlignMode(rsd.rsd.BANDED_ALIGN_MODE)
+        self.assertEqual((expected, 0), self.computeOrthologs(forwardHits, reverseHits))
+        # hits without hsps are aligned in full.
+        self.assertEqual((expected, numAlignments), self.computeOrthologs(FORWARD_HITS, REVERSE_HITS))
+        self.assertRaises(ValueError, rsd.rsd.setAlignMode, 'fast')
+
+
@@ -0,0 +1,76 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rsd.bench
+import rsd.fasta
+import rsd.util
+
+
+class TestSyntheticProteomes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.queryPath = os.path.join(self.tmpDir, 'query.faa')
+        self.subjectPath = os.path.join(self.tmpDir, 'subject.faa')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_sizes_and_orthologs(self):
+        orthologs = rsd.bench.makeSyntheticProteomes(self.queryPath, self.subjectPath, 50, 80, paralogRate=0.5, seed=1)
+        queryIds = list(rsd.fasta.readIds(self.queryPath))
+        subjectIds = list(rsd.fasta.readIds(self.subjectPath))
+        self.assertEqual(50, len(queryIds))
+        self.assertEqual(80, len(subjectIds))
+        self.assertEqual(50, len(set(queryIds)))
+        self.assertTrue(orthologs)
+        for qid, sid in orthologs:
+            self.assertIn(qid, queryIds)
+            self.assertIn(sid, subjectIds)
+
+    def test_deterministic(self):
+        rsd.bench.makeSyntheticProteomes(self.queryPath, self.subjectPath, 20, 20, seed=7)
+        first = list(rsd.fasta.readFasta(self.queryPath))
+        rsd.bench.makeSyntheticProteomes(self.queryPath, self.subjectPath, 20, 20, seed=7)
+        self.assertEqual(first, list(rsd.fasta.readFasta(self.queryPath)))
+
+
+class TestStageTimer(unittest.TestCase):
+
+    def test_timing_and_merge(self):
+        timer = rsd.util.StageTimer()
+        with timer.timing('align', units=10):
+            pass
+        with timer.timing('align', units=5):
+            pass
+        other = rsd.util.StageTimer()
+        other.merge(timer.snapshot())
+        other.merge(timer.snapshot())
+        self.assertEqual(2, timer.snapshot()['align']['calls'])
+        self.assertEqual(15, timer.snapshot()['align']['units'])
+        self.assertEqual(30, other.snapshot()['align']['units'])
+
+
+
+
+def _dieHard(*args, **keywords):
+    os._exit(3)
+
+
+class TestBenchmarkRunInProcess(unittest.TestCase):
+
+    def test_run_that_dies_raises(self):
+        benchmarkRun = rsd.bench.benchmarkRun
+        pollSeconds = rsd.bench.RUN_POLL_SECONDS
+        rsd.bench.benchmarkRun = _dieHard
+        rsd.bench.RUN_POLL_SECONDS = 0.05
+        try:
+            with self.assertRaises(Exception) as context:
+                rsd.bench.benchmarkRunInProcess(10)
+            self.assertEqual(3, context.exception.args[1])
+        finally:
+            rsd.bench.benchmarkRun = benchmarkRun
+            rsd.bench.RUN_POLL_SECONDS = pollSeconds
@@ -0,0 +1,69 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rsd.fasta
+import rsd.orthutil
+import rsd.rsd
+import rsd.util
+
+
+FASTA = '>lcl|a\nMKTAYIAKQR\nQISFVK\n>lcl|b\nMSSHHHHHH\n'
+HITS = 'a\tb\t95.0\t10\t0\t0\t1\t10\t1\t10\t1e-30\t50.0\na\tc\t90.0\t10\t1\t0\t1\t10\t1\t10\t1e-10\t40.0\n'
+
+
+class TestCompressedFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.tmpDir, name)
+        with rsd.util.openFile(path, 'w') as fh:
+            fh.write(data)
+        return path
+
+    def test_detection_by_magic_bytes(self):
+        for name, compression in (('plain.faa', None), ('genome.faa.gz', 'gzip'), ('genome.faa.bz2', 'bz2')):
+            path = self.writeFile(name, FASTA)
+            self.assertEqual(compression, rsd.util.compressionOfFile(path))
+            # a misleading name does not matter when reading.
+            renamed = os.path.join(self.tmpDir, 'renamed_' + name.replace('.', '_'))
+            os.rename(path, renamed)
+            self.assertEqual(compression, rsd.util.compressionOfFile(renamed))
+            with rsd.util.openFile(renamed) as fh:
+                self.assertEqual(FASTA, fh.read())
+
+    def test_read_fasta_and_hits(self):
+        for name in ('genome.faa', 'genome.faa.gz', 'genome.faa.bz2'):
+            path = self.writeFile(name, FASTA)
+            self.assertEqual([('>lcl|a', 'MKTAYIAKQRQISFVK'), ('>lcl|b', 'MSSHHHHHH')], list(rsd.fasta.readFasta(path)))
+            self.assertEqual(2, rsd.fasta.numSeqsInPath(path))
+        for name in ('hits.txt', 'hits.txt.gz', 'hits.txt.bz2'):
+            path = self.writeFile(name, HITS)
+            self.assertEqual({'a': [('b', 1e-30, (1, 10, 1, 10), (50.0, 10, 95.0, None, None)), ('c', 1e-10, (1, 10, 1, 10), (40.0, 10, 90.0, None, None))]},
+                             rsd.rsd.parseResults(path))
+
+    def test_orth_datas_roundtrip(self):
+        orthDatas = [(('G1', 'G2', '0.8', '1e-5'), [('a', 'b', '0.1')]), (('G2', 'G1', '0.8', '1e-5'), [])]
+        for name in ('orthologs.txt.gz', 'orthologs.txt.bz2'):
+            path = os.path.join(self.tmpDir, name)
+            rsd.orthutil.orthDatasToFile(orthDatas, path)
+            self.assertTrue(rsd.util.compressionOfFile(path))
+            self.assertEqual(orthDatas, list(rsd.orthutil.orthDatasFromFileGen(path)))
+
+    def test_copy_fasta_decompresses(self):
+        srcPath = self.writeFile('genome.faa.gz', FASTA)
+        destDir = os.path.join(self.tmpDir, 'dest')
+        os.mkdir(destDir)
+        destPath = rsd.rsd.copyFastaArg(srcPath, destDir)
+        self.assertEqual(os.path.join(destDir, 'genome.faa'), destPath)
+        with open(destPath) as fh:
+            self.assertEqual(FASTA, fh.read())
+
+
@@ -0,0 +1,113 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rsd.bench
+import rsd.diskstore
+import rsd.fasta
+import rsd.rsd
+import rsd.util
+
+
+class TestDiskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.diskBacked = dict(rsd.rsd.DISK_BACKED)
+        self.diskBackedDir = rsd.rsd.DISK_BACKED_DIR
+        self.searchBackend = rsd.rsd.SEARCH_BACKEND
+
+    def tearDown(self):
+        rsd.rsd.setDiskBacked(self.diskBacked['seqs'], self.diskBacked['hits'])
+        rsd.rsd.DISK_BACKED_DIR = self.diskBackedDir
+        rsd.rsd.setSearchBackend(self.searchBackend)
+        shutil.rmtree(self.tmpDir)
+
+    def test_hits_store_reads_like_pickled_hits(self):
+        hitsMap = {'q1': [('s1', 1e-30), ('s2', 1e-9)], 'q2': [('s1', 1e-6)]}
+        picklePath = os.path.join(self.tmpDir, 'hits.pickle')
+        rsd.util.dumpObject(hitsMap, picklePath)
+        storePath = rsd.diskstore.writeHitsStore(hitsMap.iteritems(), os.path.join(self.tmpDir, 'hits.sqlite'))
+        self.assertFalse(rsd.diskstore.isSqliteFile(picklePath))
+        store = rsd.rsd.loadBlastHits(storePath)
+        self.assertEqual(hitsMap, dict(store.iteritems()))
+        self.assertEqual(hitsMap['q1'], store['q1'])
+        self.assertEqual(None, store.get('q3'))
+        self.assertEqual(2, len(store))
+        self.assertTrue('q2' in store)
+        store.close()
+        rsd.rsd.setDiskBacked(hits=True, dir=self.tmpDir)
+        for path in (picklePath, storePath):
+            getHits = rsd.rsd.makeGetSavedHits(path)
+            self.assertEqual(hitsMap['q1'], getHits('q1', 'MKV'))
+            self.assertEqual(None, getHits('q3', 'MKV'))
+
+    def test_hits_store_keeps_hit_stats(self):
+        resultsPath = os.path.join(self.tmpDir, 'hits.txt')
+        with open(resultsPath, 'w') as fh:
+            fh.write('lcl|q1\tlcl|s1\t80.00\t50\t10\t0\t1\t50\t11\t60\t1e-30\t99.5\t100\t200\n')
+            fh.write('lcl|q1\tlcl|s2\t40.00\t20\t12\t0\t81\t100\t20\t1\t1e-09\t30.1\t100\t40\n')
+        hitsMap = rsd.rsd.parseResults(resultsPath)
+        self.assertEqual({'q1': [('s1', 1e-30, (1, 50, 11, 60), (99.5, 50, 80.0, 0.5, 0.25)),
+                                 ('s2', 1e-9, (81, 100, 20, 1), (30.1, 20, 40.0, 0.2, 0.5))]}, hitsMap)
+        storePath = rsd.diskstore.writeHitsStore(hitsMap.iteritems(), os.path.join(self.tmpDir, 'hits.sqlite'))
+        store = rsd.rsd.loadBlastHits(storePath)
+        self.assertEqual(hitsMap, dict(store.iteritems()))
+        self.assertEqual((99.5, 50, 80.0, 0.5, 0.25), rsd.rsd.getHitStats(store['q1'][0]))
+        store.close()
+
+    def test_seq_store(self):
+        queryPath = os.path.join(self.tmpDir, 'query.faa')
+        rsd.bench.makeSyntheticProteomes(queryPath, os.path.join(self.tmpDir, 'subject.faa'), 10, 10, meanLength=80, seed=1)
+        getInMemory = rsd.rsd.makeGetSeqForId(queryPath)
+        rsd.rsd.setDiskBacked(seqs=True, dir=self.tmpDir)
+        getOnDisk = rsd.rsd.makeGetSeqForId(queryPath)
+        for seqId in rsd.fasta.readIds(queryPath):
+            self.assertEqual(getInMemory(seqId), getOnDisk(seqId))
+        self.assertRaises(KeyError, getOnDisk, 'missing')
+
+    def test_compute_hits_store(self):
+        queryPath = os.path.join(self.tmpDir, 'query.faa')
+        subjectPath = os.path.join(self.tmpDir, 'subject.faa')
+        rsd.bench.makeSyntheticProteomes(queryPath, subjectPath, 20, 20, meanLength=100, seed=4)
+        rsd.rsd.setSearchBackend('kmer')
+        expected = rsd.rsd.getBlastHits(queryPath, subjectPath, 1e-5, workingDir=self.tmpDir)
+        rsd.rsd.setDiskBacked(hits=True, dir=self.tmpDir)
+        hitsPath = os.path.join(self.tmpDir, 'forward.hits')
+        rsd.rsd.computeBlastHits(queryPath, subjectPath, hitsPath, 1e-5, workingDir=self.tmpDir)
+        self.assertTrue(rsd.diskstore.isSqliteFile(hitsPath))
+        self.assertEqual(expected, dict(rsd.rsd.loadBlastHits(hitsPath).iteritems()))
+
+    def test_estimates_measure_compressed_files_decompressed(self):
+        queryPath = os.path.join(self.tmpDir, 'query.faa')
+        rsd.bench.makeSyntheticProteomes(queryPath, os.path.join(self.tmpDir, 'subject.faa'), 50, 10, meanLength=100, seed=1)
+        hitsPath = os.path.join(self.tmpDir, 'hits.pickle')
+        rsd.util.dumpObject(dict(('q{}'.format(i), [('s1', 1e-30)] * 3) for i in range(100)), hitsPath)
+        for path in (queryPath, hitsPath):
+            for ext in ('.gz', '.bz2'):
+                with open(path, 'rb') as src, rsd.util.openFile(path + ext, 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
+                self.assertTrue(os.path.getsize(path + ext) < os.path.getsize(path))
+                self.assertEqual(os.path.getsize(path), rsd.util.uncompressedSize(path + ext))
+        for ext in ('.gz', '.bz2'):
+            self.assertEqual(rsd.diskstore.estimateSeqsBytes(queryPath), rsd.diskstore.estimateSeqsBytes(queryPath + ext))
+            self.assertEqual(rsd.diskstore.estimateHitsBytes(hitsPath), rsd.diskstore.estimateHitsBytes(hitsPath + ext))
+            self.assertEqual(rsd.diskstore.estimateHitsBytes(queryFastaPath=queryPath),
+                             rsd.diskstore.estimateHitsBytes(queryFastaPath=queryPath + ext))
+
+    def test_choose_disk_backed(self):
+        base = rsd.diskstore.BASE_BYTES
+        self.assertEqual((False, False), rsd.diskstore.chooseDiskBacked(base + 300, 100, 200))
+        self.assertEqual((False, True), rsd.diskstore.chooseDiskBacked(base + 200, 100, 200))
+        self.assertEqual((True, True), rsd.diskstore.chooseDiskBacked(base + 50, 100, 200))
+
+    def test_parse_bytes(self):
+        self.assertEqual(1000, rsd.util.parseBytes('1000'))
+        self.assertEqual(512 * 2**20, rsd.util.parseBytes('512M'))
+        self.assertEqual(4 * 2**30, rsd.util.parseBytes('4gb'))
+        self.assertEqual(3 * 2**29, rsd.util.parseBytes('1.5G'))
+        self.assertRaises(ValueError, rsd.util.parseBytes, 'lots')
+
+
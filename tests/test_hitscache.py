@@ -0,0 +1,86 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rsd.bench
+import rsd.diskstore
+import rsd.fasta
+import rsd.rsd
+import rsd.util
+from tests.test_update import SeqDistanceTools
+
+
+class TestHitsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.searchBackend = rsd.rsd.SEARCH_BACKEND
+        rsd.rsd.setSearchBackend('kmer')
+
+    def tearDown(self):
+        rsd.rsd.setSearchBackend(self.searchBackend)
+        shutil.rmtree(self.tmpDir)
+
+    def test_lookup_by_evalue(self):
+        cache = rsd.diskstore.HitsCache(os.path.join(self.tmpDir, 'hits.sqlite'))
+        self.assertEqual(None, cache.lookup('q1', 1e-5))
+        cache.add({'q1': [('s1', 1e-30), ('s2', 1e-9)], 'q2': None}, 1e-5)
+        self.assertEqual([('s1', 1e-30), ('s2', 1e-9)], cache.lookup('q1', 1e-5))
+        self.assertEqual([('s1', 1e-30)], cache.lookup('q1', 1e-10))
+        self.assertEqual([], cache.lookup('q2', 1e-5))
+        # searched with a stricter evalue than the lookup needs.
+        self.assertEqual(None, cache.lookup('q1', 1e-3))
+        cache.add({'q1': [('s3', 1e-4)]}, 1e-3)
+        self.assertEqual([('s3', 1e-4)], cache.lookup('q1', 1e-3))
+        self.assertEqual(2, len(cache))
+        # a hits cache is also a hits store.
+        self.assertEqual({'q1': [('s3', 1e-4)]}, dict(rsd.rsd.loadBlastHits(cache.path).iteritems()))
+        cache.close()
+
+    def test_lru_cache(self):
+        lru = rsd.util.LruCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(1, lru.get('a'))
+        lru.put('c', 3)
+        self.assertEqual(None, lru.get('b'))
+        self.assertEqual((1, 3), (lru.get('a'), lru.get('c')))
+
+    def test_repeated_runs_read_through_cache(self):
+        queryPath = os.path.join(self.tmpDir, 'query.faa')
+        subjectPath = os.path.join(self.tmpDir, 'subject.faa')
+        rsd.bench.makeSyntheticProteomes(queryPath, subjectPath, 30, 30, meanLength=100, seed=6)
+        queryIds = list(rsd.fasta.readIds(queryPath))
+        cacheDir = os.path.join(self.tmpDir, 'cache')
+        divEvalues = [('0.8', '1e-5')]
+
+        def run(ids):
+            getForwardHits = rsd.rsd.makeGetCachedHits(subjectPath, 1e-5, rsd.rsd.hitsCachePath(cacheDir, queryPath, subjectPath))
+            getReverseHits = rsd.rsd.makeGetCachedHits(queryPath, 1e-5, rsd.rsd.hitsCachePath(cacheDir, subjectPath, queryPath))
+            with SeqDistanceTools():
+                divEvalueToOrthologs = rsd.rsd.computeOrthologs(queryPath, subjectPath, divEvalues, getForwardHits, getReverseHits, ids)
+            return divEvalueToOrthologs, getForwardHits.stats, getReverseHits.stats
+
+        os.makedirs(cacheDir)
+        forwardHits = rsd.rsd.getBlastHits(queryPath, subjectPath, 1e-5, workingDir=self.tmpDir)
+        reverseHits = rsd.rsd.getBlastHits(subjectPath, queryPath, 1e-5, workingDir=self.tmpDir)
+        with SeqDistanceTools():
+            expected = rsd.rsd.computeOrthologs(queryPath, subjectPath, divEvalues, lambda seqId, seq: forwardHits.get(seqId),
+                                                lambda seqId, seq: reverseHits.get(seqId), queryIds[:20])
+
+        firstOrthologs, firstForward, firstReverse = run(queryIds[:10])
+        self.assertEqual(10, firstForward['searched'])
+        self.assertTrue(firstReverse['searched'])
+        # the second run searches only the ids the first run did not.
+        secondOrthologs, secondForward, secondReverse = run(queryIds[:20])
+        self.assertEqual(10, secondForward['searched'])
+        thirdOrthologs, thirdForward, thirdReverse = run(queryIds[:20])
+        self.assertEqual(0, thirdForward['searched'] + thirdReverse['searched'])
+        self.assertTrue(expected[divEvalues[0]])
+        self.assertEqual(expected, secondOrthologs)
+        self.assertEqual(expected, thirdOrthologs)
+        self.assertEqual(expected[divEvalues[0]][:len(firstOrthologs[divEvalues[0]])], firstOrthologs[divEvalues[0]])
+
+
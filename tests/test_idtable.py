@@ -0,0 +1,97 @@
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import rsd.diskstore
+import rsd.idtable
+import rsd.rsd
+
+
+class TestIdTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fastaPath = os.path.join(self.tmpDir, 'genome.faa')
+        with open(self.fastaPath, 'w') as fh:
+            fh.write('>lcl|a desc\nMKV\n>b\nMRR\n>sp|c|C_HUMAN\nMTT\n')
+        self.searchBackend = rsd.rsd.SEARCH_BACKEND
+
+    def tearDown(self):
+        rsd.rsd.setSearchBackend(self.searchBackend)
+        shutil.rmtree(self.tmpDir)
+
+    def test_numbers_ids_in_fasta_order(self):
+        table = rsd.idtable.loadIdTable(self.fastaPath)
+        self.assertEqual(['a', 'b', 'c'], table.ids)
+        self.assertEqual((0, 2), (table.num('a'), table.num('c')))
+        self.assertEqual('b', table.seqId(1))
+        self.assertEqual(2, table.numForName('sp|c|C_HUMAN'))
+        self.assertRaises(KeyError, table.num, 'd')
+        self.assertTrue(table is rsd.idtable.loadIdTable(self.fastaPath))
+        getSeq = rsd.rsd.makeGetSeqForNum(self.fastaPath)
+        self.assertEqual(['MKV', 'MRR', 'MTT'], [getSeq(num) for num in range(3)])
+
+    def test_written_at_format_time_and_rebuilt_when_stale(self):
+        rsd.rsd.setSearchBackend('kmer')
+        rsd.rsd.formatFastaArg(self.fastaPath)
+        with open(rsd.idtable.idTablePath(self.fastaPath)) as fh:
+            self.assertEqual('a\nb\nc\n', fh.read())
+        self.assertEqual(['a', 'b', 'c'], rsd.idtable.loadIdTable(self.fastaPath).ids)
+        # a genome changed after it was formatted.
+        time.sleep(0.01)
+        with open(self.fastaPath, 'a') as fh:
+            fh.write('>d\nMWW\n')
+        self.assertEqual(['a', 'b', 'c', 'd'], rsd.idtable.loadIdTable(self.fastaPath).ids)
+
+    def test_index_genome_validates_ids_and_writes_offsets(self):
+        self.assertEqual(3, rsd.idtable.indexGenome(self.fastaPath))
+        self.assertTrue(rsd.idtable.isIndexed(self.fastaPath))
+        offsets = rsd.idtable.readOffsets(self.fastaPath)
+        with open(self.fastaPath) as fh:
+            for seqId, nameline in (('a', '>lcl|a desc\n'), ('c', '>sp|c|C_HUMAN\n')):
+                fh.seek(offsets[seqId])
+                self.assertEqual(nameline, fh.readline())
+        badPath = os.path.join(self.tmpDir, 'bad.faa')
+        with open(badPath, 'w') as fh:
+            fh.write('>a\nMKV\n>\nMRR\n>lcl|a\nMTT\n')
+        self.assertRaises(Exception, rsd.idtable.indexGenome, badPath)
+        self.assertFalse(os.path.exists(rsd.idtable.idTablePath(badPath)))
+        self.assertEqual(['bad.faa', 'genome.faa', 'genome.faa.idtable', 'genome.faa.offsets'], sorted(os.listdir(self.tmpDir)))
+
+    def test_format_genomes_skips_up_to_date(self):
+        rsd.rsd.setSearchBackend('kmer')
+        otherPath = os.path.join(self.tmpDir, 'other.faa')
+        with open(otherPath, 'w') as fh:
+            fh.write('>x\nMKV\n>x\nMRR\n')
+        results = rsd.rsd.formatGenomes([self.fastaPath, otherPath], workers=2)
+        self.assertEqual([(self.fastaPath, 3, True, None)], [(r['path'], r['numSeqs'], r['formatted'], r['error']) for r in results[:1]])
+        self.assertTrue(results[1]['error'])
+        self.assertFalse(rsd.rsd.isFormatted(otherPath))
+        results = rsd.rsd.formatGenomes([self.fastaPath])
+        self.assertEqual((3, False), (results[0]['numSeqs'], results[0]['formatted']))
+        time.sleep(0.01)
+        with open(self.fastaPath, 'a') as fh:
+            fh.write('>d\nMWW\n')
+        self.assertFalse(rsd.rsd.isFormatted(self.fastaPath))
+        self.assertEqual((4, True), (rsd.rsd.formatGenomes([self.fastaPath])[0]['numSeqs'], rsd.rsd.formatGenomes([self.fastaPath], force=True)[0]['formatted']))
+
+    def test_hits_share_id_strings(self):
+        resultsPath = os.path.join(self.tmpDir, 'results.tsv')
+        with open(resultsPath, 'w') as fh:
+            for query, subject, evalue in (('lcl|q1', 'lcl|s1', '1e-30'), ('lcl|q2', 'lcl|s1', '1e-20')):
+                fh.write('\t'.join([query, subject] + ['0'] * 8 + [evalue, '100']) + '\n')
+        hitsMap = rsd.rsd.parseResults(resultsPath)
+        stats = (100.0, 0, 0.0, None, None)
+        self.assertEqual({'q1': [('s1', 1e-30, (0, 0, 0, 0), stats)], 'q2': [('s1', 1e-20, (0, 0, 0, 0), stats)]}, hitsMap)
+        self.assertTrue(hitsMap['q1'][0][0] is hitsMap['q2'][0][0])
+        # a hits store holds each id once.
+        storePath = rsd.diskstore.writeHitsStore(hitsMap.iteritems(), os.path.join(self.tmpDir, 'hits.sqlite'))
+        store = rsd.diskstore.HitsStore(storePath)
+        self.assertEqual(3, store.conn.execute('SELECT COUNT(*) FROM ids').fetchone()[0])
+        self.assertEqual(hitsMap, dict(store.iteritems()))
+        store.close()
+
+
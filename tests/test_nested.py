@@ -0,0 +1,50 @@
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import rsd.nested
+
+
+class TestScratchPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_dirs_are_recycled(self):
+        with rsd.nested.ScratchPool(size=2, dir=self.tmpDir) as pool:
+            first = pool.acquire()
+            second = pool.acquire()
+            self.assertNotEqual(first, second)
+            self.assertEqual(None, pool.acquire(block=False))
+            with open(os.path.join(first, 'data'), 'w') as fh:
+                fh.write('data')
+            os.mkdir(os.path.join(first, 'subdir'))
+            pool.release(first)
+            self.assertEqual([], os.listdir(first))
+            with pool.scratch() as path:
+                self.assertEqual(first, path)
+            pool.release(second)
+            self.assertEqual(2, len(os.listdir(pool.path)))
+            poolPath = pool.path
+        self.assertFalse(os.path.exists(poolPath))
+
+    def test_fallback_when_memory_is_tight(self):
+        self.assertEqual(self.tmpDir, rsd.nested.chooseScratchRoot(minFree=2**70, fallback=self.tmpDir))
+
+    def test_reap_pools_of_dead_processes(self):
+        # pid 2**22 + 1 is above the maximum pid on linux, so no process has it.
+        deadPath = os.path.join(self.tmpDir, 'nested_scratch-{}-{}-abc'.format(socket.gethostname(), 2**22 + 1))
+        livePath = os.path.join(self.tmpDir, 'nested_scratch-{}-{}-abc'.format(socket.gethostname(), os.getpid()))
+        otherHostPath = os.path.join(self.tmpDir, 'nested_scratch-otherhost.example-{}-abc'.format(2**22 + 1))
+        for path in (deadPath, livePath, otherHostPath):
+            os.mkdir(path)
+        rsd.nested.reapScratchPools(self.tmpDir, 'nested_scratch')
+        self.assertEqual(sorted([livePath, otherHostPath]), sorted(os.path.join(self.tmpDir, name) for name in os.listdir(self.tmpDir)))
+
+
@@ -0,0 +1,393 @@
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import rsd.nested
+import rsd.rsd
+import rsd.util
+
+
+# query genome and subject genome sequences.  Sequences of equal length are "aligned" without gaps by the fake aligner.
+QUERY_SEQS = {
+    'q1': 'MKTAYIAKQRQISFVKSHFSRQ',
+    'q2': 'MKTAYIAKQRQISFVKSHFSRA',
+    'q3': 'MSSHHHHHHSSGLVPRGSHMAS',
+}
+SUBJECT_SEQS = {
+    's1': 'MKTAYIAKQRQISFVKSHFSRW',
+    's2': 'MKTAYIAKQRQISFVKSHFSRY',
+    's3': 'MSSHHHHHHSSGLVPRGSHMAT',
+}
+FORWARD_HITS = {
+    'q1': [('s1', 1e-30), ('s2', 1e-25)],
+    'q2': [('s2', 1e-20)],
+    'q3': [('s3', 1e-3)],
+}
+REVERSE_HITS = {
+    's1': [('q2', 1e-30), ('q1', 1e-28)],
+    's2': [('q1', 1e-25), ('q2', 1e-20)],
+    's3': [('q3', 1e-3)],
+}
+# distances between pairs of sequences, computed by the fake distance function.
+DISTANCES = {
+    frozenset(['q1', 's1']): 0.5,
+    frozenset(['q1', 's2']): 0.3,
+    frozenset(['q2', 's1']): 0.2,
+    frozenset(['q2', 's2']): 0.4,
+    frozenset(['q3', 's3']): 0.9,
+}
+
+
+class FakeTools(object):
+    '''
+    Replaces the external aligner and distance calculator used by rsd.rsd with fakes, so the ortholog logic can be tested
+    without kalign and codeml.  Counts alignments and distance computations.  Each call takes delay seconds, like a tool.
+    '''
+    def __init__(self, distances=DISTANCES, delay=0):
+        self.distances = distances
+        self.delay = delay
+        self.numAlignments = 0
+        self.numDistances = 0
+        # the fakes can be called from several threads at once.
+        self.lock = threading.Lock()
+
+    def alignSeqPair(self, seqId, seq, hitSeqId, hitSeq, workPath):
+        with self.lock:
+            self.numAlignments += 1
+        time.sleep(self.delay)
+        return (seqId, seq), (hitSeqId, hitSeq)
+
+    def getDistanceForAlignedSeqPair(self, seqId, alignedSeq, hitSeqId, alignedHitSeq, workPath):
+        with self.lock:
+            self.numDistances += 1
+        time.sleep(self.delay)
+        return self.distances[frozenset([seqId, hitSeqId])]
+
+    def __enter__(self):
+        self.saved = rsd.rsd.alignSeqPair, rsd.rsd.getDistanceForAlignedSeqPair
+        rsd.rsd.alignSeqPair = self.alignSeqPair
+        rsd.rsd.getDistanceForAlignedSeqPair = self.getDistanceForAlignedSeqPair
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        rsd.rsd.alignSeqPair, rsd.rsd.getDistanceForAlignedSeqPair = self.saved
+
+
+class DivergingTools(FakeTools):
+    '''
+    Fakes an alignment of the pairs in diverged that is too diverged for any divergence threshold below 0.9.
+    '''
+    def __init__(self, diverged, distances=DISTANCES):
+        super(DivergingTools, self).__init__(distances)
+        self.diverged = diverged
+
+    def alignSeqPair(self, seqId, seq, hitSeqId, hitSeq, workPath):
+        (seqId, seq), (hitSeqId, hitSeq) = super(DivergingTools, self).alignSeqPair(seqId, seq, hitSeqId, hitSeq, workPath)
+        if frozenset([seqId, hitSeqId]) in self.diverged:
+            gaps = '-' * (10 * max(len(seq), len(hitSeq)))
+            return (seqId, seq + gaps), (hitSeqId, gaps + hitSeq)
+        return (seqId, seq), (hitSeqId, hitSeq)
+
+
+class TimingOutTools(FakeTools):
+    '''
+    Fakes the aligner timing out for the pairs in alignTimeouts and codeml timing out for the pairs in distanceTimeouts.
+    '''
+    def __init__(self, alignTimeouts, distanceTimeouts, distances=DISTANCES):
+        super(TimingOutTools, self).__init__(distances)
+        self.alignTimeouts = alignTimeouts
+        self.distanceTimeouts = distanceTimeouts
+
+    def alignSeqPair(self, seqId, seq, hitSeqId, hitSeq, workPath):
+        if frozenset([seqId, hitSeqId]) in self.alignTimeouts:
+            raise rsd.util.CommandTimeout(['kalign'], 1.0)
+        return super(TimingOutTools, self).alignSeqPair(seqId, seq, hitSeqId, hitSeq, workPath)
+
+    def getDistanceForAlignedSeqPair(self, seqId, alignedSeq, hitSeqId, alignedHitSeq, workPath):
+        if frozenset([seqId, hitSeqId]) in self.distanceTimeouts:
+            raise rsd.util.CommandTimeout(['codeml'], 1.0)
+        return super(TimingOutTools, self).getDistanceForAlignedSeqPair(seqId, alignedSeq, hitSeqId, alignedHitSeq, workPath)
+
+
+class ConcurrencyTools(FakeTools):
+    '''
+    Records the peak number of alignments and of distance computations running at once.
+    '''
+    def __init__(self, distances=DISTANCES, delay=0.1):
+        super(ConcurrencyTools, self).__init__(distances, delay)
+        self.running = {'align': 0, 'distance': 0}
+        self.peaks = {'align': 0, 'distance': 0}
+
+    def call(self, tool, func, *args):
+        with self.lock:
+            self.running[tool] += 1
+            self.peaks[tool] = max(self.peaks[tool], self.running[tool])
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.running[tool] -= 1
+
+    def alignSeqPair(self, *args):
+        return self.call('align', super(ConcurrencyTools, self).alignSeqPair, *args)
+
+    def getDistanceForAlignedSeqPair(self, *args):
+        return self.call('distance', super(ConcurrencyTools, self).getDistanceForAlignedSeqPair, *args)
+
+
+def getHitsFunc(hitsMap):
+    def getHits(seqId, seq):
+        return hitsMap.get(seqId)
+    return getHits
+
+
+class TestComputeOrthologs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        rsd.rsd.resetRunSummaries()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def computeOrthologs(self, divEvalues, querySeqIds=('q1', 'q2', 'q3')):
+        return rsd.rsd._computeOrthologsSub(list(querySeqIds), QUERY_SEQS.get, SUBJECT_SEQS.get, divEvalues,
+                                            getHitsFunc(FORWARD_HITS), getHitsFunc(REVERSE_HITS), self.tmpDir)
+
+    def test_reciprocal_smallest_distance(self):
+        with FakeTools():
+            divEvalueToOrthologs = self.computeOrthologs([(0.8, 1e-5)])
+        # q2 is closest to s2, but s2 is closer to q1.
+        self.assertEqual([('q1', 's2', 0.3)], divEvalueToOrthologs[(0.8, 1e-5)])
+
+    def test_evalue_thresholds(self):
+        with FakeTools():
+            divEvalueToOrthologs = self.computeOrthologs([('0.8', '1e-5'), ('0.8', '1e-2'), ('0.8', '1e-26')])
+        self.assertEqual([('q1', 's2', 0.3)], divEvalueToOrthologs[('0.8', '1e-5')])
+        self.assertEqual([('q1', 's2', 0.3), ('q3', 's3', 0.9)], divEvalueToOrthologs[('0.8', '1e-2')])
+        # s2 is not a good enough hit for q1, and q1 is not the closest reverse hit of s1.
+        self.assertEqual([], divEvalueToOrthologs[('0.8', '1e-26')])
+
+    def test_timed_out_pairs_are_dropped(self):
+        with TimingOutTools(set([frozenset(['q1', 's2'])]), set([frozenset(['q3', 's3'])])):
+            divEvalueToOrthologs = self.computeOrthologs([('0.8', '1e-2')])
+        # without s2, q1 is not the closest reverse hit of s1, and without q1, q2 is the closest reverse hit of s2.
+        self.assertEqual([('q2', 's2', 0.4)], divEvalueToOrthologs[('0.8', '1e-2')])
+        self.assertEqual([('q1', 's2'), ('s2', 'q1')], sorted(rsd.rsd.TIMEOUT_SUMMARY['align']))
+        self.assertEqual([('q3', 's3')], rsd.rsd.TIMEOUT_SUMMARY['distance'])
+
+    def test_summaries_cover_every_chunk_of_a_run(self):
+        with TimingOutTools(set(), set([frozenset(['q1', 's2']), frozenset(['q3', 's3'])])):
+            for chunk in (['q1', 'q2'], ['q3']):
+                self.computeOrthologs([('0.8', '1e-2')], chunk)
+        self.assertEqual([('q1', 's2'), ('q3', 's3'), ('s2', 'q1')], sorted(rsd.rsd.TIMEOUT_SUMMARY['distance']))
+        self.assertEqual(3, rsd.rsd.LATENCY_SUMMARY['queries'])
+        rsd.rsd.resetRunSummaries()
+        self.assertEqual(({}, {'distances': 0}, {'align': [], 'distance': []}),
+                         (rsd.rsd.LATENCY_SUMMARY, rsd.rsd.PRUNE_SUMMARY, rsd.rsd.TIMEOUT_SUMMARY))
+
+    def test_pipelined_matches_serial(self):
+        rand = random.Random(0)
+        querySeqs = dict(('q{}'.format(i), 'M' * rand.randint(20, 40)) for i in range(60))
+        subjectSeqs = dict(('s{}'.format(i), 'M' * rand.randint(20, 40)) for i in range(40))
+        forwardHits = dict((q, [(s, rand.choice([1e-30, 1e-10, 1e-3])) for s in rand.sample(sorted(subjectSeqs), 3)]) for q in querySeqs)
+        reverseHits = dict((s, [(q, rand.choice([1e-30, 1e-10, 1e-3])) for q in rand.sample(sorted(querySeqs), 3)]) for s in subjectSeqs)
+        for q, hits in forwardHits.items():
+            # make some hits reciprocal
+            for s, evalue in hits[:1]:
+                reverseHits[s][rand.randint(0, 2)] = (q, evalue)
+        distances = dict((frozenset([q, s]), rand.choice([0.1, 0.2, 0.3, 0.5])) for q in querySeqs for s in subjectSeqs)
+        divEvalues = [('0.8', '1e-5'), ('0.8', '1e-2'), ('0.2', '1e-20')]
+        querySeqIds = sorted(querySeqs)
+        saved = dict(rsd.rsd.STAGE_WORKERS), rsd.rsd.PIPELINE_QUEUE_SIZE
+        try:
+            results = []
+            for workers, queueSize in ((1, 1), (4, 3)):
+                rsd.rsd.setStageWorkers(**dict((kind, workers) for kind in rsd.rsd.STAGE_WORKERS))
+                rsd.rsd.PIPELINE_QUEUE_SIZE = queueSize
+                rsd.rsd.resetRunSummaries()
+                with FakeTools(distances) as tools:
+                    results.append((rsd.rsd._computeOrthologsSub(querySeqIds, querySeqs.get, subjectSeqs.get, divEvalues,
+                                                                 getHitsFunc(forwardHits), getHitsFunc(reverseHits), self.tmpDir),
+                                    tools.numAlignments, tools.numDistances + rsd.rsd.PRUNE_SUMMARY['distances']))
+        finally:
+            rsd.rsd.STAGE_WORKERS.update(saved[0])
+            rsd.rsd.PIPELINE_QUEUE_SIZE = saved[1]
+        self.assertTrue(results[0][0][('0.8', '1e-2')])
+        # more distance workers compute the distances of a reverse search in larger batches, so fewer are pruned.
+        self.assertEqual(results[0], results[1])
+        # starting the costliest queries first gives the same orthologs, in the same order.
+        costs = dict((q, len(querySeqs[q]) * sum(len(subjectSeqs[s]) for s, evalue in forwardHits[q])) for q in querySeqs)
+        rsd.rsd.resetRunSummaries()
+        with FakeTools(distances):
+            self.assertEqual(results[0][0], rsd.rsd._computeOrthologsSub(querySeqIds, querySeqs.get, subjectSeqs.get, divEvalues,
+                                                                         getHitsFunc(forwardHits), getHitsFunc(reverseHits), self.tmpDir,
+                                                                         costs=costs))
+        self.assertEqual(len(querySeqIds), rsd.rsd.LATENCY_SUMMARY['queries'])
+
+    def test_hits_of_one_query_run_concurrently(self):
+        subjectSeqs = dict(('s{}'.format(i), 'M' * 30) for i in range(rsd.rsd.MAX_HITS))
+        forwardHits = {'q1': [(s, 1e-30) for s in sorted(subjectSeqs)]}
+        reverseHits = dict((s, [('q1', 1e-30)]) for s in subjectSeqs)
+        distances = dict((frozenset(['q1', s]), 0.1 * (i + 1)) for i, s in enumerate(sorted(subjectSeqs)))
+        saved = dict(rsd.rsd.STAGE_WORKERS)
+        try:
+            rsd.rsd.setStageWorkers(align=rsd.rsd.MAX_HITS, distance=rsd.rsd.MAX_HITS)
+            with ConcurrencyTools(distances) as tools:
+                divEvalueToOrthologs = rsd.rsd._computeOrthologsSub(['q1'], {'q1': 'M' * 30}.get, subjectSeqs.get, [(0.8, 1e-5)],
+                                                                    getHitsFunc(forwardHits), getHitsFunc(reverseHits), self.tmpDir)
+        finally:
+            rsd.rsd.STAGE_WORKERS.update(saved)
+        self.assertEqual([('q1', 's0', 0.1)], divEvalueToOrthologs[(0.8, 1e-5)])
+        self.assertEqual({'align': rsd.rsd.MAX_HITS, 'distance': rsd.rsd.MAX_HITS}, tools.peaks)
+
+    def test_more_workers_than_scratch_dirs(self):
+        rand = random.Random(1)
+        querySeqs = dict(('q{}'.format(i), 'M' * rand.randint(20, 40)) for i in range(30))
+        subjectSeqs = dict(('s{}'.format(i), 'M' * rand.randint(20, 40)) for i in range(30))
+        forwardHits = dict((q, [(s, 1e-30) for s in rand.sample(sorted(subjectSeqs), 3)]) for q in querySeqs)
+        reverseHits = dict((s, [(q, 1e-30) for q in rand.sample(sorted(querySeqs), 3)]) for s in subjectSeqs)
+        distances = dict((frozenset([q, s]), rand.choice([0.1, 0.2, 0.3, 0.5])) for q in querySeqs for s in subjectSeqs)
+        def computeOrthologs():
+            return rsd.rsd._computeOrthologsSub(sorted(querySeqs), querySeqs.get, subjectSeqs.get, [(0.8, 1e-5)],
+                                                getHitsFunc(forwardHits), getHitsFunc(reverseHits), self.tmpDir)
+        with FakeTools(distances):
+            expected = computeOrthologs()
+        pid = os.getpid()
+        saved = dict(rsd.rsd.STAGE_WORKERS), rsd.nested._DEFAULT_SCRATCH_POOLS.get(pid)
+        results = []
+        try:
+            rsd.rsd.setStageWorkers(hits=4, align=4, distance=4)
+            # the alignment and distance threads together need more dirs than the pool has.
+            with rsd.nested.ScratchPool(size=3, dir=self.tmpDir) as pool:
+                rsd.nested._DEFAULT_SCRATCH_POOLS[pid] = pool
+                with FakeTools(distances, delay=0.005):
+                    thread = threading.Thread(target=lambda: results.append(computeOrthologs()))
+                    thread.daemon = True
+                    thread.start()
+                    thread.join(30)
+        finally:
+            rsd.rsd.STAGE_WORKERS.update(saved[0])
+            if saved[1] is None:
+                rsd.nested._DEFAULT_SCRATCH_POOLS.pop(pid, None)
+            else:
+                rsd.nested._DEFAULT_SCRATCH_POOLS[pid] = saved[1]
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([expected], results)
+
+    def test_pruned_distances_match_unpruned(self):
+        rand = random.Random(2)
+        querySeqs = dict(('q{}'.format(i), 'M' * rand.randint(20, 40)) for i in range(40))
+        subjectSeqs = dict(('s{}'.format(i), 'M' * rand.randint(20, 40)) for i in range(30))
+        forwardHits = dict((q, [(s, rand.choice([1e-30, 1e-10])) for s in rand.sample(sorted(subjectSeqs), 3)]) for q in querySeqs)
+        reverseHits = dict((s, [(q, rand.choice([1e-30, 1e-10])) for q in rand.sample(sorted(querySeqs), 4)]) for s in subjectSeqs)
+        for q, hits in forwardHits.items():
+            reverseHits[hits[0][0]][rand.randint(0, 3)] = (q, 1e-30)
+        distances = dict((frozenset([q, s]), rand.choice([0.1, 0.2, 0.3, 0.5])) for q in querySeqs for s in subjectSeqs)
+        diverged = set(frozenset([q, s]) for q in querySeqs for s in subjectSeqs if rand.random() < 0.3)
+        divEvalues = [('0.8', '1e-5'), ('0.5', '1e-5'), ('0.8', '1e-20')]
+        results = []
+        saved = rsd.rsd.PRUNE_DISTANCES
+        try:
+            for prune in (False, True):
+                rsd.rsd.PRUNE_DISTANCES = prune
+                with DivergingTools(diverged, distances) as tools:
+                    results.append((rsd.rsd._computeOrthologsSub(sorted(querySeqs), querySeqs.get, subjectSeqs.get, divEvalues,
+                                                                 getHitsFunc(forwardHits), getHitsFunc(reverseHits), self.tmpDir),
+                                    tools.numAlignments, tools.numDistances))
+        finally:
+            rsd.rsd.PRUNE_DISTANCES = saved
+        self.assertTrue(results[0][0][('0.8', '1e-5')])
+        self.assertEqual(results[0][:2], results[1][:2])
+        self.assertTrue(rsd.rsd.PRUNE_SUMMARY['distances'] > 0)
+        self.assertEqual(results[0][2] - rsd.rsd.PRUNE_SUMMARY['distances'], results[1][2])
+
+    def test_estimate_query_costs(self):
+        lengths = {'q1': 10, 'q2': 20}
+        hitLengths = {'s1': 5, 's2': 7}
+        hits = {'q1': [('s1', 1e-30), ('s2', 1e-3)], 'q2': [('s2', 1e-20)]}
+        self.assertEqual({'q1': 120, 'q2': 140}, rsd.rsd.estimateQueryCosts(['q1', 'q2'], lengths, hitLengths, hits))
+        self.assertEqual({'q1': 50, 'q2': 140}, rsd.rsd.estimateQueryCosts(['q1', 'q2'], lengths, hitLengths, hits, 1e-5))
+        self.assertEqual({'q1': 100, 'q2': 400}, rsd.rsd.estimateQueryCosts(['q1', 'q2'], lengths, hitLengths))
+
+    def test_seq_lengths_are_cached_until_the_genome_changes(self):
+        path = os.path.join(self.tmpDir, 'genome.faa')
+        with open(path, 'w') as fh:
+            fh.write('>q1\nMKV\n>q2\nMKVLA\n')
+        lengths = rsd.rsd.loadSeqLengths(path)
+        self.assertEqual({'q1': 3, 'q2': 5}, lengths)
+        self.assertTrue(lengths is rsd.rsd.loadSeqLengths(path))
+        with open(path, 'a') as fh:
+            fh.write('>q3\nM\n')
+        future = os.path.getmtime(path) + 10
+        os.utime(path, (future, future))
+        self.assertEqual({'q1': 3, 'q2': 5, 'q3': 1}, rsd.rsd.loadSeqLengths(path))
+
+
+def originalDivergencePredicate(alignedIdAndSeq, alignedHitIdAndSeq, divergenceThreshold):
+    '''
+    The closure based divergence predicate used by RSD before divergences were precomputed.
+    '''
+    divIdSeqs = sorted((seq.count('-'), seq.count('-') / float(len(seq)), id, seq) for id, seq in (alignedIdAndSeq, alignedHitIdAndSeq))
+    leastDivergedDashCount, leastDivergedDiv, leastDivergedId, leastDivergedSeq = divIdSeqs[0]
+    startTrim, endTrim, trimDivergence = rsd.rsd.dashlen_check(divIdSeqs[1][3])
+    if leastDivergedSeq and leastDivergedDiv > divergenceThreshold:
+        return True
+    if (startTrim or endTrim) and trimDivergence >= divergenceThreshold:
+        return True
+    return False
+
+
+class TestDivergence(unittest.TestCase):
+
+    def test_divergences_match_predicate(self):
+        pairs = [
+            (('a', 'MKT--AYIAKQRQ'), ('b', 'MKTWWAYIAKQRQ')),
+            (('a', '-' * 12 + 'MKTAYIAKQRQ-ISFVK'), ('b', 'MSSHHHHHHSSGMKTAYIAKQRQWISFVK')),
+            (('a', 'MKTAYIAKQRQ'), ('b', 'MKTAYIAKQRQ')),
+        ]
+        for alignedIdAndSeq, alignedHitIdAndSeq in pairs:
+            startTrim, endTrim, leastDivergence, trimDivergence = rsd.rsd.alignedSeqPairDivergences(alignedIdAndSeq, alignedHitIdAndSeq)
+            hitData = rsd.rsd.HitData('b', alignedHitIdAndSeq[1], 0.0)
+            hitData.leastDivergence, hitData.trimDivergence = leastDivergence, trimDivergence
+            for div in (0.01, 0.1, 0.2, 0.5, 0.8):
+                expected = originalDivergencePredicate(alignedIdAndSeq, alignedHitIdAndSeq, div)
+                self.assertEqual(expected, rsd.rsd.isTooDiverged(leastDivergence, trimDivergence, div))
+                self.assertEqual(expected, hitData.tooDiverged(div))
+        # the second pair has 12 leading dashes, which are trimmed.
+        startTrim, endTrim, leastDivergence, trimDivergence = rsd.rsd.alignedSeqPairDivergences(*pairs[1])
+        self.assertEqual(12, startTrim)
+        self.assertTrue(rsd.rsd.isTooDiverged(leastDivergence, trimDivergence, 0.05))
+        self.assertFalse(rsd.rsd.isTooDiverged(leastDivergence, trimDivergence, 0.8))
+
+
+class TestSweepMinimumDistanceHitDatas(unittest.TestCase):
+
+    def test_matches_filtering_every_threshold(self):
+        rand = random.Random(0)
+        never = rsd.rsd.NEVER_TOO_DIVERGED
+        divs = [0.1, 0.2, 0.3, 0.5, 0.8]
+        evalues = [1e-20, 1e-10, 1e-5, 1e-2]
+        thresholds = [((div, evalue), div, evalue) for div in divs for evalue in evalues]
+        for trial in range(200):
+            hitDatas = []
+            for i in range(rand.randint(0, 6)):
+                hitData = rsd.rsd.HitData('h{}'.format(i), '', rand.choice(evalues + [1e-30, 1e-7]))
+                # include divergences equal to thresholds and ties in distance to exercise the edge cases.
+                hitData.leastDivergence = rand.choice([never, 0.0, 0.2, 0.25, 0.5, 0.9])
+                hitData.trimDivergence = rand.choice([never, 0.1, 0.2, 0.4, 0.8])
+                hitData.distance = rand.choice([0.1, 0.2, 0.2, 0.5, 1.0])
+                hitDatas.append(hitData)
+            rand.shuffle(thresholds)
+            swept = rsd.rsd.sweepMinimumDistanceHitDatas(hitDatas, thresholds)
+            for (divEvalue, div, evalue), minimums in zip(thresholds, swept):
+                good = [h for h in hitDatas if h.evalue < evalue and not h.tooDiverged(div)]
+                expected = [h for h in good if h.distance == min(g.distance for g in good)]
+                self.assertEqual(expected, minimums)
+
+
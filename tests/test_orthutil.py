@@ -0,0 +1,170 @@
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import rsd.orthutil
+
+
+def makeOrthDatas(numGenomes=6, seed=0):
+    '''
+    returns: a shuffled list of orthDatas for every ordered pair of genomes and two divs and evalues, some without orthologs.
+    '''
+    rand = random.Random(seed)
+    orthDatas = []
+    genomes = ['G{}'.format(i) for i in range(numGenomes)]
+    for qdb in genomes:
+        for sdb in genomes:
+            if qdb == sdb:
+                continue
+            for div in ('0.2', '0.8'):
+                for evalue in ('1e-20', '1e-05'):
+                    orthologs = [('{}_{}'.format(qdb, i), '{}_{}'.format(sdb, rand.randint(0, 50)), '{:.4f}'.format(rand.random() * 3))
+                                 for i in range(rand.randint(0, 5))]
+                    orthDatas.append(((qdb, sdb, div, evalue), orthologs))
+    rand.shuffle(orthDatas)
+    return orthDatas
+
+
+class TestOrthDatasIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, 'orthologs.txt')
+        self.orthDatas = makeOrthDatas()
+        rsd.orthutil.orthDatasToFile(self.orthDatas, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_lookups_match_scan(self):
+        rsd.orthutil.buildOrthDatasIndex(self.path)
+        for (qdb, sdb, div, evalue), orthologs in self.orthDatas:
+            self.assertEqual([((qdb, sdb, div, evalue), orthologs)],
+                             list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path, qdb, sdb, div, evalue)))
+        expected = sorted(orthData for orthData in self.orthDatas if orthData[0][:2] == ('G3', 'G1'))
+        self.assertEqual(expected, list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path, 'G3', 'G1')))
+        self.assertEqual(sorted(self.orthDatas), list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path)))
+        self.assertEqual([], list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path, 'G3', 'G3')))
+        self.assertEqual([], list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path, 'G9')))
+        self.assertEqual([], list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path, 'A')))
+
+    def test_stale_index(self):
+        rsd.orthutil.buildOrthDatasIndex(self.path)
+        rsd.orthutil.orthDatasToFile([(('G0', 'G1', '0.5', '1e-10'), [])], self.path, mode='a')
+        with self.assertRaises(Exception):
+            list(rsd.orthutil.orthDatasFromIndexedFileGen(self.path, 'G0', 'G1'))
+
+
+class TestOrthDatasDb(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, 'orthologs.sqlite')
+        self.orthDatas = makeOrthDatas()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_roundtrip_and_lookups(self):
+        self.assertEqual(len(self.orthDatas), rsd.orthutil.orthDatasToDb(iter(self.orthDatas), self.path, batchSize=7))
+        self.assertEqual(sorted(self.orthDatas), list(rsd.orthutil.orthDatasFromDbGen(self.path)))
+        expected = sorted(orthData for orthData in self.orthDatas if orthData[0][:2] == ('G3', 'G1'))
+        self.assertEqual(expected, list(rsd.orthutil.orthDatasFromDbGen(self.path, 'G3', 'G1')))
+        self.assertEqual([], list(rsd.orthutil.orthDatasFromDbGen(self.path, 'G3', 'G3')))
+        expected = sorted((params, ortholog) for params, orthologs in self.orthDatas for ortholog in orthologs if 'G2_3' in ortholog[:2])
+        self.assertTrue(expected)
+        self.assertEqual(expected, sorted(rsd.orthutil.orthologsForSeqFromDbGen(self.path, 'G2_3')))
+        self.assertEqual([], list(rsd.orthutil.orthologsForSeqFromDbGen(self.path, 'missing')))
+
+    def test_merge_replaces_params(self):
+        rsd.orthutil.orthDatasToDb(self.orthDatas, self.path)
+        params = self.orthDatas[0][0]
+        update = [(params, [('x', 'y', '0.5')]), (('G9', 'G0', '0.2', '1e-20'), [])]
+        rsd.orthutil.orthDatasToDb(update, self.path)
+        expected = sorted(update + self.orthDatas[1:])
+        self.assertEqual(expected, list(rsd.orthutil.orthDatasFromDbGen(self.path)))
+
+
+class TestMergeOrthDatasFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, orthDatas):
+        path = os.path.join(self.tmpDir, name)
+        rsd.orthutil.orthDatasToFile(orthDatas, path)
+        return path
+
+    def test_sort_with_small_runs(self):
+        orthDatas = makeOrthDatas()
+        path = self.writeFile('unsorted.txt', orthDatas)
+        self.assertFalse(rsd.orthutil.isOrthDatasFileSorted(path))
+        rsd.orthutil.sortOrthDatasFile(path, path, runSize=10, fanIn=3)
+        self.assertTrue(rsd.orthutil.isOrthDatasFileSorted(path))
+        key = lambda orthData: rsd.orthutil.orthDatasParamsKey(orthData[0])
+        self.assertEqual(sorted(orthDatas, key=key), rsd.orthutil.orthDatasFromFile(path))
+
+    def test_merge_and_dedupe(self):
+        orthDatas = makeOrthDatas()
+        # split into overlapping inputs, with a different duplicate in each input.
+        first = orthDatas[:100]
+        second = [(params, orthologs + [('dup', 'second', '0.1')]) for params, orthologs in orthDatas[50:]]
+        # '.8' is the same divergence as '0.8'
+        third = [((qdb, sdb, '.8', evalue), [('dup', 'third', '0.1')]) for (qdb, sdb, div, evalue), orthologs in orthDatas if div == '0.8']
+        paths = [self.writeFile('first.txt', first), self.writeFile('second.txt', sorted(second)),
+                 self.writeFile('third.txt', third)]
+        key = lambda orthData: rsd.orthutil.orthDatasParamsKey(orthData[0])
+        for keep in (rsd.orthutil.MERGE_KEEP_FIRST, rsd.orthutil.MERGE_KEEP_LAST):
+            outPath = os.path.join(self.tmpDir, 'merged_{}.txt.gz'.format(keep))
+            rsd.orthutil.mergeOrthDatasFiles(paths, outPath, keep=keep, runSize=20, fanIn=2)
+            expected = {}
+            for orthData in first + second + third:
+                if keep == rsd.orthutil.MERGE_KEEP_LAST or key(orthData) not in expected:
+                    expected[key(orthData)] = orthData
+            self.assertEqual(sorted(expected.values(), key=key), rsd.orthutil.orthDatasFromFile(outPath))
+        self.assertEqual(sorted(os.listdir(self.tmpDir)), ['first.txt', 'merged_first.txt.gz', 'merged_last.txt.gz', 'second.txt', 'third.txt'])
+
+
+class TestSeqOrthologsIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        orthDatas = makeOrthDatas()
+        self.paths = [os.path.join(self.tmpDir, 'first.txt'), os.path.join(self.tmpDir, 'second.txt.gz')]
+        rsd.orthutil.orthDatasToFile(orthDatas[:80], self.paths[0])
+        rsd.orthutil.orthDatasToFile(orthDatas[80:], self.paths[1])
+        self.indexPath = rsd.orthutil.buildSeqOrthologsIndex(self.paths, os.path.join(self.tmpDir, 'seqs.idx'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_lookups_match_scan(self):
+        expected = {}
+        for path in self.paths:
+            for params, orthologs in rsd.orthutil.orthDatasFromFileGen(path):
+                for qid, sid, dist in orthologs:
+                    for seqId in (qid, sid):
+                        expected.setdefault(seqId, []).append((params, (qid, sid, dist)))
+        with rsd.orthutil.SeqOrthologsIndex(self.indexPath) as index:
+            for seqId, results in expected.items():
+                found = index.orthologs(seqId)
+                self.assertEqual(len(results), len(found))
+                for (params, (qid, sid, dist)), (foundParams, (foundQid, foundSid, foundDist)) in zip(results, found):
+                    self.assertEqual((params, qid, sid), (foundParams, foundQid, foundSid))
+                    self.assertAlmostEqual(float(dist), foundDist, places=4)
+            self.assertEqual([], index.postings('missing'))
+            self.assertEqual([], index.postings('A'))
+            self.assertEqual([], index.postings('~'))
+
+    def test_stale_index(self):
+        rsd.orthutil.orthDatasToFile([(('G0', 'G1', '0.5', '1e-10'), [])], self.paths[0], mode='a')
+        with self.assertRaises(Exception):
+            rsd.orthutil.SeqOrthologsIndex(self.indexPath)
+
+
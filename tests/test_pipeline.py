@@ -0,0 +1,78 @@
+
+import random
+import threading
+import time
+import unittest
+
+import rsd.pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_results_in_order(self):
+        rand = random.Random(0)
+        def slow(value):
+            time.sleep(rand.random() * 0.002)
+            return value
+        stages = [rsd.pipeline.Stage('add', lambda x: slow(x + 1), 3), rsd.pipeline.Stage('double', lambda x: slow(x * 2), 4)]
+        self.assertEqual([(x + 1) * 2 for x in range(200)], list(rsd.pipeline.Pipeline(stages, queueSize=2).run(iter(range(200)))))
+        self.assertEqual([], list(rsd.pipeline.Pipeline(stages).run([])))
+
+    def test_unordered_results_do_not_wait_for_slow_items(self):
+        release = threading.Event()
+        def wait(x):
+            if x == 0:
+                release.wait(5)
+            return x
+        results = []
+        for result in rsd.pipeline.Pipeline([rsd.pipeline.Stage('wait', wait, 2)], queueSize=1, maxInFlight=3).run(range(20), ordered=False):
+            results.append(result)
+            # every other item gets through while the first one is still running.
+            if len(results) == 19:
+                release.set()
+        self.assertEqual(range(1, 20) + [0], results)
+
+    def test_backpressure(self):
+        lock = threading.Lock()
+        counts = {'fed': 0, 'returned': 0, 'maxInFlight': 0}
+        def items():
+            for i in range(100):
+                with lock:
+                    counts['fed'] += 1
+                    counts['maxInFlight'] = max(counts['maxInFlight'], counts['fed'] - counts['returned'])
+                yield i
+        stages = [rsd.pipeline.Stage('fast', lambda x: x, 2), rsd.pipeline.Stage('slow', lambda x: time.sleep(0.001) or x, 1)]
+        for result in rsd.pipeline.Pipeline(stages, queueSize=2, maxInFlight=5).run(items()):
+            with lock:
+                counts['returned'] += 1
+        self.assertEqual(100, counts['returned'])
+        self.assertTrue(counts['maxInFlight'] <= 6)
+
+    def test_shared_semaphore(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        def call(x):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.001)
+            with lock:
+                running[0] -= 1
+            return x
+        semaphore = threading.BoundedSemaphore(2)
+        stages = [rsd.pipeline.Stage('first', call, 3, semaphore), rsd.pipeline.Stage('second', call, 3, semaphore)]
+        self.assertEqual(range(50), list(rsd.pipeline.Pipeline(stages).run(range(50))))
+        self.assertEqual(2, running[1])
+
+    def test_exception_is_raised_in_order(self):
+        def fail(x):
+            if x == 7:
+                raise ValueError(x)
+            return x
+        results = []
+        with self.assertRaises(ValueError):
+            for result in rsd.pipeline.Pipeline([rsd.pipeline.Stage('fail', fail, 3)]).run(range(100)):
+                results.append(result)
+        self.assertEqual(range(7), results)
+
+
@@ -0,0 +1,104 @@
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import rsd.plan
+import rsd.rsd
+from tests.test_orthologs import QUERY_SEQS, SUBJECT_SEQS, FORWARD_HITS, REVERSE_HITS
+
+
+def writeFasta(path, seqs):
+    with open(path, 'w') as fh:
+        for seqId in sorted(seqs):
+            fh.write('>{}\n{}\n'.format(seqId, seqs[seqId]))
+    return path
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_estimate_work(self):
+        lengths = dict((seqId, len(seq)) for seqId, seq in QUERY_SEQS.items() + SUBJECT_SEQS.items())
+        work = rsd.rsd.estimateOrthologsWork(sorted(QUERY_SEQS), lengths, lengths, FORWARD_HITS, REVERSE_HITS, 1e-5)
+        # q1: s1 and s2, then the reverse hits of s1, q2 and q1.  q2: s2, then q1 and q2.  q3 has no good hits.
+        self.assertEqual({'queries': 3, 'queryResidues': 66, 'hitLookups': 5, 'alignments': 7, 'distances': 7,
+                          'alignResidues': 7 * 44, 'distanceResidues': 7 * 22}, work)
+
+    def test_swap_uses_hits(self):
+        queryPath = writeFasta(os.path.join(self.tmpDir, 'query.faa'), dict(('q{}'.format(i), 'M' * 50) for i in range(1, 5)))
+        subjectPath = writeFasta(os.path.join(self.tmpDir, 'subject.faa'), {'s1': 'M' * 50, 's2': 'M' * 50})
+        forwardHits = {'q1': [('s1', 1e-30)]}
+        reverseHits = {'s1': [('q1', 1e-30), ('q2', 1e-20), ('q3', 1e-20)], 's2': [('q2', 1e-20), ('q3', 1e-20), ('q4', 1e-20)]}
+        getHits = lambda hits: lambda seqId, seq: hits.get(seqId)
+        # the subject genome has fewer sequences, but more hits, whether the hits are saved or sampled.
+        self.assertFalse(rsd.rsd.shouldSwapGenomes(queryPath, subjectPath, None, forwardHits, reverseHits))
+        self.assertTrue(rsd.rsd.shouldSwapGenomes(subjectPath, queryPath, None, reverseHits, forwardHits))
+        self.assertFalse(rsd.rsd.shouldSwapGenomes(queryPath, subjectPath, getForwardHits=getHits(forwardHits), getReverseHits=getHits(reverseHits)))
+        self.assertTrue(rsd.rsd.shouldSwapGenomes(subjectPath, queryPath, getForwardHits=getHits(reverseHits), getReverseHits=getHits(forwardHits)))
+
+        plan = rsd.plan.planRun(queryPath, subjectPath, 1e-5, rsd.plan.HITS_SAVED, forwardHits, reverseHits, workers={'align': 2})
+        self.assertEqual('forward', plan['direction'])
+        self.assertEqual(4, plan['forward']['work']['alignments'])
+        self.assertEqual(7, plan['swapped']['work']['alignments'])
+        seconds = plan['forward']['seconds']
+        self.assertAlmostEqual(seconds['align'] + seconds['distance'], seconds['serialSeconds'])
+        self.assertAlmostEqual(max(seconds['align'] / 2, seconds['distance']), seconds['wallSeconds'])
+        self.assertTrue(rsd.plan.formatPlan(plan))
+
+        # sampling every sequence on-the-fly gives the same work.
+        sampled = rsd.plan.planRun(queryPath, subjectPath, 1e-5, rsd.plan.HITS_ON_THE_FLY, getForwardHits=getHits(forwardHits),
+                                   getReverseHits=getHits(reverseHits), sampleSize=10)
+        self.assertEqual(plan['forward']['work'], sampled['forward']['work'])
+        self.assertTrue(sampled['forward']['seconds']['hits'] > 0)
+
+    def test_swap_follows_the_plan(self):
+        getHits = lambda hits: lambda seqId, seq: hits.get(seqId)
+        def assertSwap(expected, queryPath, subjectPath, forwardHits, reverseHits, evalue, hitsMode):
+            if hitsMode == rsd.plan.HITS_SAVED:
+                hits = {'forwardHits': forwardHits, 'reverseHits': reverseHits}
+            else:
+                hits = {'getForwardHits': getHits(forwardHits), 'getReverseHits': getHits(reverseHits)}
+            plan = rsd.plan.planRun(queryPath, subjectPath, evalue, hitsMode, **hits)
+            self.assertEqual(expected, plan['direction'] == 'swapped')
+            self.assertEqual(expected, rsd.rsd.shouldSwapGenomes(queryPath, subjectPath, evalue=evalue, **hits))
+
+        queryPath = writeFasta(os.path.join(self.tmpDir, 'query.faa'), dict(('q{}'.format(i), 'M' * 50) for i in range(1, 4)))
+        subjectPath = writeFasta(os.path.join(self.tmpDir, 'subject.faa'), {'s1': 'M' * 50, 's2': 'M' * 50})
+        forwardHits = {'q1': [('s1', 1e-30)], 'q2': [('s1', 1e-30)], 'q3': []}
+        reverseHits = {'s1': [('q3', 1e-10)], 's2': [('q1', 1e-30), ('q2', 1e-10), ('q3', 1e-10)]}
+        # the weak reverse hits make the swapped direction costlier, unless the evalue of the run excludes them.
+        for hitsMode in (rsd.plan.HITS_SAVED, rsd.plan.HITS_ON_THE_FLY):
+            assertSwap(False, queryPath, subjectPath, forwardHits, reverseHits, 1e-5, hitsMode)
+            assertSwap(True, queryPath, subjectPath, forwardHits, reverseHits, 1e-20, hitsMode)
+
+        longQueryPath = writeFasta(os.path.join(self.tmpDir, 'long.faa'), {'q1': 'M' * 200})
+        forwardHits, reverseHits = {'q1': [('s1', 1e-30)]}, {'s1': [('q1', 1e-30)]}
+        # both directions align the same pair, but looking up the hits of the short sequence on-the-fly is cheaper.
+        assertSwap(False, longQueryPath, subjectPath, forwardHits, reverseHits, 1e-5, rsd.plan.HITS_SAVED)
+        assertSwap(True, longQueryPath, subjectPath, forwardHits, reverseHits, 1e-5, rsd.plan.HITS_ON_THE_FLY)
+        savedUnits = dict(rsd.rsd.SECONDS_PER_UNIT)
+        try:
+            rsd.rsd.setCostModel({'blast': 0.0})
+            assertSwap(False, longQueryPath, subjectPath, forwardHits, reverseHits, 1e-5, rsd.plan.HITS_ON_THE_FLY)
+        finally:
+            rsd.rsd.setCostModel(savedUnits)
+
+    def test_calibration_from_bench(self):
+        results = {'runs': [{'queryResidues': 1000, 'subjectResidues': 2000,
+                             'stages': {'align': {'seconds': 2.0, 'calls': 10, 'units': 1000},
+                                        'distance': {'seconds': 3.0, 'calls': 10, 'units': 300},
+                                        'blast': {'seconds': 4.0, 'calls': 2, 'units': 0}}}]}
+        path = os.path.join(self.tmpDir, 'bench.json')
+        with open(path, 'w') as fh:
+            json.dump(results, fh)
+        self.assertEqual({'align': 0.002, 'distance': 0.01, 'blast': 1e-6}, rsd.plan.loadCalibration(path))
+
+
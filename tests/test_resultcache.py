@@ -0,0 +1,80 @@
+
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import rsd.resultcache
+import rsd.rsd
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, data, opener=open):
+        path = os.path.join(self.tmpDir, name)
+        fh = opener(path, 'wb')
+        fh.write(data)
+        fh.close()
+        return path
+
+    def test_key_depends_on_contents_and_settings(self):
+        query = self.writeFile('query.faa', '>q1\nMKV\n')
+        queryGz = self.writeFile('renamed.faa.gz', '>q1\nMKV\n', gzip.open)
+        subject = self.writeFile('subject.faa', '>s1\nMKL\n')
+        changed = self.writeFile('changed.faa', '>s1\nMKI\n')
+        tools = {'blastp': None}
+        settings = {'searchBackend': 'blast'}
+        def key(queryPath=query, subjectPath=subject, divEvalues=(('0.8', '1e-5'), ('0.2', '1e-20')), **keywords):
+            keywords.setdefault('tools', tools)
+            keywords.setdefault('settings', settings)
+            return rsd.resultcache.resultKey(queryPath, subjectPath, divEvalues, **keywords)
+        self.assertEqual(key(), key(queryPath=queryGz, divEvalues=[(0.2, 1e-20), ('.8', '0.00001')]))
+        self.assertNotEqual(key(), key(subjectPath=changed))
+        self.assertNotEqual(key(), key(divEvalues=[('0.8', '1e-5')]))
+        self.assertNotEqual(key(), key(ids=['q1']))
+        self.assertNotEqual(key(), key(hitsPaths=[subject, None]))
+        self.assertNotEqual(key(), key(tools={'blastp': 'abc'}))
+        self.assertNotEqual(key(), key(settings={'searchBackend': 'kmer'}))
+
+    def test_key_depends_on_aligner(self):
+        query = self.writeFile('query.faa', '>q1\nMKV\n')
+        subject = self.writeFile('subject.faa', '>s1\nMKL\n')
+        useClustalw = rsd.rsd.USE_CLUSTALW
+        try:
+            keys = []
+            for value in (False, True):
+                rsd.rsd.USE_CLUSTALW = value
+                self.assertEqual(value, rsd.resultcache.engineSettings()['useClustalw'])
+                keys.append(rsd.resultcache.resultKey(query, subject, [('0.2', '1e-20')], tools={}))
+            self.assertNotEqual(keys[0], keys[1])
+        finally:
+            rsd.rsd.USE_CLUSTALW = useClustalw
+        self.assertTrue('clustalw' in rsd.resultcache.TOOLS)
+
+    def test_get_put_and_prune(self):
+        cache = rsd.resultcache.ResultCache(os.path.join(self.tmpDir, 'cache'))
+        divEvalueToOrthologs = {('0.8', '1e-5'): [('q1', 's1', 0.1234), ('q2', 's2', 1.5)], ('0.2', '1e-20'): []}
+        self.assertEqual(None, cache.get('a' * 40, list(divEvalueToOrthologs)))
+        path = cache.put('a' * 40, divEvalueToOrthologs, 'query.faa', 'subject.faa')
+        self.assertEqual(cache.path('a' * 40), path)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(path))], [os.path.basename(path)])
+        # thresholds are matched by value.
+        self.assertEqual({(0.8, 1e-5): divEvalueToOrthologs[('0.8', '1e-5')]}, cache.get('a' * 40, [(0.8, 1e-5)]))
+        self.assertEqual(None, cache.get('a' * 40, [('0.5', '1e-5')]))
+        # the least recently used results are removed first.
+        cache.put('b' * 40, divEvalueToOrthologs)
+        cache.put('c' * 40, divEvalueToOrthologs)
+        now = time.time()
+        for age, key in enumerate(['c' * 40, 'a' * 40, 'b' * 40]):
+            os.utime(cache.path(key), (now - age * 100, now - age * 100))
+        cache.get('b' * 40, list(divEvalueToOrthologs))
+        self.assertEqual(1, cache.prune(maxBytes=2 * os.path.getsize(path)))
+        self.assertEqual([False, True, True], [os.path.exists(cache.path(key)) for key in ('a' * 40, 'b' * 40, 'c' * 40)])
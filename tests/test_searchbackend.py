@@ -0,0 +1,67 @@
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import rsd.bench
+import rsd.rsd
+import rsd.search
+
+
+class TestSmithWaterman(unittest.TestCase):
+
+    def test_identical_and_python_matches_numpy(self):
+        seq = 'MKTAYIAKQRQISFVKSHFSRQ'
+        query = rsd.search.encode(seq)
+        identity = sum(rsd.search.BLOSUM62[code][code] for code in query)
+        self.assertEqual([identity], rsd.search.smithWatermanScores(query, [query]))
+        if rsd.search.numpy is None:
+            return
+        rand = random.Random(3)
+        for i in range(50):
+            query = [rand.randrange(20) for j in range(rand.randint(1, 40))]
+            subjects = []
+            for j in range(rand.randint(1, 4)):
+                subject = list(query)
+                for k in range(rand.randint(0, 8)):
+                    pos = rand.randrange(len(subject) + 1)
+                    if rand.random() < 0.5:
+                        subject.insert(pos, rand.randrange(20))
+                    elif pos < len(subject):
+                        del subject[pos]
+                subjects.append(subject)
+            self.assertEqual([rsd.search._smithWatermanPython(query, subject) for subject in subjects],
+                             rsd.search._smithWatermanNumpy(query, subjects))
+
+
+class TestKmerBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.queryPath = os.path.join(self.tmpDir, 'query.faa')
+        self.subjectPath = os.path.join(self.tmpDir, 'subject.faa')
+        self.orthologs = rsd.bench.makeSyntheticProteomes(self.queryPath, self.subjectPath, 30, 30, meanLength=150, seed=2)
+        self.searchBackend = rsd.rsd.SEARCH_BACKEND
+
+    def tearDown(self):
+        rsd.rsd.setSearchBackend(self.searchBackend)
+        shutil.rmtree(self.tmpDir)
+
+    def test_finds_orthologs(self):
+        rsd.rsd.setSearchBackend('kmer')
+        self.assertEqual(self.subjectPath, rsd.rsd.formatFastaArg(self.subjectPath))
+        hitsMap = rsd.rsd.getBlastHits(self.queryPath, self.subjectPath, 1e-5, workingDir=self.tmpDir)
+        found = [(qid, sid) for qid, sid in self.orthologs if sid in [hitId for hitId, evalue in hitsMap.get(qid, [])]]
+        self.assertTrue(len(found) >= 0.9 * len(self.orthologs), (found, self.orthologs))
+        for hits in hitsMap.values():
+            self.assertTrue(len(hits) <= rsd.rsd.MAX_HITS)
+            self.assertEqual(sorted(evalue for hitId, evalue in hits), [evalue for hitId, evalue in hits])
+            self.assertTrue(all(evalue < 1e-5 for hitId, evalue in hits))
+
+    def test_hits_map_from_hits_gen(self):
+        hits = [('q1', 's1', 1e-30), ('q1', 's1', 1e-10), ('q1', 's2', 1e-9), ('q1', 's3', 1e-8), ('q2', 's1', 1e-6)]
+        self.assertEqual({'q1': [('s1', 1e-30), ('s2', 1e-9)], 'q2': [('s1', 1e-6)]}, rsd.rsd.hitsMapFromHitsGen(hits, 2))
+
+
@@ -0,0 +1,93 @@
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import rsd.orthutil
+import rsd.rsd
+import rsd.shard
+from tests.test_orthologs import FakeTools, getHitsFunc
+
+
+def makeRandomGenomes(tmpDir, numQuerySeqs, numSubjectSeqs, seed=0):
+    '''
+    Writes random query and subject genomes and returns their paths, random forward and reverse hits, and distances
+    between every pair of sequences, for use with FakeTools.
+    '''
+    rand = random.Random(seed)
+    queryIds = ['q{}'.format(i) for i in range(numQuerySeqs)]
+    subjectIds = ['s{}'.format(i) for i in range(numSubjectSeqs)]
+    paths = []
+    for name, ids in (('query.faa', queryIds), ('subject.faa', subjectIds)):
+        path = os.path.join(tmpDir, name)
+        with open(path, 'w') as fh:
+            for seqId in ids:
+                fh.write('>{}\n{}\n'.format(seqId, 'M' * rand.randint(10, 60)))
+        paths.append(path)
+    distances = dict((frozenset([q, s]), rand.choice([0.1, 0.2, 0.3, 0.5])) for q in queryIds for s in subjectIds)
+    forwardHits = dict((q, [(s, rand.choice([1e-30, 1e-10])) for s in rand.sample(subjectIds, 3)]) for q in queryIds)
+    reverseHits = dict((s, [(q, rand.choice([1e-30, 1e-10])) for q in rand.sample(queryIds, 3)]) for s in subjectIds)
+    return paths[0], paths[1], getHitsFunc(forwardHits), getHitsFunc(reverseHits), distances
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_assign_shards(self):
+        idsAndLengths = [('a', 100), ('b', 90), ('c', 50), ('d', 50), ('e', 40), ('f', 10)]
+        assignment = rsd.shard.assignShards(idsAndLengths, 2)
+        self.assertEqual(assignment, rsd.shard.assignShards(list(reversed(idsAndLengths)), 2))
+        loads = [sum(length for seqId, length in idsAndLengths if assignment[seqId] == shard) for shard in (1, 2)]
+        self.assertEqual([160, 180], sorted(loads))
+        self.assertEqual((3, 10), rsd.shard.parseShard('3/10'))
+        for arg in ('0/10', '11/10', '3', 'a/b'):
+            self.assertRaises(ValueError, rsd.shard.parseShard, arg)
+
+    def test_merged_shards_match_single_run(self):
+        divEvalues = [(0.2, 1e-20), (0.8, 1e-05)]
+        # a larger query genome makes a single run swap the genomes.
+        for numQuerySeqs, numSubjectSeqs in ((20, 25), (25, 20)):
+            queryPath, subjectPath, getForwardHits, getReverseHits, distances = makeRandomGenomes(self.tmpDir, numQuerySeqs, numSubjectSeqs)
+            isSwapped = rsd.rsd.shouldSwapGenomes(queryPath, subjectPath, getForwardHits=getForwardHits, getReverseHits=getReverseHits, evalue=1e-05)
+            self.assertEqual(numQuerySeqs > numSubjectSeqs, isSwapped)
+            with FakeTools(distances):
+                divEvalueToOrthologs = rsd.rsd.computeOrthologs(queryPath, subjectPath, divEvalues, getForwardHits, getReverseHits, workingDir=self.tmpDir)
+                singlePath = os.path.join(self.tmpDir, 'single.txt')
+                rsd.orthutil.orthDatasToFile([(('query.faa', 'subject.faa', div, evalue), divEvalueToOrthologs[(div, evalue)]) for div, evalue in divEvalues], singlePath)
+                for numShards in (1, 3, 7):
+                    shardPaths = []
+                    for shard in range(1, numShards + 1):
+                        ids, ranks, numIds = rsd.shard.shardIdsAndRanks(subjectPath if isSwapped else queryPath, shard, numShards)
+                        shardOrthologs = rsd.rsd.computeOrthologsForChunk(queryPath, subjectPath, divEvalues, getForwardHits, getReverseHits, ids, isSwapped, self.tmpDir)
+                        orthDatas = [(('query.faa', 'subject.faa', div, evalue), shardOrthologs[(div, evalue)]) for div, evalue in divEvalues]
+                        shardPath = os.path.join(self.tmpDir, 'shard{}.txt'.format(shard))
+                        rsd.shard.writeShard(shardPath, orthDatas, shard, numShards, 'query.faa', 'subject.faa', divEvalues, isSwapped, ids, ranks, numIds)
+                        shardPaths.append(shardPath)
+                    mergedPath = rsd.shard.mergeShards(list(reversed(shardPaths)), os.path.join(self.tmpDir, 'merged.txt'))
+                    with open(singlePath) as single, open(mergedPath) as merged:
+                        self.assertEqual(single.read(), merged.read())
+                    if numShards > 1:
+                        self.assertRaises(Exception, rsd.shard.mergeShards, shardPaths[1:], mergedPath)
+
+    def test_shards_that_dropped_pairs_are_only_merged_if_allowed(self):
+        divEvalues = [(0.8, 1e-05)]
+        paths = []
+        for shard, dropped in ((1, {'distance': [('q1', 's1')], 'align': []}), (2, None)):
+            path = os.path.join(self.tmpDir, 'shard{}.txt'.format(shard))
+            rsd.shard.writeShard(path, [(('query.faa', 'subject.faa', 0.8, 1e-05), [])], shard, 2, 'query.faa', 'subject.faa',
+                                 divEvalues, False, ['q{}'.format(shard)], [shard - 1], 2, dropped)
+            paths.append(path)
+        mergedPath = os.path.join(self.tmpDir, 'merged.txt')
+        self.assertRaises(Exception, rsd.shard.mergeShards, paths, mergedPath)
+        self.assertFalse(os.path.exists(mergedPath))
+        self.assertEqual(mergedPath, rsd.shard.mergeShards(paths, mergedPath, allowDropped=True))
+        self.assertEqual({'distance': [('q1', 's1')]}, rsd.shard.droppedPairs(rsd.shard.readSidecar(path) for path in paths))
+
+
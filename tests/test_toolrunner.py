@@ -0,0 +1,97 @@
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import rsd.nested
+import rsd.toolrunner
+import rsd.util
+
+
+class TestToolRunner(unittest.TestCase):
+
+    def test_limits_and_order(self):
+        lock = threading.Lock()
+        running = {'align': 0, 'distance': 0}
+        peaks = {'align': 0, 'distance': 0}
+        def call(tool, value):
+            with lock:
+                running[tool] += 1
+                peaks[tool] = max(peaks[tool], running[tool])
+            time.sleep(0.01)
+            with lock:
+                running[tool] -= 1
+            return value * 2
+        with rsd.toolrunner.ToolRunner({'align': 2, 'distance': 3}) as runner:
+            futures = [runner.submit('align', call, 'align', i) for i in range(10)]
+            self.assertEqual(range(0, 40, 2), runner.map('distance', call, [('distance', i) for i in range(20)]))
+            self.assertEqual(range(0, 20, 2), [future.result() for future in futures])
+        self.assertEqual({'align': 2, 'distance': 3}, peaks)
+
+    def test_exception_is_raised(self):
+        def fail(value):
+            if value == 3:
+                raise ValueError(value)
+            return value
+        with rsd.toolrunner.ToolRunner({'align': 2}) as runner:
+            with self.assertRaises(ValueError):
+                runner.map('align', fail, [(i,) for i in range(6)])
+            self.assertEqual([1, 2], runner.map('align', fail, [(1,), (2,)]))
+
+
+class TestWorkDirs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_timeout_kills_process_group(self):
+        start = time.time()
+        # the shell waits on a child that keeps stdout open, so only killing both ends the call.
+        self.assertRaises(rsd.util.CommandTimeout, rsd.util.run, ['sh', '-c', 'sleep 30 & wait'], timeout=0.2)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual('ok\n', rsd.util.run(['echo', 'ok'], timeout=10))
+        self.assertEqual(None, rsd.util.checkCall(['true'], timeout=10))
+
+    def test_dirs_are_prepared_once_and_recycled(self):
+        prepared = []
+        def prepare(path):
+            prepared.append(path)
+            open(os.path.join(path, 'codeml.ctl'), 'w').close()
+        with rsd.nested.ScratchPool(size=4, dir=self.tmpDir) as pool:
+            with rsd.toolrunner.WorkDirs(pool, prepare) as workDirs:
+                with workDirs.dir() as first:
+                    with workDirs.dir() as second:
+                        self.assertNotEqual(first, second)
+                with workDirs.dir() as path:
+                    self.assertTrue(path in (first, second))
+                    self.assertEqual(['codeml.ctl'], os.listdir(path))
+                self.assertEqual(2, len(prepared))
+            # closing the work dirs returns them to the scratch pool, cleaned.
+            self.assertEqual([], os.listdir(first))
+
+    def test_limit_leaves_dirs_for_other_work_dirs(self):
+        with rsd.nested.ScratchPool(size=3, dir=self.tmpDir) as pool:
+            with rsd.toolrunner.WorkDirs(pool, limit=2) as aligns, rsd.toolrunner.WorkDirs(pool, limit=1) as distances:
+                taken = []
+                def work(workDirs):
+                    with workDirs.dir() as path:
+                        with lock:
+                            taken.append(path)
+                        time.sleep(0.01)
+                lock = threading.Lock()
+                threads = [threading.Thread(target=work, args=(workDirs,)) for workDirs in [aligns] * 5 + [distances] * 5]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join(10)
+                self.assertFalse(any(thread.is_alive() for thread in threads))
+                self.assertEqual(3, len(set(taken)))
+                self.assertEqual((2, 1), (len(aligns.all), len(distances.all)))
+
+
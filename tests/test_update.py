@@ -0,0 +1,111 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rsd.bench
+import rsd.fasta
+import rsd.rsd
+import rsd.update
+from tests.test_orthologs import FakeTools
+
+
+class SeqDistanceTools(FakeTools):
+    '''
+    Fakes a distance that depends only on the sequences, so it is the same however the orthologs are computed.
+    '''
+    def getDistanceForAlignedSeqPair(self, seqId, alignedSeq, hitSeqId, alignedHitSeq, workPath):
+        with self.lock:
+            self.numDistances += 1
+        mismatches = sum(1 for a, b in zip(alignedSeq, alignedHitSeq) if a != b) + abs(len(alignedSeq) - len(alignedHitSeq))
+        return round(mismatches / float(max(len(alignedSeq), len(alignedHitSeq))), 4)
+
+
+def writeFasta(path, records):
+    with open(path, 'w') as fh:
+        for seqId, seq in records:
+            fh.write('>{}\n{}'.format(seqId, rsd.fasta.prettySeq(seq)))
+    return path
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.searchBackend = rsd.rsd.SEARCH_BACKEND
+        rsd.rsd.setSearchBackend('kmer')
+
+    def tearDown(self):
+        rsd.rsd.setSearchBackend(self.searchBackend)
+        shutil.rmtree(self.tmpDir)
+
+    def computePair(self, queryPath, subjectPath, divEvalues):
+        forwardHits = rsd.rsd.getBlastHits(queryPath, subjectPath, 1e-5, workingDir=self.tmpDir)
+        reverseHits = rsd.rsd.getBlastHits(subjectPath, queryPath, 1e-5, workingDir=self.tmpDir)
+        getForwardHits = lambda seqId, seq: forwardHits.get(seqId)
+        getReverseHits = lambda seqId, seq: reverseHits.get(seqId)
+        # like saved hits, which let the full run swap the genomes by their estimated work.
+        getForwardHits.hitsDb, getReverseHits.hitsDb = forwardHits, reverseHits
+        with SeqDistanceTools():
+            divEvalueToOrthologs = rsd.rsd.computeOrthologs(queryPath, subjectPath, divEvalues, getForwardHits, getReverseHits)
+        orthDatas = [(('query.faa', 'subject.faa', div, evalue), divEvalueToOrthologs[(div, evalue)]) for div, evalue in divEvalues]
+        return forwardHits, reverseHits, orthDatas
+
+    def test_update_matches_full_recompute(self):
+        oldQueryPath = os.path.join(self.tmpDir, 'old', 'query.faa')
+        newQueryPath = os.path.join(self.tmpDir, 'new', 'query.faa')
+        subjectPath = os.path.join(self.tmpDir, 'subject.faa')
+        os.makedirs(os.path.dirname(oldQueryPath))
+        os.makedirs(os.path.dirname(newQueryPath))
+        rsd.bench.makeSyntheticProteomes(oldQueryPath, subjectPath, 30, 30, meanLength=100, seed=5)
+        # change two proteins, remove one, and add a copy of a subject protein.
+        records = [(rsd.fasta.idFromName(nameline), seq) for nameline, seq in rsd.fasta.readFasta(oldQueryPath)]
+        records[3] = (records[3][0], records[3][1][:40] + 'W' * 10 + records[3][1][50:])
+        records[10] = (records[10][0], records[10][1][::-1])
+        del records[20]
+        records.append(('Q999999', list(rsd.fasta.readFasta(subjectPath))[7][1]))
+        writeFasta(newQueryPath, records)
+        divEvalues = [('0.8', '1e-5'), ('0.2', '1e-20')]
+
+        oldForward, oldReverse, oldOrthDatas = self.computePair(oldQueryPath, subjectPath, divEvalues)
+        with SeqDistanceTools() as tools:
+            forwardHits, reverseHits, orthDatas, stats = rsd.update.updateGenomePair(
+                oldQueryPath, newQueryPath, subjectPath, subjectPath, oldForward, oldReverse, oldOrthDatas, 1e-5, self.tmpDir)
+        expectedForward, expectedReverse, expectedOrthDatas = self.computePair(newQueryPath, subjectPath, divEvalues)
+
+        self.assertEqual((3, 1, 0, 0), (stats['queryChanged'], stats['queryRemoved'], stats['subjectChanged'], stats['subjectRemoved']))
+        self.assertTrue(stats['recomputed'] < len(records) / 2, stats)
+        self.assertEqual(len(records), stats['recomputed'] + stats['carried'])
+        self.assertTrue(tools.numAlignments)
+        for hits, expected in ((forwardHits, expectedForward), (reverseHits, expectedReverse)):
+            self.assertEqual(sorted(expected), sorted(hits))
+            for seqId in expected:
+                self.assertEqual([hitId for hitId, evalue in expected[seqId]], [hitId for hitId, evalue in hits[seqId]])
+                for (hitId, evalue), (expectedId, expectedEvalue) in zip(hits[seqId], expected[seqId]):
+                    self.assertAlmostEqual(1.0, evalue / expectedEvalue)
+        self.assertTrue(expectedOrthDatas[0][1])
+        self.assertEqual(expectedOrthDatas, orthDatas)
+
+    def test_update_orders_orthologs_like_a_swapped_full_run(self):
+        oldQueryPath = os.path.join(self.tmpDir, 'old', 'query.faa')
+        newQueryPath = os.path.join(self.tmpDir, 'new', 'query.faa')
+        subjectPath = os.path.join(self.tmpDir, 'subject.faa')
+        os.makedirs(os.path.dirname(oldQueryPath))
+        os.makedirs(os.path.dirname(newQueryPath))
+        rsd.bench.makeSyntheticProteomes(oldQueryPath, subjectPath, 60, 15, meanLength=100, seed=7)
+        records = [(rsd.fasta.idFromName(nameline), seq) for nameline, seq in rsd.fasta.readFasta(oldQueryPath)]
+        records[5] = (records[5][0], records[5][1][::-1])
+        writeFasta(newQueryPath, records)
+        divEvalues = [('0.8', '1e-5')]
+
+        oldForward, oldReverse, oldOrthDatas = self.computePair(oldQueryPath, subjectPath, divEvalues)
+        with SeqDistanceTools():
+            forwardHits, reverseHits, orthDatas, stats = rsd.update.updateGenomePair(
+                oldQueryPath, newQueryPath, subjectPath, subjectPath, oldForward, oldReverse, oldOrthDatas, 1e-5, self.tmpDir)
+        expectedForward, expectedReverse, expectedOrthDatas = self.computePair(newQueryPath, subjectPath, divEvalues)
+
+        self.assertTrue(rsd.rsd.shouldSwapGenomes(newQueryPath, subjectPath, None, forwardHits, reverseHits))
+        self.assertTrue(stats['carried'])
+        self.assertTrue(len(set(ortholog[0] for ortholog in expectedOrthDatas[0][1])) > 1)
+        self.assertEqual(expectedOrthDatas, orthDatas)
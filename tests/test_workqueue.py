@@ -0,0 +1,133 @@
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import rsd.workqueue
+
+
+def computeChunk(ids):
+    orthDatas = [(('Q', 'S', 0.8, 1e-05), [(i, 's' + i, 0.5) for i in ids]),
+                 (('Q', 'S', 0.2, 1e-05), [(i, 's' + i, 0.5) for i in ids if i.endswith('0')])]
+    # pretend codeml timed out for every id ending in 5.
+    return orthDatas, {'distance': [(i, 's' + i) for i in ids if i.endswith('5')]}
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.queueDir = os.path.join(self.tmpDir, 'queue')
+        self.ids = ['q{}'.format(i) for i in range(25)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_workers_merge_in_order(self):
+        first = rsd.workqueue.WorkQueue(self.queueDir, workerId='first')
+        config = first.create({'job': 'test'}, rsd.workqueue.chunkIds(self.ids, 4))
+        self.assertEqual(7, config['numChunks'])
+        second = rsd.workqueue.WorkQueue(self.queueDir, workerId='second')
+        self.assertEqual(config, second.create({'job': 'other'}, []))
+        # the first worker completes one ticket and the second finishes the rest.
+        ticket = first.claim()
+        self.assertTrue(first.complete(ticket, *computeChunk(ticket.ids)))
+        self.assertEqual(6, rsd.workqueue.runWorker(second, computeChunk, poll=0))
+        self.assertTrue(first.isDone())
+        mergeLock = first.claimMerge()
+        self.assertTrue(mergeLock)
+        self.assertEqual(None, second.claimMerge())
+        self.assertEqual([(i, 's' + i, '0.5') for i in self.ids], list(rsd.workqueue.mergedOrthologsGen(first, (0.8, 1e-05))))
+        self.assertEqual([('q0', 'sq0', '0.5'), ('q10', 'sq10', '0.5'), ('q20', 'sq20', '0.5')],
+                         list(rsd.workqueue.mergedOrthologsGen(first, (0.2, 1e-05))))
+        # the pairs dropped by both workers.
+        self.assertEqual({'distance': [('q5', 'sq5'), ('q15', 'sq15')]}, second.dropped())
+        mergeLock.release()
+        self.assertTrue(second.isMerged())
+        self.assertEqual(None, second.claimMerge())
+
+    def test_expired_lease_is_reclaimed(self):
+        crashed = rsd.workqueue.WorkQueue(self.queueDir, leaseSeconds=60, workerId='crashed')
+        crashed.create({}, rsd.workqueue.chunkIds(self.ids, 10))
+        ticket = crashed.claim()
+        worker = rsd.workqueue.WorkQueue(self.queueDir, leaseSeconds=60, workerId='worker')
+        self.assertEqual(0, worker.reclaimStale())
+        # the crashed worker stopped refreshing its lease long ago.
+        past = time.time() - 120
+        os.utime(ticket.path, (past, past))
+        self.assertEqual(1, worker.reclaimStale())
+        self.assertEqual(3, rsd.workqueue.runWorker(worker, computeChunk, poll=0))
+        # completing the reclaimed ticket fails, but does not corrupt the results.
+        self.assertFalse(crashed.complete(ticket, *computeChunk(ticket.ids)))
+        self.assertTrue(worker.isDone())
+        self.assertEqual(self.ids, [qid for qid, sid, dist in rsd.workqueue.mergedOrthologsGen(worker, (0.8, 1e-05))])
+
+    def test_lease_refreshes_ticket(self):
+        queue = rsd.workqueue.WorkQueue(self.queueDir, leaseSeconds=60)
+        queue.create({}, [self.ids])
+        ticket = queue.claim()
+        past = time.time() - 120
+        os.utime(ticket.path, (past, past))
+        with rsd.workqueue.Lease(ticket.path, 0.01):
+            time.sleep(0.1)
+        self.assertEqual(0, queue.reclaimStale())
+
+
+
+    def test_costliest_chunks_are_claimed_first(self):
+        queue = rsd.workqueue.WorkQueue(self.queueDir, workerId='worker')
+        chunks = rsd.workqueue.chunkIds(self.ids, 10)
+        queue.create({}, chunks, [5, 20, 5])
+        self.assertEqual([chunks[1], chunks[0], chunks[2]], [queue.claim().ids for chunk in chunks])
+        self.assertEqual(None, queue.claim())
+
+    def test_stale_lock_is_taken_over_once(self):
+        lockPath = os.path.join(self.tmpDir, 'lock')
+        crashed = rsd.workqueue.QueueLock(lockPath, 60, 'crashed')
+        self.assertTrue(crashed.acquire())
+        crashed.lease.stop()
+        past = time.time() - 120
+        os.utime(lockPath, (past, past))
+        first = rsd.workqueue.QueueLock(lockPath, 60, 'first')
+        second = rsd.workqueue.QueueLock(lockPath, 60, 'second')
+        # the first worker takes the lock over after the second one found it stale and before it renames it away.
+        def isStaleThenTakenOver(path=None):
+            isStale = rsd.workqueue.QueueLock.isStale(second, path)
+            if path is None:
+                self.assertTrue(first.acquire())
+            return isStale
+        second.isStale = isStaleThenTakenOver
+        self.assertFalse(second.acquire())
+        self.assertEqual('first', first.owner())
+        self.assertEqual(['lock'], os.listdir(self.tmpDir))
+        # a worker that lost the lock does not release it.
+        crashed.release()
+        self.assertTrue(os.path.isdir(lockPath))
+        first.release()
+        self.assertEqual([], os.listdir(self.tmpDir))
+
+    def test_dead_creator_and_merger_are_taken_over(self):
+        past = time.time() - 120
+        # the creator died after making the lock and some of the queue.
+        crashed = rsd.workqueue.WorkQueue(self.queueDir, leaseSeconds=60, workerId='crashed')
+        os.makedirs(os.path.join(self.queueDir, rsd.workqueue.CREATING_NAME))
+        os.mkdir(crashed.todoDir)
+        os.utime(os.path.join(self.queueDir, rsd.workqueue.CREATING_NAME), (past, past))
+        worker = rsd.workqueue.WorkQueue(self.queueDir, leaseSeconds=60, workerId='worker')
+        self.assertEqual(3, worker.create({}, rsd.workqueue.chunkIds(self.ids, 10), wait=0)['numChunks'])
+        self.assertFalse(os.path.exists(os.path.join(self.queueDir, rsd.workqueue.CREATING_NAME)))
+        # a merge can not start until every chunk has results.
+        self.assertRaises(Exception, list, rsd.workqueue.mergedOrthologsGen(worker, (0.8, 1e-05)))
+        self.assertEqual(3, rsd.workqueue.runWorker(worker, computeChunk, poll=0))
+        # the merger died without finishing.
+        mergeLock = crashed.claimMerge()
+        mergeLock.lease.stop()
+        self.assertEqual(None, worker.claimMerge())
+        os.utime(mergeLock.path, (past, past))
+        takeover = worker.claimMerge()
+        self.assertTrue(takeover)
+        self.assertEqual(self.ids, [qid for qid, sid, dist in rsd.workqueue.mergedOrthologsGen(worker, (0.8, 1e-05))])
+        takeover.release()
+        self.assertTrue(worker.isMerged())